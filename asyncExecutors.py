@@ -0,0 +1,444 @@
+import asyncio, time, random, aiohttp
+from multiprocessing.pool import Pool
+from executors import QuerySetExecutor, ResultCollector, init_worker, forward_result, CHUNK_BYTES
+from connections import get_connection_settings, get_base_url, new_timings
+from users import get_start_offset, get_think_time, get_deadline, has_more_iterations, get_user_nums
+from histograms import ResultStats
+from results import ResultTable
+from retries import RETRY_STATUSES
+from pagination import get_page_settings, get_page_url, get_page_offsets
+from responses import TAIL_BYTES, keep_tail
+
+def get_async_settings(target):
+    settings = {'concurrency': 100, 'processes': 1}
+    if 'async' in target and target['async'] != None:
+        settings.update(target['async'])
+    return settings
+
+# Trace hooks. Only queries pass a trace context, prewarming and page requests don't.
+
+async def on_request_start(session, context, params):
+    if context.trace_request_ctx != None:
+        # aiohttp opens the connection and its TLS session in one step, so there is no separate TLS phase
+        context.trace_request_ctx['timings'] = dict(new_timings(), tls_s=None)
+
+async def on_dns_resolvehost_start(session, context, params):
+    if context.trace_request_ctx != None:
+        context.trace_request_ctx['dns_start'] = time.perf_counter()
+
+async def on_dns_resolvehost_end(session, context, params):
+    if context.trace_request_ctx != None:
+        timings = context.trace_request_ctx['timings']
+        timings['dns_s'] += time.perf_counter() - context.trace_request_ctx['dns_start']
+
+async def on_connection_create_start(session, context, params):
+    if context.trace_request_ctx != None:
+        context.trace_request_ctx['connect_start'] = time.perf_counter()
+
+async def on_connection_create_end(session, context, params):
+    if context.trace_request_ctx != None:
+        context.trace_request_ctx['new_connection'] = True
+        # Name resolution happens while the connection is created
+        timings = context.trace_request_ctx['timings']
+        timings['connect_s'] = time.perf_counter() - context.trace_request_ctx['connect_start'] - timings['dns_s']
+
+async def on_request_chunk_sent(session, context, params):
+    if context.trace_request_ctx != None:
+        context.trace_request_ctx['timings']['sent'] = time.perf_counter()
+
+async def on_request_end(session, context, params):
+    # Called once the response headers have been read
+    if context.trace_request_ctx != None:
+        context.trace_request_ctx['timings']['headers'] = time.perf_counter()
+
+def new_trace_config():
+    # Lets each request find out whether it opened a new connection or reused a pooled one, and how long
+    # each phase of the request took
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+def describe_error(e):
+    # Timeouts have no message of their own
+    if isinstance(e, asyncio.TimeoutError):
+        return 'TimeoutError. The request timed out'
+    return f'{type(e).__name__}. {e}'
+
+class AsyncQSExecutor(QuerySetExecutor):
+    # Runs queries as coroutines on a single event loop instead of one process per query.
+    # The number of queries in flight is capped by the async concurrency setting.
+
+    # Whether the executor can split its queries across processes
+    fans_out = False
+
+    def __init__(self,target, query_set, templates=None):
+       super().__init__(target, query_set, templates)
+       self.settings = get_async_settings(target)
+       if self.settings['processes'] > 1 and not self.fans_out:
+           raise ValueError('The async processes setting only applies to QPS, capacity and virtual user tests')
+
+    def new_session(self):
+        connection_settings = get_connection_settings(self.target)
+        connector = aiohttp.TCPConnector(
+            limit=self.settings['concurrency'],
+            force_close=not connection_settings['keep_alive'])
+        return aiohttp.ClientSession(connector=connector, trace_configs=[new_trace_config()])
+
+    async def prewarm(self, http):
+        connection_settings = get_connection_settings(self.target)
+        count = min(connection_settings['prewarm'], self.settings['concurrency'])
+        if not connection_settings['keep_alive'] or count < 1:
+            return
+
+        async def warm():
+            try:
+                async with http.get(
+                    get_base_url(self.target) + '/v1/orgs/self/virtualinstances',
+                    headers={'Authorization': 'ApiKey ' + self.target['api_key']}) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f'Warning: unable to prewarm connection. {e}')
+
+        await asyncio.gather(*[warm() for x in range(0, count)])
+
+    async def run_query_async(self, http, query_num, user_num, target, query):
+        result = self.new_result(query_num, user_num, query)
+
+        template = self.get_template(query_num, query)
+        if template == None:
+            result['status'] = 'invalid'
+            result['message'] = 'Query definition has neither lambda or sql specified'
+            return result
+        url, headers, drop_results = template.url, template.headers, template.drop_results
+        request_body = template.render(self.feed_values(query_num, user_num))
+        tail_only = self.keeps_tail(template)
+
+        trace_context = {'new_connection': False}
+        admission = self.admission_wait_s()
+        if admission > 0:
+            await asyncio.sleep(admission)
+        first_start = time.perf_counter()
+        attempts = 0
+        retried = []
+        backoff = 0.0
+        while True:
+            attempts += 1
+            self.query_sent()
+            start = time.perf_counter()
+            try:
+                async with http.post(url, data=request_body, headers=headers, trace_request_ctx=trace_context) as qryResopnse:
+                    # The body is kept as bytes until the response is summarized
+                    chunks = bytearray() if tail_only else []
+                    size = 0
+                    async for chunk in qryResopnse.content.iter_chunked(CHUNK_BYTES):
+                        size += len(chunk)
+                        if tail_only:
+                            keep_tail(chunks, chunk)
+                        else:
+                            chunks.append(chunk)
+                    body = bytes(chunks[-TAIL_BYTES:]) if tail_only else b''.join(chunks)
+                    end = time.perf_counter()
+                    status_code = qryResopnse.status
+                    reason = qryResopnse.reason
+                    retry_after = qryResopnse.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # The session's timeout raises asyncio.TimeoutError, which isn't a ClientError
+                result['status'] = 'error'
+                result['message'] = describe_error(e)
+                self.record_attempts(result, attempts, retried, backoff, admission)
+                return result
+            finally:
+                self.query_answered()
+            wait = self.retry_wait_s(status_code, attempts, first_start, retry_after)
+            if wait == None:
+                break
+            retried.append(RETRY_STATUSES[status_code])
+            await asyncio.sleep(wait)
+            backoff += wait
+        result['new_connection'] = trace_context['new_connection']
+        self.record_attempts(result, attempts, retried, backoff, admission)
+        self.record_phases(result, trace_context.get('timings'), start, end)
+
+        message = None
+        if status_code != 200:
+            message = f'{reason}. {body.decode(errors="replace")}'
+        pagination = self.record_response(result, status_code, message, body, size, start, end, drop_results)
+        if pagination != None:
+            await self.drain_pages_async(http, target, query, headers, result, pagination, start)
+
+        return result
+
+    async def fetch_page_async(self, http, url, headers):
+        self.query_sent()
+        start = time.perf_counter()
+        try:
+            async with http.get(url, headers=headers) as response:
+                chunks = []
+                async for chunk in response.content.iter_chunked(CHUNK_BYTES):
+                    chunks.append(chunk)
+                body = b''.join(chunks)
+                status_code = response.status
+                reason = response.reason
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return None, describe_error(e), b'', None
+        finally:
+            self.query_answered()
+        page_ms = round((time.perf_counter() - start) * 1000, 1)
+        message = None
+        if status_code != 200:
+            message = f'{reason}. {body.decode(errors="replace")}'
+        return status_code, message, body, page_ms
+
+    async def drain_pages_async(self, http, target, query, headers, result, pagination, start):
+        settings = get_page_settings(query)
+        page_size = settings['page_size']
+        self.start_pages(result)
+        if settings['page_pipeline'] > 1:
+            # Every remaining page is requested as an offset from the start cursor, page_pipeline at a time
+            semaphore = asyncio.Semaphore(settings['page_pipeline'])
+
+            async def fetch(url):
+                async with semaphore:
+                    return await self.fetch_page_async(http, url, headers)
+
+            urls = [get_page_url(target, pagination['query_id'], pagination['start_cursor'], page_size, offset)
+                for offset in get_page_offsets(pagination, page_size)]
+            for page in await asyncio.gather(*[fetch(url) for url in urls]):
+                self.record_page(result, *page)
+                if result['status'] != 'success':
+                    break
+        else:
+            cursor = pagination['next_cursor']
+            while cursor != None and result['status'] == 'success':
+                url = get_page_url(target, pagination['query_id'], cursor, page_size)
+                cursor = self.record_page(result, *await self.fetch_page_async(http, url, headers))
+        self.finish_pages(result, start)
+
+    async def run_bounded_query(self, http, semaphore, query_num, user_num, target, query, iteration=None):
+        async with semaphore:
+            result = await self.run_query_async(http, query_num, user_num, target, query)
+        # Virtual users tag their results with the iteration before the result handlers see them
+        if iteration != None:
+            result['iteration'] = iteration
+        self.collect(self.stats, result)
+        return result
+
+    async def run_async(self):
+        semaphore = asyncio.Semaphore(self.settings['concurrency'])
+        self.stats = ResultStats()
+        async with self.new_session() as http:
+            await self.prewarm(http)
+            start = time.time()
+            tasks = []
+            for x in range(0, len(self.query_set)):
+                tasks.append(self.run_bounded_query(http, semaphore, x + 1, 0, self.target, self.query_set[x]))
+            query_results = await asyncio.gather(*tasks)
+            end = time.time()
+        return list(query_results), end - start
+
+    def run(self):
+        results = {}
+        query_results, elapsed = asyncio.run(self.run_async())
+        results['query_results'] = ResultTable(query_results)
+        results['stats'] = self.stats
+        results['elapsed_s'] = elapsed
+        return results
+
+
+class AsyncOpenLoopExecutor(AsyncQSExecutor):
+    # Issues queries on a precomputed arrival schedule from an event loop. With more than one
+    # process each event loop issues an interleaved share of the schedule.
+
+    fans_out = True
+
+    def __init__(self,target, query_set, templates=None):
+       super().__init__(target, query_set, templates)
+       # As in OpenLoopExecutor, only capacity steps need every result
+       self.keep_results = False
+
+    async def run_scheduled_query(self, http, semaphore, seq, query_num, user_num, target, query, start, offset):
+        async with semaphore:
+            # How late, relative to the schedule, the query was actually sent. This includes any time spent
+            # waiting for the concurrency cap
+            lag = time.time() - (start + offset)
+            try:
+                result = await self.run_query_async(http, query_num, user_num, target, query)
+            except Exception as e:
+                # As in the process based executor, anything else that goes wrong fails the query
+                result = self.new_result(query_num, user_num, query)
+                result['status'] = 'error'
+                result['message'] = describe_error(e)
+        result['lag_ms'] = round(lag * 1000)
+        result['offset_s'] = round(offset, 3)
+        result['seq'] = seq
+        self.collect(self.stats, result)
+        return result if self.keep_results else None
+
+    async def run_schedule_async(self, share, start):
+        semaphore = asyncio.Semaphore(self.settings['concurrency'])
+        query_count = len(self.query_set)
+        dispatch_lag = 0.0
+        self.stats = ResultStats()
+        async with self.new_session() as http:
+            await self.prewarm(http)
+            tasks = []
+            for seq, offset in share:
+                due = start + offset
+                delay = due - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    dispatch_lag = max(dispatch_lag, -delay)
+                query = self.query_set[seq % query_count]
+                tasks.append(asyncio.create_task(
+                    self.run_scheduled_query(http, semaphore, seq, seq % query_count + 1, 0, self.target, query, start, offset)))
+            issue_end = time.time()
+            query_results = await asyncio.gather(*tasks)
+        return [result for result in query_results if result != None], issue_end, dispatch_lag
+
+    def run_share(self, share, start):
+        # Runs in a worker process when the schedule is split across processes
+        self.result_handlers = [forward_result]
+        query_results, issue_end, dispatch_lag = asyncio.run(self.run_schedule_async(share, start))
+        return issue_end, dispatch_lag
+
+    def run(self, schedule):
+        results = {}
+        processes = self.settings['processes']
+        indexed = list(enumerate(schedule))
+
+        # Give the worker processes time to start and open their connections before the first scheduled query
+        start_delay = 0
+        if processes > 1 or get_connection_settings(self.target)['prewarm'] > 0:
+            start_delay = 1
+        start = time.time() + start_delay
+        if processes > 1:
+            query_results = ResultTable()
+            stats = ResultStats()
+
+            def handle(result):
+                if self.keep_results:
+                    query_results.append(result)
+                self.collect(stats, result)
+
+            # Each event loop process streams its results back as they complete
+            collector = ResultCollector(handle)
+            collector.start()
+            with Pool(processes=processes, initializer=init_worker, initargs=self.worker_args(None, collector.queue)) as pool:
+                tasks = []
+                for x in range(0, processes):
+                    tasks.append(pool.apply_async(self.run_share, [indexed[x::processes], start]))
+                pool.close()
+                pool.join()
+                shares = [task.get() for task in tasks]
+            collector.stop()
+        else:
+            share_results, issue_end, dispatch_lag = asyncio.run(self.run_schedule_async(indexed, start))
+            query_results = ResultTable(share_results)
+            stats = self.stats
+            shares = [(issue_end, dispatch_lag)]
+        end = time.time()
+
+        query_results.sort('seq')
+
+        results['query_results'] = query_results
+        results['stats'] = stats
+        results['issue_s'] = max(share[0] for share in shares) - start
+        results['elapsed_s'] = end - start
+        results['max_dispatch_lag_ms'] = round(max(share[1] for share in shares) * 1000)
+        return results
+
+
+class AsyncVirtualUserExecutor(AsyncQSExecutor):
+    # Simulates concurrent users as coroutines on one event loop, so a single process can drive many more
+    # users than the process based VirtualUserExecutor. Users behave the same way in both. With more than
+    # one process each event loop runs an interleaved share of the users.
+
+    fans_out = True
+
+    def __init__(self,target, query_set, user_settings, templates=None):
+       super().__init__(target, query_set, templates)
+       self.user_settings = user_settings
+       self.partitions = user_settings['total']
+
+    async def run_user(self, http, semaphore, user_num, start):
+        rng = random.Random()
+        delay = start + get_start_offset(self.user_settings, user_num) - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        deadline = get_deadline(self.user_settings, start)
+        query_results = []
+        iteration = 1
+        while has_more_iterations(self.user_settings, iteration, deadline, time.time()):
+            for x in range(0, len(self.query_set)):
+                if deadline != None and time.time() >= deadline:
+                    break
+                result = await self.run_bounded_query(http, semaphore, x + 1, user_num, self.target, self.query_set[x], iteration)
+                query_results.append(result)
+            iteration += 1
+            if has_more_iterations(self.user_settings, iteration, deadline, time.time()):
+                await asyncio.sleep(get_think_time(self.user_settings, rng))
+        return query_results
+
+    async def run_users_async(self, user_nums, start=None):
+        semaphore = asyncio.Semaphore(self.settings['concurrency'])
+        self.stats = ResultStats()
+        async with self.new_session() as http:
+            await self.prewarm(http)
+            if start == None:
+                start = time.time()
+            tasks = []
+            for user_num in user_nums:
+                tasks.append(self.run_user(http, semaphore, user_num, start))
+            user_results = await asyncio.gather(*tasks)
+            end = time.time()
+        return user_results, end - start
+
+    def run_share(self, user_nums, start):
+        # Runs in a worker process when the users are split across processes
+        self.result_handlers = [forward_result]
+        asyncio.run(self.run_users_async(user_nums, start))
+
+    def run(self):
+        results = {}
+        processes = self.settings['processes']
+        user_nums = list(get_user_nums(self.user_settings))
+        query_results = ResultTable()
+        if processes > 1:
+            stats = ResultStats()
+
+            def handle(result):
+                query_results.append(result)
+                self.collect(stats, result)
+
+            # Every process starts its users from the same time, once they have all started and opened their
+            # connections. Each event loop process streams its results back as they complete.
+            start = time.time() + 1
+            collector = ResultCollector(handle)
+            collector.start()
+            with Pool(processes=processes, initializer=init_worker, initargs=self.worker_args(None, collector.queue)) as pool:
+                tasks = []
+                for x in range(0, processes):
+                    tasks.append(pool.apply_async(self.run_share, [user_nums[x::processes], start]))
+                pool.close()
+                pool.join()
+                for task in tasks:
+                    task.get()
+            collector.stop()
+            elapsed = time.time() - start
+        else:
+            user_results, elapsed = asyncio.run(self.run_users_async(user_nums))
+            for user_result in user_results:
+                query_results.extend(user_result)
+            stats = self.stats
+        results['query_results'] = query_results
+        results['stats'] = stats
+        results['elapsed_s'] = elapsed
+        return results
@@ -0,0 +1,187 @@
+import argparse, csv, resource, socket, time
+from multiprocessing import Process
+from columnar import columnar
+from mockServer import MockRocksetServer, add_mock_arguments, get_mock_settings
+from executors import SerialQSExecutor, ParallelQSExecutor, OpenLoopExecutor, VirtualUserExecutor
+from asyncExecutors import AsyncQSExecutor, AsyncOpenLoopExecutor, AsyncVirtualUserExecutor
+from schedule import build_schedule
+
+# Measures the overhead of rockset-load itself by running each executor against a local mock server.
+# Client CPU includes the worker processes, which are counted once they exit.
+
+QUERY_SET_MODES = ['serial', 'parallel', 'async']
+OPEN_LOOP_MODES = ['qps', 'qps_async']
+USER_MODES = ['users', 'users_async']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the rockset-load executors against a local mock server.')
+    parser.add_argument('--modes', help='comma separated executor modes to benchmark', default=','.join(QUERY_SET_MODES + OPEN_LOOP_MODES + USER_MODES))
+    parser.add_argument('--port', help='port for the mock server', type=int, default=8089)
+    parser.add_argument('--queries', help='number of queries in the query set', type=int, default=10)
+    parser.add_argument('--rounds', help='number of times the query set is run in query set modes', type=int, default=10)
+    parser.add_argument('--start_qps', help='first rate tried in open-loop modes', type=float, default=50)
+    parser.add_argument('--max_qps', help='highest rate tried in open-loop modes', type=float, default=5000)
+    parser.add_argument('--step_factor', help='rate multiplier between open-loop steps', type=float, default=1.5)
+    parser.add_argument('--step_s', help='duration of each open-loop step in seconds', type=float, default=5)
+    parser.add_argument('--max_lag_ms', help='highest p99 schedule lag that still counts as sustainable', type=float, default=50)
+    parser.add_argument('--workers', help='worker processes for the process based open-loop mode', type=int, default=32)
+    parser.add_argument('--users', help='number of virtual users in user modes', type=int, default=20)
+    parser.add_argument('--concurrency', help='async concurrency cap', type=int, default=1000)
+    parser.add_argument('-o', '--output', help='csv file the results are appended to')
+    add_mock_arguments(parser)
+    return vars(parser.parse_args())
+
+def serve_mock(port, settings):
+    MockRocksetServer('127.0.0.1', port, settings).serve_forever()
+
+def start_mock(port, settings):
+    server = Process(target=serve_mock, args=(port, settings), daemon=True)
+    server.start()
+    # Wait for the server to accept connections
+    for x in range(0, 100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    exit(f'Mock server did not start on port {port}')
+
+def cpu_s():
+    # CPU used by this process and every child process that has exited
+    total = 0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def new_target(options):
+    return {
+        'api_server': f"127.0.0.1:{options['port']}",
+        'protocol': 'http',
+        'api_key': 'mock',
+        'async': {'concurrency': options['concurrency'], 'processes': 1}
+    }
+
+def new_queries(options):
+    return [{'name': f'bench {x + 1}', 'sql': 'SELECT 1'} for x in range(0, options['queries'])]
+
+def measure(run):
+    cpu_start = cpu_s()
+    start = time.time()
+    results = run()
+    elapsed = time.time() - start
+    cpu = cpu_s() - cpu_start
+    stats = results['stats']
+    return {
+        'requests': stats.count(),
+        'errors': stats.count() - stats.successes(),
+        'elapsed_s': round(elapsed, 3),
+        'qps': round(stats.count() / elapsed, 1) if elapsed > 0 else 0,
+        'cpu_ms_per_request': round(cpu * 1000 / stats.count(), 3) if stats.count() > 0 else None,
+        'round_trip_p99_ms': stats.histogram('round_trip_ms').percentile(99),
+        'lag_p99_ms': stats.histogram('lag_ms').percentile(99)
+    }, results
+
+def bench_query_set(mode, options):
+    target = new_target(options)
+    queries = new_queries(options)
+
+    def run():
+        executors = {'serial': SerialQSExecutor, 'parallel': ParallelQSExecutor, 'async': AsyncQSExecutor}
+        combined = None
+        for x in range(0, options['rounds']):
+            results = executors[mode](target, queries).run()
+            if combined == None:
+                combined = results
+            else:
+                combined['stats'].merge(results['stats'])
+        return combined
+
+    measurement, results = measure(run)
+    return measurement
+
+def bench_open_loop(mode, options):
+    # Raise the offered rate until the achieved rate or the schedule lag shows the client can't keep up
+    target = new_target(options)
+    queries = new_queries(options)
+    rate = options['start_qps']
+    best = None
+    while rate <= options['max_qps']:
+        schedule = build_schedule({'rate': rate, 'duration': options['step_s']})
+        if mode == 'qps_async':
+            executor = AsyncOpenLoopExecutor(target, queries)
+        else:
+            executor = OpenLoopExecutor(target, queries, options['workers'])
+        measurement, results = measure(lambda: executor.run(schedule))
+        achieved = results['stats'].count() / results['elapsed_s']
+        lag = measurement['lag_p99_ms']
+        print(f'  {mode}: offered {round(rate, 1)} QPS, achieved {round(achieved, 1)} QPS, p99 lag {lag} ms')
+        if achieved < rate * 0.95 or (lag != None and lag > options['max_lag_ms']):
+            break
+        measurement['qps'] = round(rate, 1)
+        best = measurement
+        rate *= options['step_factor']
+    return best
+
+def bench_users(mode, options):
+    target = new_target(options)
+    queries = new_queries(options)
+    user_settings = {'count': options['users'], 'ramp_up': 0, 'think_time': 0, 'duration': options['step_s'], 'iterations': 1,
+        'offset': 0, 'total': options['users']}
+    if mode == 'users_async':
+        executor = AsyncVirtualUserExecutor(target, queries, user_settings)
+    else:
+        executor = VirtualUserExecutor(target, queries, user_settings)
+    measurement, results = measure(executor.run)
+    return measurement
+
+def run_benchmarks(options):
+    rows = []
+    for mode in options['modes'].split(','):
+        print(f'Benchmarking {mode}')
+        if mode in QUERY_SET_MODES:
+            measurement = bench_query_set(mode, options)
+        elif mode in OPEN_LOOP_MODES:
+            measurement = bench_open_loop(mode, options)
+        elif mode in USER_MODES:
+            measurement = bench_users(mode, options)
+        else:
+            print(f'Unexpected benchmark mode {mode}')
+            continue
+        if measurement == None:
+            print(f'  {mode} could not sustain {options["start_qps"]} QPS')
+            continue
+        measurement['mode'] = mode
+        rows.append(measurement)
+    return rows
+
+def display_benchmarks(rows):
+    headers = ['Mode', 'Requests', 'Errors', 'Elapsed (s)', 'Max QPS', 'CPU (ms/req)', 'p99 (ms)', 'Lag p99 (ms)']
+    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
+    data = []
+    for row in rows:
+        data.append([row['mode'], row['requests'], row['errors'], row['elapsed_s'], row['qps'], row['cpu_ms_per_request'], row['round_trip_p99_ms'], row['lag_p99_ms']])
+    print(columnar(data, headers = headers, justify = justify, no_borders=True, preformatted_headers=True))
+
+def log_benchmarks(options, rows):
+    headers = ['mode', 'requests', 'errors', 'elapsed_s', 'qps', 'cpu_ms_per_request', 'round_trip_p99_ms', 'lag_p99_ms', 'latency_ms', 'rows']
+    with open(options['output'], 'at') as output:
+        writer = csv.writer(output, delimiter = ',')
+        if output.tell() == 0:
+            writer.writerow(headers)
+        for row in rows:
+            writer.writerow([row['mode'], row['requests'], row['errors'], row['elapsed_s'], row['qps'], row['cpu_ms_per_request'],
+                row['round_trip_p99_ms'], row['lag_p99_ms'], options['latency_ms'], options['rows']])
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    server = start_mock(options['port'], get_mock_settings({key: options[key] for key in get_mock_settings()}))
+    try:
+        rows = run_benchmarks(options)
+    finally:
+        server.terminate()
+    display_benchmarks(rows)
+    if options['output'] != None:
+        log_benchmarks(options, rows)
@@ -0,0 +1,118 @@
+from histograms import ResultStats
+
+SEARCHES = ['step', 'binary']
+
+def get_capacity_settings(config):
+    settings = {
+        'p99_slo_ms': None, 'max_exhausted_rate': 0.01, 'max_error_rate': 0.01,
+        'start_qps': 10, 'max_qps': 1000, 'step_factor': 2, 'search': 'binary', 'precision': 0.05,
+        'warmup_s': 5, 'step_s': 30, 'arrival': 'constant', 'workers': 32, 'max_lag_ms': 100
+    }
+    if config['capacity'] != None:
+        settings.update(config['capacity'])
+    if settings['p99_slo_ms'] == None:
+        raise ValueError('A capacity search needs a p99_slo_ms')
+    if settings['search'] not in SEARCHES:
+        raise ValueError(f"Unexpected capacity search {settings['search']}")
+    if settings['step_factor'] <= 1:
+        raise ValueError('The capacity step_factor must be greater than 1')
+    return settings
+
+def get_step_qps_config(settings, rate):
+    # Each step warms up before its steady state window, at the same rate
+    return {'rate': rate, 'duration': settings['warmup_s'] + settings['step_s'], 'arrival': settings['arrival']}
+
+def get_steady_stats(query_results, warmup_s):
+    # Stats for the queries that were scheduled after the warm up
+    stats = ResultStats()
+    for result in query_results:
+        if result['offset_s'] >= warmup_s:
+            stats.record(result)
+    return stats
+
+def evaluate_step(settings, rate, stats):
+    count = stats.count()
+    exhausted = stats.statuses.get('exhausted', 0)
+    failed = count - stats.successes() - exhausted
+    step = {
+        'offered_qps': round(rate, 1),
+        'count': count,
+        'achieved_qps': round(stats.successes() / settings['step_s'], 1),
+        'p99_ms': stats.histogram('round_trip_ms').percentile(99),
+        'exhausted_rate': round(exhausted / count, 4) if count > 0 else 0,
+        'error_rate': round(failed / count, 4) if count > 0 else 0,
+        'lag_p99_ms': stats.histogram('lag_ms').percentile(99)
+    }
+
+    # A step the client couldn't issue on time says nothing about the VI
+    if step['lag_p99_ms'] != None and step['lag_p99_ms'] > settings['max_lag_ms']:
+        step['outcome'] = 'client'
+    elif step['exhausted_rate'] > settings['max_exhausted_rate']:
+        step['outcome'] = 'exhausted'
+    elif step['error_rate'] > settings['max_error_rate']:
+        step['outcome'] = 'errors'
+    elif step['p99_ms'] == None or step['p99_ms'] > settings['p99_slo_ms']:
+        step['outcome'] = 'latency'
+    else:
+        step['outcome'] = 'pass'
+    return step
+
+class CapacitySearch():
+    # Chooses the offered rate of each step. The rate grows by step_factor until a step misses the SLO (the knee);
+    # a binary search then bisects between the highest passing rate and the lowest failing one until they are
+    # within precision of each other.
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.steps = []
+        self.best = None
+        self.failed_rate = None
+        self.stop_reason = None
+
+    def add_step(self, step):
+        self.steps.append(step)
+        rate = step['offered_qps']
+        if step['outcome'] == 'pass':
+            if self.best == None or rate > self.best['offered_qps']:
+                self.best = step
+        elif step['outcome'] == 'client':
+            self.stop_reason = f'the client could not keep up at {rate} QPS'
+        elif self.failed_rate == None or rate < self.failed_rate:
+            self.failed_rate = rate
+
+    def next_rate(self):
+        # Returns the rate of the next step, or None once the search is over
+        settings = self.settings
+        if self.stop_reason != None:
+            return None
+
+        if self.failed_rate == None:
+            if len(self.steps) == 0:
+                return settings['start_qps']
+            last = self.steps[-1]['offered_qps']
+            if last >= settings['max_qps']:
+                self.stop_reason = f"max_qps ({settings['max_qps']}) was sustained"
+                return None
+            return min(last * settings['step_factor'], settings['max_qps'])
+
+        if self.best == None:
+            self.stop_reason = f"start_qps ({settings['start_qps']}) was not sustained"
+            return None
+        if settings['search'] == 'step' or self.failed_rate <= self.best['offered_qps'] * (1 + settings['precision']):
+            self.stop_reason = f"the knee is between {self.best['offered_qps']} and {self.failed_rate} QPS"
+            return None
+        return (self.best['offered_qps'] + self.failed_rate) / 2
+
+    def summary(self):
+        best = self.best
+        return {
+            'p99_slo_ms': self.settings['p99_slo_ms'],
+            'max_exhausted_rate': self.settings['max_exhausted_rate'],
+            'search': self.settings['search'],
+            'max_qps': best['offered_qps'] if best != None else None,
+            'achieved_qps': best['achieved_qps'] if best != None else None,
+            'p99_ms': best['p99_ms'] if best != None else None,
+            'exhausted_rate': best['exhausted_rate'] if best != None else None,
+            'steps': self.steps,
+            'stop_reason': self.stop_reason
+        }
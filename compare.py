@@ -0,0 +1,49 @@
+import argparse, sys
+from history import update_index, list_runs, select_runs, load_latencies, compare_runs
+from display import display_comparison
+
+# Compares the latencies of a candidate run with a baseline run from the history, query by query, and flags
+# the queries that regressed. Exits with 1 when any query regressed, so it can gate a CI job.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare two rockset-load runs from the history.')
+    parser.add_argument('-o', '--output_dir', help='directory the runs were written to', default='./history')
+    parser.add_argument('-t', '--test_name', help='test whose runs are compared (default = the test of the given runs)')
+    parser.add_argument('-b', '--baseline', help='run id of the baseline (default = the run before the candidate)')
+    parser.add_argument('-c', '--candidate', help='run id of the candidate (default = the latest run of the test)')
+    parser.add_argument('--metric', help='latency that is compared', default='round_trip_ms')
+    parser.add_argument('--alpha', help='p value below which a difference is significant', type=float, default=0.01)
+    parser.add_argument('--min_change_pct', help='smallest change of the p50 or p99 that counts as a regression', type=float, default=5)
+    parser.add_argument('--min_count', help='fewest successful queries in each run needed to compare a query', type=int, default=20)
+    parser.add_argument('--list', help='list the runs in the history instead', action='store_true')
+    options = vars(parser.parse_args())
+    options['details_name'] = 'query_details.csv'
+    return options
+
+def display_runs(runs):
+    for run_id, run in runs:
+        print(f"{run['test_start']}  {run_id}  {run['test_name']}  ({run['rows']} queries)")
+
+def get_run(index, run_id):
+    run = dict(index['runs'][run_id])
+    run['run_id'] = run_id
+    return run
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    index = update_index(options)
+    if options['list']:
+        display_runs(list_runs(index, options['test_name']))
+        exit()
+
+    try:
+        baseline, candidate = select_runs(index, options['test_name'], options['baseline'], options['candidate'])
+        comparisons = compare_runs(options,
+            load_latencies(options, index, baseline, options['metric']),
+            load_latencies(options, index, candidate, options['metric']))
+    except ValueError as e:
+        exit(str(e))
+    display_comparison(get_run(index, baseline), get_run(index, candidate), options['metric'], comparisons)
+    if any(comparison['verdict'] == 'regression' for comparison in comparisons.values()):
+        sys.exit(1)
@@ -0,0 +1,147 @@
+import os, socket, time, requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# One keep-alive session per worker process. Pool workers are reused across queries, so the
+# session (and its open connections) outlives each individual query.
+session = None
+session_pid = None
+session_prefix = None
+
+def get_base_url(target):
+    # Targets use https unless the api server was given with an http:// prefix, e.g. for a local mock server
+    protocol = 'https'
+    if 'protocol' in target:
+        protocol = target['protocol']
+    return protocol + '://' + target['api_server']
+
+def new_timings():
+    # Handshake phases are durations in seconds, sent and headers are perf_counter times. Only the request that
+    # opens a connection pays for its DNS lookup, TCP connect and TLS handshake.
+    return {'dns_s': 0.0, 'connect_s': 0.0, 'tls_s': 0.0, 'sent': None, 'headers': None}
+
+class TimedConnection():
+    # Mixed into urllib3's connections to time the phases of each request sent on them
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = new_timings()
+        self.request_timings = None
+
+    def _new_conn(self):
+        # The name is resolved here, so that urllib3 only has to connect to an address
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+        except OSError:
+            # Let urllib3 raise its usual error
+            return super()._new_conn()
+        resolved = time.perf_counter()
+        self.timings['dns_s'] = resolved - start
+        try:
+            for x in range(0, len(addresses)):
+                # host is derived from _dns_host, so it is put back before the TLS handshake and Host header use it
+                self._dns_host = addresses[x][4][0]
+                try:
+                    sock = super()._new_conn()
+                    break
+                except Exception:
+                    if x == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+        self.timings['connect_s'] = time.perf_counter() - resolved
+        return sock
+
+    def getresponse(self, *args, **kwargs):
+        # urllib3 waits for the response once the whole request has been written
+        self.timings['sent'] = time.perf_counter()
+        response = super().getresponse(*args, **kwargs)
+        self.timings['headers'] = time.perf_counter()
+        self.request_timings = self.timings
+        self.timings = new_timings()
+        return response
+
+class TimedHTTPConnection(TimedConnection, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnection, HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        # Whatever connect spends after opening the socket is the TLS handshake
+        self.timings['tls_s'] = max(0.0, time.perf_counter() - start - self.timings['dns_s'] - self.timings['connect_s'])
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+def take_timings(response):
+    # The phase timings of the request that got the response. The response only holds on to its connection
+    # until its body has been read, so this has to be called first.
+    connection = response.raw.connection
+    if connection == None:
+        return None
+    return getattr(connection, 'request_timings', None)
+
+def get_connection_settings(target):
+    settings = {'keep_alive': True, 'pool_size': 10, 'prewarm': 0}
+    if 'connections' in target and target['connections'] != None:
+        settings.update(target['connections'])
+    return settings
+
+def prewarm_session(target, count):
+    # Open connections concurrently so that each request gets its own connection
+    def warm(_):
+        try:
+            session.get(
+                get_base_url(target) + '/v1/orgs/self/virtualinstances',
+                headers={'Authorization': 'ApiKey ' + target['api_key']})
+        except requests.RequestException as e:
+            print(f'Warning: unable to prewarm connection. {e}')
+
+    with ThreadPoolExecutor(max_workers=count) as warmers:
+        list(warmers.map(warm, range(0, count)))
+
+def init_session(target):
+    global session, session_pid, session_prefix
+    settings = get_connection_settings(target)
+
+    session = requests.Session()
+    adapter = TimedAdapter(pool_connections=1, pool_maxsize=settings['pool_size'])
+    session_prefix = get_base_url(target)
+    session.mount(session_prefix, adapter)
+    session_pid = os.getpid()
+
+    if not settings['keep_alive']:
+        # Ask the server to close the connection after every response, so each query pays for its own handshake
+        session.headers['Connection'] = 'close'
+    elif settings['prewarm'] > 0:
+        prewarm_session(target, min(settings['prewarm'], settings['pool_size']))
+
+def get_session(target):
+    # Sessions are not shared across processes, so create a new one after a fork
+    if session == None or session_pid != os.getpid():
+        init_session(target)
+    return session
+
+def count_connections(sess):
+    # Number of connections the session has opened since it was created
+    opened = 0
+    adapter = sess.adapters[session_prefix]
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool != None:
+            opened += pool.num_connections
+    return opened
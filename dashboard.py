@@ -0,0 +1,97 @@
+import threading, time
+from histograms import LatencyHistogram
+from display import display_live_stats
+
+class LiveStats():
+    # Keeps per second counters and latency histograms for the last window_s seconds. Recording a result and
+    # taking a snapshot both cost the same no matter how long the test has been running.
+
+    def __init__(self, window_s=10):
+        self.window_s = window_s
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.total = 0
+        self.first_second = int(time.time())
+
+    def new_bucket(self, second):
+        # Drop the buckets that have slid out of the window
+        for old in [old for old in self.buckets if old <= second - self.window_s - 1]:
+            del self.buckets[old]
+        bucket = {'statuses': {}, 'round_trip_ms': LatencyHistogram()}
+        self.buckets[second] = bucket
+        return bucket
+
+    def record(self, result):
+        second = int(time.time())
+        with self.lock:
+            bucket = self.buckets.get(second)
+            if bucket == None:
+                bucket = self.new_bucket(second)
+            status = result['status']
+            bucket['statuses'][status] = bucket['statuses'].get(status, 0) + 1
+            if status == 'success':
+                bucket['round_trip_ms'].record(result['round_trip_ms'])
+            self.total += 1
+
+    def snapshot(self, now=None):
+        # Covers the last window_s whole seconds, leaving out the second that is still being filled
+        if now == None:
+            now = time.time()
+        current = int(now)
+        statuses = {}
+        latency = LatencyHistogram()
+        with self.lock:
+            for second, bucket in self.buckets.items():
+                if current - self.window_s <= second < current:
+                    for status, count in bucket['statuses'].items():
+                        statuses[status] = statuses.get(status, 0) + count
+                    latency.merge(bucket['round_trip_ms'])
+            total = self.total
+
+        count = sum(statuses.values())
+        # Until the test has run for a whole window, rates are over the seconds it has run for
+        covered_s = max(1, min(self.window_s, current - self.first_second))
+        return {
+            'window_s': self.window_s,
+            'total': total,
+            'qps': round(count / covered_s, 1),
+            'p50_ms': latency.percentile(50),
+            'p99_ms': latency.percentile(99),
+            'exhausted_per_s': round(statuses.get('exhausted', 0) / covered_s, 1),
+            'timeout_per_s': round(statuses.get('timeout', 0) / covered_s, 1),
+            'error_per_s': round(statuses.get('error', 0) / covered_s, 1),
+            'failed_pct': round(100 * (count - statuses.get('success', 0)) / count, 1) if count > 0 else 0
+        }
+
+class LiveDashboard():
+    # Refreshes a one line view of the test from a background thread while it runs
+
+    def __init__(self, interval_s=1, window_s=10):
+        self.interval_s = interval_s
+        self.stats = LiveStats(window_s)
+        self.executors = []
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.refresh, daemon=True)
+
+    def watch(self, executor):
+        # The executor's in flight counter is read on every refresh
+        self.executors.append(executor)
+
+    def in_flight(self):
+        return sum(executor.in_flight.value for executor in self.executors)
+
+    def refresh(self):
+        start = time.time()
+        while not self.stopping.wait(self.interval_s):
+            snapshot = self.stats.snapshot()
+            snapshot['elapsed_s'] = round(time.time() - start)
+            snapshot['in_flight'] = self.in_flight()
+            display_live_stats(snapshot)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        display_live_stats(None)
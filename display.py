@@ -1,22 +1,28 @@
 from columnar import columnar
 from click import style
+from histograms import ALL_QUERIES, PERCENTILES
 
 def display_qs_results(config, results):
 
     # Display the individual query results
-    headers = ['Test','Q Set Name', 'Q Set #', 'Status', 'Total (ms)', 'Query (ms)', 'Queued (ms)', 'Network (ms)', 'Rows', 'Error']
+    headers = ['Test','Q Set Name', 'Q Set #', 'User', 'Iter', 'Status', 'Total (ms)', 'Query (ms)', 'Queued (ms)', 'Network (ms)', 'Rows', 'Error']
     patterns = [
       ('error', lambda text: style(text, fg='red')),
       ('success', lambda text: style(text, fg='green')),
       ('timeout', lambda text: style(text, fg='yellow')),
     ]
-    justify = ['l', 'l', 'c', 'r', 'r', 'r', 'r', 'r', 'l']
+    justify = ['l', 'l', 'c', 'c', 'c', 'r', 'r', 'r', 'r', 'r', 'l']
     data = []
     for result in results['query_results']:
         line = []
         line.append(config['test_name'])
         line.append(result['name'])
         line.append(result['query_num'])
+        line.append(result['user_num'])
+        if 'iteration' in result:
+            line.append(result['iteration'])
+        else:
+            line.append('')
         line.append(result['status'])
         if result['status'] == 'success':
             line.append(result['round_trip_ms'])
@@ -43,8 +49,8 @@ def display_qs_results(config, results):
 
 def display_qs_summary(config, summary):
     # Display the test parameters
-    headers = ['Test', 'Started', 'Clean', 'Total (ms)', 'Query (ms)', 'Queued (ms)', 'Network (ms)', 'VI', 'Agg Par', 'CQEL', 'CQL']
-    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
+    headers = ['Test', 'Started', 'Clean', 'Total (ms)', 'Query (ms)', 'Queued (ms)', 'Network (ms)', 'New Conn', 'Reused Conn', 'VI', 'Agg Par', 'CQEL', 'CQL']
+    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
     patterns = [
       ('False', lambda text: style(text, fg='red')),
       ('True', lambda text: style(text, fg='green'))
@@ -57,6 +63,8 @@ def display_qs_summary(config, summary):
         summary['query_ms'],
         summary['queued_ms'],
         summary['network_ms'],
+        summary['new_connections'],
+        summary['reused_connections'],
         config['target']['vi_size'], 
         config['target']['aggregator_parallelism'], 
         config['target']['concurrent_query_execution_limit'],
@@ -65,6 +73,16 @@ def display_qs_summary(config, summary):
     table = columnar(data, headers = headers, patterns = patterns, justify = justify, no_borders=True, preformatted_headers=True)
     print(table)    
 
+    display_latency_summary(config, summary)
+
+    if len(summary['query_sets']) > 0:
+        display_query_set_summaries(summary['query_sets'])
+
+    if summary['retries'] > 0 or summary['admission_ms'] > 0:
+        retried = ', '.join(f'{status} {count}' for status, count in summary['retried_statuses'].items())
+        print(f"--- RETRIES --- {summary['retries']} retries ({retried}) in {summary['attempts']} attempts, "
+            f"{summary['backoff_ms']} ms backing off, {summary['admission_ms']} ms held by admission control")
+
     if len(summary['warnings']) > 0:
         headers = ['Query #', 'Name', 'Status']
         data =[]
@@ -77,4 +95,136 @@ def display_qs_summary(config, summary):
         print("--- WARNINGS ---")
         table = columnar(data, headers = headers, no_borders=True, preformatted_headers=True)
         print(table)   
+        if summary['warning_count'] > len(summary['warnings']):
+            print(f"... and {summary['warning_count'] - len(summary['warnings'])} more warnings")
+
+def display_latency_summary(config, summary):
+    # Display latency percentiles for all queries together, followed by each query name
+    print(f"--- LATENCY --- {summary['successes']} of {summary['count']} queries succeeded in {summary['elapsed_s']} s ({summary['throughput_qps']} QPS)")
+    print(f"Downloaded {round(summary['download_bytes'] / 1048576, 2)} MB, {summary['decode_ms']} ms spent decoding responses")
+    headers = ['Query', 'Metric', 'Count', 'Mean (ms)', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'p99.9 (ms)', 'Max (ms)']
+    justify = ['l', 'l', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
+    data = []
+    latency = summary['latency']
+    names = sorted(latency, key=lambda name: (name != ALL_QUERIES, name))
+    for name in names:
+        for metric, metric_summary in latency[name].items():
+            line = []
+            line.append('All' if name == ALL_QUERIES else name)
+            line.append(metric)
+            line.append(metric_summary['count'])
+            line.append(metric_summary['mean'])
+            for pct in PERCENTILES:
+                line.append(metric_summary[f'p{pct}'])
+            line.append(metric_summary['max'])
+            data.append(line)
+    if len(data) > 0:
+        table = columnar(data, headers = headers, justify = justify, no_borders=True, preformatted_headers=True)
+        print(table)
 
+
+def display_query_set_summaries(query_sets):
+    # How the load was split between the query sets of a mix
+    print("--- QUERY SETS ---")
+    headers = ['Query Set', 'Count', 'Succeeded', 'Share', 'QPS', 'p50 (ms)', 'p99 (ms)', 'Max (ms)']
+    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
+    data = []
+    for query_set in query_sets:
+        round_trip = query_set['round_trip']
+        data.append([query_set['name'], query_set['count'], query_set['successes'], query_set['share'], query_set['throughput_qps'],
+            round_trip['p50'], round_trip['p99'], round_trip['max']])
+    table = columnar(data, headers = headers, justify = justify, no_borders=True, preformatted_headers=True)
+    print(table)
+
+def display_qps_summary(config, summary):
+    # Display offered vs achieved load for an open-loop test
+    headers = ['Test', 'Planned (s)', 'Elapsed (s)', 'Scheduled', 'Completed', 'Succeeded', 'Offered QPS', 'Issued QPS', 'Achieved QPS', 'Lag p50 (ms)', 'Lag p99 (ms)', 'Lag max (ms)']
+    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
+    data = [[
+        config['test_name'],
+        summary['planned_s'],
+        summary['elapsed_s'],
+        summary['scheduled'],
+        summary['completed'],
+        summary['successes'],
+        summary['offered_qps'],
+        summary['issued_qps'],
+        summary['achieved_qps'],
+        summary['lag_p50_ms'],
+        summary['lag_p99_ms'],
+        summary['lag_max_ms']
+        ]]
+    table = columnar(data, headers = headers, justify = justify, no_borders=True, preformatted_headers=True)
+    print(table)
+
+    # Queries dispatched well behind schedule mean the client could not keep up with the offered load
+    if summary['max_dispatch_lag_ms'] > 100:
+        print(style(f"Warning: the scheduler fell up to {summary['max_dispatch_lag_ms']} ms behind the arrival schedule. The client may be the bottleneck", fg='yellow'))
+
+def display_capacity_step(step):
+    # One line per capacity search step as it completes
+    line = (f"{step['offered_qps']} QPS offered, {step['achieved_qps']} achieved  p99 {step['p99_ms']} ms  "
+        f"429 rate {step['exhausted_rate']}  error rate {step['error_rate']}  lag p99 {step['lag_p99_ms']} ms")
+    if step['outcome'] == 'pass':
+        print(line + '  ' + style('pass', fg='green'))
+    else:
+        print(line + '  ' + style(f"fail ({step['outcome']})", fg='red'))
+
+def display_capacity_summary(config, summary):
+    target = config['target']
+    print(f"--- CAPACITY --- {config['test_name']}: search stopped because {summary['stop_reason']}")
+    headers = ['VI', 'Agg Par', 'CQEL', 'CEL', 'p99 SLO (ms)', 'Max 429 Rate', 'Max QPS', 'Achieved QPS', 'p99 (ms)', '429 Rate', 'Steps']
+    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r']
+    data = [[
+        target['vi_size'],
+        target['aggregator_parallelism'],
+        target['concurrent_query_execution_limit'],
+        target['concurrent_queries_limit'],
+        summary['p99_slo_ms'],
+        summary['max_exhausted_rate'],
+        summary['max_qps'],
+        summary['achieved_qps'],
+        summary['p99_ms'],
+        summary['exhausted_rate'],
+        len(summary['steps'])
+        ]]
+    table = columnar(data, headers = headers, justify = justify, no_borders=True, preformatted_headers=True)
+    print(table)
+
+def display_writer_summary(options, summary):
+    # Report how well the background details writer kept up with the test
+    print(f"--- DETAILS --- {summary['written']} results written to {options['details_name']} in {summary['batches']} batches ({summary['write_s']} s writing, max queue depth {summary['max_depth']})")
+    if summary['dropped'] > 0:
+        print(style(f"Warning: {summary['dropped']} results were not written because the details writer could not keep up. Increase --queue_size", fg='yellow'))
+
+def display_live_stats(snapshot):
+    # Rewrites a single status line while the test runs. None finishes the line once the test is over.
+    if snapshot == None:
+        print()
+        return
+    line = (f"[{snapshot['elapsed_s']}s] {snapshot['qps']} QPS  in flight {snapshot['in_flight']}  "
+        f"p50 {snapshot['p50_ms']} ms  p99 {snapshot['p99_ms']} ms  "
+        f"429/s {snapshot['exhausted_per_s']}  408/s {snapshot['timeout_per_s']}  err/s {snapshot['error_per_s']}  "
+        f"total {snapshot['total']}")
+    if snapshot['failed_pct'] > 0:
+        line += style(f"  failed {snapshot['failed_pct']}%", fg='red')
+    print('\r\x1b[K' + line, end='', flush=True)
+
+def display_comparison(baseline, candidate, metric, comparisons):
+    print(f"--- COMPARE --- {metric} of {candidate['test_name']} run {candidate['run_id']} ({candidate['test_start']}) against run {baseline['run_id']} ({baseline['test_start']})")
+    headers = ['Query', 'Base Count', 'Count', 'Base p50', 'p50', 'p50 Change %', 'Base p99', 'p99', 'p99 Change %', 'P(slower)', 'p value', 'Verdict']
+    patterns = [
+      ('regression', lambda text: style(text, fg='red')),
+      ('improvement', lambda text: style(text, fg='green')),
+    ]
+    justify = ['l', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'r', 'l']
+    data = []
+    for name, comparison in comparisons.items():
+        line = [name, comparison['baseline_count'], comparison['candidate_count']]
+        for key in ['baseline_p50', 'candidate_p50', 'p50_change_pct', 'baseline_p99', 'candidate_p99', 'p99_change_pct', 'p_slower']:
+            line.append(comparison[key] if key in comparison else '')
+        line.append(f"{comparison['p_value']:.2g}" if 'p_value' in comparison else '')
+        line.append(comparison['verdict'])
+        data.append(line)
+    table = columnar(data, headers = headers, justify = justify, patterns = patterns, no_borders=True, preformatted_headers=True)
+    print(table)
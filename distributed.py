@@ -0,0 +1,315 @@
+import copy, json, multiprocessing, queue, socket, struct, threading, time
+from histograms import ResultStats, stats_from_dict
+from results import ResultTable, result_from_row
+from mixes import combine_results, get_query_sets, get_set_user_settings
+from users import get_user_settings
+from testModes import new_test_mode
+
+# A distributed test is run by one coordinator and any number of workers, on one machine or many. The
+# coordinator sends every worker the test with its share of the load, starts them all at the same moment and
+# merges the results and stats they stream back into a single summary and details log. Workers never get the
+# API key from the coordinator, each one reads its own.
+#
+# Messages are JSON objects, each sent after its length as a 4 byte big endian integer:
+#   worker -> coordinator: hello, ready, results (every stream_interval seconds), done or error
+#   coordinator -> worker: test, start
+
+HEADER = struct.Struct('!I')
+
+# Values taken from the results of each worker's test, for the combined summary
+RESULT_KEYS = ['elapsed_s', 'issue_s', 'max_dispatch_lag_ms', 'scheduled', 'planned_s']
+
+def parse_address(address):
+    # host:port, where the host can be left out to listen on every interface
+    host, separator, port = address.rpartition(':')
+    if separator == '':
+        raise ValueError(f'Expected host:port but got {address}')
+    return host, int(port)
+
+def send_message(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('The connection was closed')
+        data += chunk
+    return bytes(data)
+
+def receive_message(sock, expected=None):
+    size, = HEADER.unpack(receive_exactly(sock, HEADER.size))
+    message = json.loads(receive_exactly(sock, size))
+    if expected != None and message['type'] != expected:
+        if message['type'] == 'error':
+            raise RuntimeError(message['message'])
+        raise ValueError(f"Expected a {expected} message but got {message['type']}")
+    return message
+
+def split_count(count, worker_num, worker_count):
+    # The share of count, e.g. of the users, that worker_num (from 0) gets
+    return count // worker_count + (1 if worker_num < count % worker_count else 0)
+
+def share_users(users, worker_num, worker_count):
+    count = split_count(users, worker_num, worker_count)
+    if count < 1:
+        raise ValueError(f'{users} users can not be split between {worker_count} workers')
+    return count
+
+def get_user_offset(users, worker_num, worker_count):
+    # The number of users the workers before worker_num get
+    return sum(split_count(users, x, worker_count) for x in range(0, worker_num))
+
+def get_worker_config(config, worker_num, worker_count):
+    # A copy of the config with the worker's share of the load. Open loop rates, trace records and virtual users
+    # are divided between the workers; iterations without users are run in full by every worker.
+    if 'capacity' in config:
+        raise ValueError('Capacity searches can not be distributed')
+    worker_config = copy.deepcopy({key: value for key, value in config.items() if key != 'stats'})
+    worker_config['target'].pop('api_key', None)
+
+    if 'qps' in worker_config:
+        qps_config = worker_config['qps']
+        if 'stages' in qps_config and qps_config['stages']:
+            for stage in qps_config['stages']:
+                stage['rate'] = stage['rate'] / worker_count
+        elif 'rate' in qps_config:
+            qps_config['rate'] = qps_config['rate'] / worker_count
+        # Together the workers' constant schedules make up the schedule of the whole rate
+        qps_config['phase'] = worker_num / worker_count
+        if 'seed' in qps_config:
+            qps_config['seed'] = qps_config['seed'] + worker_num
+
+    if 'replay' in worker_config:
+        # Every worker reads the whole trace, from its own copy, and sends its share of the records
+        replay = dict(worker_config['replay'] or {})
+        replay['partition'] = [worker_num, worker_count]
+        worker_config['replay'] = replay
+
+    # Each worker is told which of the users are its own, so that users are numbered, and partitioned feeders
+    # split their files, across the whole test
+    has_users = 'users' in worker_config and worker_config['users'] != None
+    if has_users:
+        users = worker_config['users']
+        total = users['count'] if 'count' in users else 1
+        users['count'] = share_users(total, worker_num, worker_count)
+        users['offset'] = get_user_offset(total, worker_num, worker_count)
+        users['total'] = total
+
+    if 'query_sets' in worker_config and worker_config['query_sets']:
+        query_sets = get_query_sets(config)
+        for x in range(0, len(query_sets)):
+            query_set = worker_config['query_sets'][x]
+            if 'rate' in query_set:
+                query_set['rate'] = query_set['rate'] / worker_count
+            if has_users:
+                # The query set's users for the whole test, whether its own or its share by weight
+                total = get_set_user_settings(get_user_settings(config), query_sets, query_sets[x])['count']
+                query_set['users'] = share_users(total, worker_num, worker_count)
+                query_set['user_offset'] = get_user_offset(total, worker_num, worker_count)
+                query_set['total_users'] = total
+    return worker_config
+
+class ResultStreamer():
+    # Sends a worker's results, with the stats of those results, to the coordinator every interval_s seconds
+
+    def __init__(self, sock, interval_s):
+        self.sock = sock
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        self.results = []
+        self.stats = ResultStats()
+        self.thread = threading.Thread(target=self.stream, daemon=True)
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, result):
+        with self.lock:
+            self.results.append(result)
+            self.stats.record(result)
+
+    def send(self):
+        with self.lock:
+            results, stats = self.results, self.stats
+            self.results, self.stats = [], ResultStats()
+        if len(results) > 0:
+            send_message(self.sock, {'type': 'results', 'results': [result.to_row() for result in results], 'stats': stats.to_dict()})
+
+    def stream(self):
+        while not self.stopping.wait(self.interval_s):
+            self.send()
+
+    def stop(self):
+        # Sends whatever hasn't been sent yet
+        self.stopping.set()
+        self.thread.join()
+        self.send()
+
+def connect(address, timeout_s=60):
+    # Workers can be started before the coordinator, so keep trying for a while
+    deadline = time.time() + timeout_s
+    while True:
+        try:
+            return socket.create_connection(parse_address(address))
+        except OSError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(1)
+
+def run_worker(address, api_key, verbose=False):
+    with connect(address) as sock:
+        send_message(sock, {'type': 'hello', 'host': socket.gethostname()})
+        test = receive_message(sock, 'test')
+        config = test['config']
+        config['target']['api_key'] = api_key
+        # The coordinator does all of the output
+        mode = new_test_mode(config, {'verbose': False, 'log_output': False, 'live': False, 'columnar': False})
+        streamer = ResultStreamer(sock, test['stream_interval'])
+        mode.result_handlers.append(streamer.add)
+        send_message(sock, {'type': 'ready'})
+
+        receive_message(sock, 'start')
+        if verbose:
+            print(f"Worker {test['worker_num'] + 1} of {test['worker_count']} started")
+        streamer.start()
+        try:
+            results = mode.run_test()
+        except Exception as e:
+            streamer.stop()
+            send_message(sock, {'type': 'error', 'message': f'{type(e).__name__}. {e}'})
+            raise
+        streamer.stop()
+
+        # None when the worker had nothing to run, e.g. an empty schedule
+        summary = None
+        if results != None:
+            summary = {key: results[key] for key in RESULT_KEYS if key in results}
+        send_message(sock, {'type': 'done', 'results': summary})
+        if verbose:
+            print(f"Worker {test['worker_num'] + 1} of {test['worker_count']} finished")
+
+class Coordinator():
+    # Runs a test on workers and reports it with the test mode's output, as if it had run here
+
+    def __init__(self, options, test):
+        self.options = options
+        self.test = test
+        self.verbose = options['verbose']
+        self.workers = []
+        # Messages from every worker, as (worker_num, message), handled on the coordinator's main thread
+        self.messages = queue.Queue()
+
+    def start_local_workers(self, count):
+        # Local workers are ordinary processes rather than daemons, because they start pools of their own
+        host, port = parse_address(self.options['coordinator'])
+        address = f"{host if host not in ['', '0.0.0.0'] else 'localhost'}:{port}"
+        processes = []
+        for x in range(0, count):
+            process = multiprocessing.Process(target=run_worker, args=(address, self.test.config['target']['api_key']))
+            process.start()
+            processes.append(process)
+        return processes
+
+    def accept_workers(self, listener, count):
+        while len(self.workers) < count:
+            sock, address = listener.accept()
+            hello = receive_message(sock, 'hello')
+            self.workers.append(sock)
+            if self.verbose:
+                print(f"Worker {len(self.workers)} of {count} connected from {address[0]} ({hello['host']})")
+
+    def start_workers(self):
+        # Every worker gets its test before any of them starts, so they all start at the same moment
+        count = len(self.workers)
+        for worker_num in range(0, count):
+            send_message(self.workers[worker_num], {
+                'type': 'test',
+                'config': get_worker_config(self.test.config, worker_num, count),
+                'worker_num': worker_num,
+                'worker_count': count,
+                'stream_interval': self.options['stream_interval']
+            })
+        for sock in self.workers:
+            receive_message(sock, 'ready')
+        for worker_num in range(0, count):
+            threading.Thread(target=self.listen, args=(worker_num,), daemon=True).start()
+        for sock in self.workers:
+            send_message(sock, {'type': 'start'})
+
+    def listen(self, worker_num):
+        try:
+            while True:
+                message = receive_message(self.workers[worker_num])
+                self.messages.put((worker_num, message))
+                if message['type'] in ['done', 'error']:
+                    return
+        except (OSError, ValueError) as e:
+            self.messages.put((worker_num, {'type': 'error', 'message': f'Lost the connection. {e}'}))
+
+    def collect(self):
+        # Hands every result to the test's output as it arrives and merges the stats of each worker
+        parts = [{'query_results': ResultTable(), 'stats': ResultStats()} for sock in self.workers]
+        finished = 0
+        errors = []
+        while finished < len(self.workers):
+            worker_num, message = self.messages.get()
+            part = parts[worker_num]
+            if message['type'] == 'results':
+                for row in message['results']:
+                    result = result_from_row(row)
+                    result['worker'] = worker_num + 1
+                    part['query_results'].append(result)
+                    for handler in self.test.result_handlers:
+                        handler(result)
+                part['stats'].merge(stats_from_dict(message['stats']))
+            elif message['type'] == 'done':
+                if message['results'] == None:
+                    parts[worker_num] = None
+                else:
+                    part.update(message['results'])
+                finished += 1
+            elif message['type'] == 'error':
+                errors.append(f"Worker {worker_num + 1} failed. {message['message']}")
+                finished += 1
+        if len(errors) > 0:
+            raise RuntimeError(' '.join(errors))
+        return self.combine(parts)
+
+    def combine(self, parts):
+        parts = [part for part in parts if part != None]
+        if len(parts) == 0:
+            return None
+        results = combine_results(parts)
+        # The workers each ran a share of the schedule, at the same time
+        if 'scheduled' in parts[0]:
+            results['scheduled'] = sum(part['scheduled'] for part in parts)
+            results['planned_s'] = max(part['planned_s'] for part in parts)
+        return results
+
+    def run(self):
+        count = self.options['workers'] or self.options['local_workers']
+        if count < 1:
+            raise ValueError('A coordinator needs at least one worker')
+        with socket.create_server(parse_address(self.options['coordinator'])) as listener:
+            processes = self.start_local_workers(self.options['local_workers'])
+            if self.verbose:
+                print(f"Waiting for {count} workers on {self.options['coordinator']}")
+            self.accept_workers(listener, count)
+
+        try:
+            self.start_workers()
+            self.test.start_output()
+            try:
+                results = self.collect()
+            finally:
+                self.test.stop_output()
+        finally:
+            for sock in self.workers:
+                sock.close()
+            for process in processes:
+                process.join()
+        self.test.report(results)
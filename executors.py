@@ -1,160 +1,637 @@
-import time, requests
-from urllib.parse import quote_from_bytes
+import time, random, threading
+from functools import partial
+import multiprocessing
+from requests import RequestException
 from multiprocessing.pool import Pool
+from concurrent.futures import ThreadPoolExecutor
+from connections import init_session, get_session, count_connections, take_timings
+from users import get_start_offset, get_think_time, get_deadline, has_more_iterations, get_user_nums
+from histograms import ResultStats
+from results import QueryResult, ResultTable
+from responses import get_response_mode, summarize_response, read_body
+from pagination import get_page_settings, get_page_url, get_page_offsets, read_page
+from feeders import get_query_feeders, new_feed_positions
+from templates import compile_template, compile_templates
+from retries import RETRY_STATUSES, get_retry_settings, get_admission_settings, get_retry_after_s, get_retry_wait_s, update_admission_delay
+
+# Size of the chunks response bodies are read in
+CHUNK_BYTES = 65536
+
+# Set in pool workers that stream each result back to the parent process as soon as it completes
+result_queue = None
+# Set in pool workers to the executor's count of queries in flight, which is shared with the parent process
+in_flight = None
+# Set in pool workers to the executor's admission control delay, also shared with the parent process
+admission_delay = None
+# Set in pool workers to the positions of the executor's parameter feeders, also shared with the parent process
+feed_positions = None
+# Set in open loop pool workers to the executor, with its compiled queries, so that each task only carries the
+# query's number and offset, and to the time its schedule started, which the parent process sets
+worker_executor = None
+schedule_start = None
+
+def init_worker(target=None, queue=None, counter=None, delay=None, positions=None, executor=None, started=None):
+    global result_queue, in_flight, admission_delay, feed_positions, worker_executor, schedule_start
+    result_queue = queue
+    in_flight = counter
+    admission_delay = delay
+    feed_positions = positions
+    worker_executor = executor
+    schedule_start = started
+    if target != None:
+        init_session(target)
+
+def forward_result(result):
+    result_queue.put(result)
+
+def run_scheduled(query_num, offset, query=None):
+    return worker_executor.run_scheduled_query(query_num, offset, query)
+
+class ResultCollector():
+    # Receives the results streamed by worker processes and hands them to a handler in the parent process
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.queue = multiprocessing.Queue()
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+
+    def collect(self):
+        while True:
+            result = self.queue.get()
+            if result == None:
+                break
+            self.handler(result)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # Only call once the workers have exited, so that everything they sent is ahead of the sentinel
+        self.queue.put(None)
+        self.thread.join()
 
 class QuerySetExecutor():
-    def __init__(self,target, query_set):
+    def __init__(self,target, query_set, templates=None):
         self.target = target
         self.query_set = query_set
+        self.iteration = None
+        # Name of the query set in a mix of query sets, which every result is tagged with
+        self.query_set_name = None
+        self.response_mode = get_response_mode(target)
+        # Called in the parent process with each result as it arrives
+        self.result_handlers = []
+        # Number of queries sent and not yet answered, across all of the executor's processes
+        self.in_flight = multiprocessing.Value('i', 0)
+        self.retry_settings = get_retry_settings(target)
+        self.admission_settings = get_admission_settings(target)
+        # Milliseconds each new query waits before it is sent, set by admission control
+        self.admission_delay = multiprocessing.Value('d', 0.0)
+        self.feeders = get_query_feeders(query_set)
+        self.feed_positions = new_feed_positions(self.feeders)
+        # Each query is compiled into a ready to send request. Test modes compile a query set once and hand
+        # the templates to every executor that runs it.
+        self.templates = templates if templates != None else compile_templates(target, query_set, self.feeders)
+        # Number of slices partitioned feeders split their files into, one for each virtual user
+        self.partitions = 1
+        # Worker processes of executors that are run more than once, kept until the executor is closed
+        self.pool = None
 
-    def run_query(self, query_num, user_num, target, query):
+    def __getstate__(self):
+        # Result handlers stay in the parent process, they are not sent to pool workers. Workers are given
+        # the in flight counter and admission delay when they start instead.
+        state = self.__dict__.copy()
+        state['result_handlers'] = []
+        state['in_flight'] = None
+        state['admission_delay'] = None
+        state['feed_positions'] = None
+        state['pool'] = None
+        return state
 
-        drop_results = False
-        if 'overrides' in target:
-            overrides = target['overrides']
-            if overrides != None:
-                if 'drop_results' in overrides:
-                    drop_results = True
+    def worker_args(self, target, queue=None):
+        # Arguments for init_worker in the executor's pool workers
+        return (target, queue, self.in_flight, self.admission_delay, self.feed_positions)
 
-        result = {}
-        result['query_num'] = query_num
-        if 'name' in query:
-            result['name'] = query['name']
-        else:
-            result['name'] = 'unnamed'
+    def get_pool(self, processes):
+        # The pool is created by the first run and reused by every run after it, so each worker opens and
+        # prewarms its session once and its connections stay open from one iteration to the next
+        if self.pool == None:
+            self.pool = Pool(processes=processes, initializer=init_worker, initargs=self.worker_args(self.target))
+        return self.pool
 
-        # Run the query
-        payload = {}
-        
-        if 'lambda' in query:
+    def close(self):
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
-            qlURL = query['lambda']
-            if qlURL[0] != '/':
-                qlURL = '/' + qlURL
+    def get_in_flight(self):
+        if in_flight != None:
+            return in_flight
+        return self.in_flight
 
-            if 'parameters' in query:
-                payload['parameters'] = query['parameters']
+    def get_admission_delay(self):
+        if admission_delay != None:
+            return admission_delay
+        return self.admission_delay
 
-            if drop_results:
-                print('Warning: drop results is not currently supported when using query lambdas')
+    def get_feed_positions(self):
+        if feed_positions != None:
+            return feed_positions
+        return self.feed_positions
 
-            start = time.perf_counter()
-            qryResopnse = requests.post(
-                'https://' + target['api_server'] + qlURL,
-                json=payload,
-                headers={'Authorization': 'ApiKey ' + target['api_key'] ,'Content-Type': 'application/json' })
-            end = time.perf_counter()
-        elif 'sql' in query:
-            sql = {}
-            sql['query'] = query['sql']
-            if ('drop_results' in query and query['drop_results']) or drop_results:
-                baseQuery = sql['query'].rstrip()
-                if baseQuery[-1] == ';':
-                    baseQuery = baseQuery[:-1]
-                sql['query'] = baseQuery + ' HINT(final_aggregator_drop_results=true)'
-            if 'parameters' in query:
-                sql['parameters'] = query['parameters']
-            if 'paginate' in query:
-                sql['paginate'] = query['paginate']
-            if 'initial_paginate_response_doc_count' in query:       
-                sql['initial_paginate_response_doc_count'] = query['initial_paginate_response_doc_count']
-
-            payload['sql'] = sql
+    def get_template(self, query_num, query):
+        # None if the query definition is invalid
+        return self.templates[query_num - 1]
 
-            start = time.perf_counter()
-            qryResopnse = requests.post(
-                'https://' + target['api_server'] + '/v1/orgs/self/queries',
-                json=payload,
-                headers={'Authorization': 'ApiKey ' + target['api_key'] ,'Content-Type': 'application/json' })
-            end = time.perf_counter()
+    def feed_values(self, query_num, user_num):
+        # The next values from the query's feeders, or None if it doesn't have any
+        feeders = self.feeders[query_num - 1]
+        if len(feeders) == 0:
+            return None
+        values = {}
+        for feeder in feeders:
+            values.update(feeder.next_values(self.get_feed_positions(), user_num, self.partitions))
+        return values
+
+    def admission_wait_s(self):
+        if self.admission_settings == None:
+            return 0
+        return self.get_admission_delay().value / 1000
+
+    def record_admission(self, status_code):
+        if self.admission_settings == None:
+            return
+        delay = self.get_admission_delay()
+        with delay.get_lock():
+            delay.value = update_admission_delay(self.admission_settings, delay.value, status_code)
+
+    def retry_wait_s(self, status_code, attempt, first_start, retry_after):
+        # Returns how long to back off before the next attempt, or None if the query is finished
+        self.record_admission(status_code)
+        if status_code == 200:
+            return None
+        return get_retry_wait_s(self.retry_settings, status_code, attempt, time.perf_counter() - first_start, get_retry_after_s(retry_after))
+
+    def record_attempts(self, result, attempts, retried, backoff_s, admission_s):
+        # Kept apart from the queued and server throttled times, which only cover the final attempt
+        result['attempts'] = attempts
+        result['retried'] = retried
+        result['backoff_ms'] = round(backoff_s * 1000)
+        result['admission_ms'] = round(admission_s * 1000)
+
+    def query_sent(self):
+        counter = self.get_in_flight()
+        with counter.get_lock():
+            counter.value += 1
+
+    def query_answered(self):
+        counter = self.get_in_flight()
+        with counter.get_lock():
+            counter.value -= 1
+
+    def collect(self, stats, result):
+        stats.record(result)
+        for handler in self.result_handlers:
+            handler(result)
+
+    def new_result(self, query_num, user_num, query):
+        result = QueryResult()
+        result['query_num'] = query_num
+        result['user_num'] = user_num
+        if self.iteration != None:
+            result['iteration'] = self.iteration
+        if self.query_set_name != None:
+            result['query_set'] = self.query_set_name
+        if 'name' in query:
+            result['name'] = query['name']
         else:
-            result['status'] = 'invalid'
-            result['message'] = 'Query definition has neither lambda or sql specified'
-            return result
+            result['name'] = 'unnamed'
+        return result
 
-        if qryResopnse.status_code == 408:
+    def record_failure(self, result, status_code, message):
+        if status_code == 408:
             result['status'] = 'timeout'
-        elif qryResopnse.status_code == 429:
+        elif status_code == 429:
             result['status'] = 'exhausted'
-        elif qryResopnse.status_code != 200:
+        else:
             result['status'] = 'error'
-            result['message'] = f'{qryResopnse.reason}. {qryResopnse.text}'
+            result['message'] = message
+
+    def keeps_tail(self, template):
+        # Whether only the end of the query's responses is read into memory
+        return self.response_mode == 'light' and not template.paginated
+
+    def record_response(self, result, status_code, message, body, size, start, end, drop_results):
+        # body is the raw body of a successful response, or in the light response mode possibly only the end
+        # of it, and size the number of bytes downloaded. message is the error text of a failed one.
+        # Returns the pagination of a paginated response, otherwise None
+        if status_code != 200:
+            self.record_failure(result, status_code, message)
         else:
+            decode_start = time.perf_counter()
+            stats, row_count, pagination = summarize_response(body, self.response_mode, len(body) == size)
+            result['decode_ms'] = round((time.perf_counter() - decode_start) * 1000, 3)
+            result['download_bytes'] = size
+
             result['status'] = 'success'
             result['round_trip_ms'] = round((end - start) * 1000)
-            response_data = qryResopnse.json()
-            result['server_ms'] = response_data['stats']['elapsed_time_ms']
-            result['queued_ns'] = round(response_data['stats']['throttled_time_micros'])
+            result['server_ms'] = stats['elapsed_time_ms']
+            result['queued_ns'] = round(stats['throttled_time_micros'])
             result['query_ms'] = round(result['server_ms'] - (result['queued_ns'] /1000))
             result['network_ms'] = result['round_trip_ms'] - result['server_ms']
             if drop_results:
                 result['row_count'] = 'dropped'
             else:
-                result['row_count'] = len(response_data['results'])
+                result['row_count'] = row_count
+                return pagination
+        return None
+
+    def record_phases(self, result, timings, start, end):
+        # Splits the round trip of the final attempt into phases. Sending covers whatever happened before the
+        # request was written other than the handshakes, TTFB is the wait from then until the response headers
+        # arrived, and download the time spent reading the body.
+        if timings == None or timings['sent'] == None or timings['headers'] == None:
+            return
+        handshakes = timings['dns_s'] + timings['connect_s']
+        result['dns_ms'] = round(timings['dns_s'] * 1000, 1)
+        result['connect_ms'] = round(timings['connect_s'] * 1000, 1)
+        # The async executor can't tell the TLS handshake apart from the TCP connect
+        if timings['tls_s'] != None:
+            result['tls_ms'] = round(timings['tls_s'] * 1000, 1)
+            handshakes += timings['tls_s']
+        result['send_ms'] = round(max(0.0, timings['sent'] - start - handshakes) * 1000, 1)
+        result['ttfb_ms'] = round((timings['headers'] - timings['sent']) * 1000, 1)
+        result['download_ms'] = round((end - timings['headers']) * 1000, 1)
+
+    def start_pages(self, result):
+        # The query response itself is the first page
+        result['first_page_ms'] = result['round_trip_ms']
+        result['page_latencies_ms'] = []
+
+    def record_page(self, result, status_code, message, body, page_ms):
+        # Adds a page fetched from the pages endpoint to the query's result and returns the next page's cursor
+        if status_code != 200:
+            self.record_failure(result, status_code, f"Page {len(result['page_latencies_ms']) + 2} failed. {message}")
+            return None
+        decode_start = time.perf_counter()
+        row_count, next_cursor = read_page(body)
+        result['decode_ms'] = round(result['decode_ms'] + (time.perf_counter() - decode_start) * 1000, 3)
+        result['download_bytes'] += len(body)
+        result['row_count'] += row_count
+        result['page_latencies_ms'].append(page_ms)
+        return next_cursor
+
+    def finish_pages(self, result, start):
+        result['page_count'] = len(result['page_latencies_ms']) + 1
+        # Time from sending the query until the last page was read
+        result['drain_ms'] = round((time.perf_counter() - start) * 1000)
+
+    def fetch_page(self, session, url, headers):
+        self.query_sent()
+        start = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, stream=True)
+            body = b''.join(response.iter_content(CHUNK_BYTES))
+        except RequestException as e:
+            return None, f'{type(e).__name__}. {e}', b'', None
+        finally:
+            self.query_answered()
+        page_ms = round((time.perf_counter() - start) * 1000, 1)
+        message = None
+        if response.status_code != 200:
+            message = f'{response.reason}. {body.decode(errors="replace")}'
+        return response.status_code, message, body, page_ms
+
+    def drain_pages(self, session, target, query, headers, result, pagination, start):
+        settings = get_page_settings(query)
+        page_size = settings['page_size']
+        self.start_pages(result)
+        if settings['page_pipeline'] > 1:
+            # Every remaining page is requested as an offset from the start cursor, page_pipeline at a time
+            urls = [get_page_url(target, pagination['query_id'], pagination['start_cursor'], page_size, offset)
+                for offset in get_page_offsets(pagination, page_size)]
+            with ThreadPoolExecutor(max_workers=settings['page_pipeline']) as fetchers:
+                for page in fetchers.map(lambda url: self.fetch_page(session, url, headers), urls):
+                    self.record_page(result, *page)
+                    if result['status'] != 'success':
+                        break
+        else:
+            cursor = pagination['next_cursor']
+            while cursor != None and result['status'] == 'success':
+                url = get_page_url(target, pagination['query_id'], cursor, page_size)
+                cursor = self.record_page(result, *self.fetch_page(session, url, headers))
+        self.finish_pages(result, start)
+
+    def run_query(self, query_num, user_num, target, query):
+
+        result = self.new_result(query_num, user_num, query)
+
+        template = self.get_template(query_num, query)
+        if template == None:
+            result['status'] = 'invalid'
+            result['message'] = 'Query definition has neither lambda or sql specified'
+            return result
+        url, headers, drop_results = template.url, template.headers, template.drop_results
+        request_body = template.render(self.feed_values(query_num, user_num))
+        tail_only = self.keeps_tail(template)
+
+        # Run the query on this worker's keep-alive session
+        session = get_session(target)
+        opened = count_connections(session)
+        admission = self.admission_wait_s()
+        if admission > 0:
+            time.sleep(admission)
+        first_start = time.perf_counter()
+        attempts = 0
+        retried = []
+        backoff = 0.0
+        while True:
+            attempts += 1
+            self.query_sent()
+            start = time.perf_counter()
+            try:
+                qryResopnse = session.post(url, data=request_body, headers=headers, stream=True)
+                timings = take_timings(qryResopnse)
+                # The body is kept as bytes until the response is summarized
+                body, size = read_body(qryResopnse.iter_content(CHUNK_BYTES), tail_only)
+            except RequestException as e:
+                # Connection failures and client timeouts are expected under overload, so they are recorded
+                # like any other failed query rather than ending the test
+                result['status'] = 'error'
+                result['message'] = f'{type(e).__name__}. {e}'
+                self.record_attempts(result, attempts, retried, backoff, admission)
+                return result
+            finally:
+                self.query_answered()
+            end = time.perf_counter()
+            wait = self.retry_wait_s(qryResopnse.status_code, attempts, first_start, qryResopnse.headers.get('Retry-After'))
+            if wait == None:
+                break
+            retried.append(RETRY_STATUSES[qryResopnse.status_code])
+            time.sleep(wait)
+            backoff += wait
+        result['new_connection'] = count_connections(session) > opened
+        self.record_attempts(result, attempts, retried, backoff, admission)
+        self.record_phases(result, timings, start, end)
+
+        message = None
+        if qryResopnse.status_code != 200:
+            message = f'{qryResopnse.reason}. {body.decode(errors="replace")}'
+        pagination = self.record_response(result, qryResopnse.status_code, message, body, size, start, end, drop_results)
+        if pagination != None:
+            self.drain_pages(session, target, query, headers, result, pagination, start)
 
         return result
 
 class ParallelQSExecutor(QuerySetExecutor):
 
-    def __init__(self,target, query_set):
-       super().__init__(target, query_set)
+    def __init__(self,target, query_set, templates=None):
+       super().__init__(target, query_set, templates)
 
     def run(self):
         results = {}
-        query_count = len(self.query_set['queries'])
+        query_count = len(self.query_set)
         query_results = [None] * query_count
-        with Pool(processes=query_count) as pool:
-            tasks = []
-            for x in range(0, query_count):
-                args = []
-                args.append(x + 1)   # query_num
-                args.append(0)       # user_num
-                args.append(self.target)  # target
-                args.append(self.query_set['queries'][x])  # query
-
-                task = pool.apply_async(self.run_query, args)
-                tasks.append(task)
-            
-            pool.close()
-            pool.join()
+        stats = ResultStats()
+        pool = self.get_pool(query_count)
+        tasks = []
+        start = time.time()
+        for x in range(0, query_count):
+            args = []
+            args.append(x + 1)   # query_num
+            args.append(0)       # user_num
+            args.append(self.target)  # target
+            args.append(self.query_set[x])  # query
 
-            for task in tasks:
-                result = task.get()
-                offset = result['query_num']
-                query_results[offset -1] = result
+            # Results are added to the stats as they arrive
+            task = pool.apply_async(self.run_query, args, callback=partial(self.collect, stats))
+            tasks.append(task)
+
+        for task in tasks:
+            result = task.get()
+            offset = result['query_num']
+            query_results[offset -1] = result
+        end = time.time()
         
-        results['query_results'] = query_results
+        results['query_results'] = ResultTable(query_results)
+        results['stats'] = stats
+        results['elapsed_s'] = end - start
         return results
 
 
 class SerialQSExecutor(QuerySetExecutor):
 
-    def __init__(self,target, query_set):
-       super().__init__(target, query_set)
+    def __init__(self,target, query_set, templates=None):
+       super().__init__(target, query_set, templates)
 
     def run(self):
         results = {}
         query_count = len(self.query_set)
         query_results = [None] * query_count
-        with Pool(processes=query_count) as pool:
+        stats = ResultStats()
+        # A single worker runs the queries one after another, reusing its keep-alive connection
+        pool = self.get_pool(1)
+        tasks = []
+        start = time.time()
+        for x in range(0, query_count):
+            args = []
+            args.append(x + 1)   # query_num
+            args.append(0)       # user_num
+            args.append(self.target)  # target
+            args.append(self.query_set[x])  # query
+
+            task = pool.apply(self.run_query, args)
+            self.collect(stats, task)
+            tasks.append(task)
+        end = time.time()
+
+        for task in tasks:
+            result = task
+            offset = result['query_num']
+            query_results[offset -1] = result
+        
+        results['query_results'] = ResultTable(query_results)
+        results['stats'] = stats
+        results['elapsed_s'] = end - start
+        return results
+
+
+class OpenLoopExecutor(QuerySetExecutor):
+    # Issues queries on a precomputed arrival schedule, regardless of whether earlier queries have completed
+
+    def __init__(self,target, query_set, workers, templates=None):
+       super().__init__(target, query_set, templates)
+       self.workers = workers
+       # Whether every result is kept and returned, rather than only recorded in the stats and handed to the
+       # result handlers. Only capacity steps read them.
+       self.keep_results = False
+       # Time the schedule started, shared with the pool workers
+       self.schedule_start = multiprocessing.Value('d', 0.0)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['schedule_start'] = None
+        return state
+
+    def task_args(self, query_num, query, offset):
+        # The worker's executor already has the query set, so only its number is sent
+        return (query_num, offset)
+
+    def run_scheduled_query(self, query_num, offset, query=None):
+        # How late, relative to the schedule, the query was actually sent
+        lag = time.time() - (schedule_start.value + offset)
+        if query == None:
+            query = self.query_set[query_num - 1]
+        try:
+            result = self.run_query(query_num, 0, self.target, query)
+        except Exception as e:
+            # Anything else that goes wrong, e.g. a successful response that isn't JSON, fails the query rather
+            # than the whole schedule
+            result = self.new_result(query_num, 0, query)
+            result['status'] = 'error'
+            result['message'] = f'{type(e).__name__}. {e}'
+        result['lag_ms'] = round(lag * 1000)
+        result['offset_s'] = round(offset, 3)
+        return result
+
+    def run(self, schedule):
+        query_count = len(self.query_set)
+        return self.dispatch((schedule[x], x % query_count + 1, self.query_set[x % query_count]) for x in range(0, len(schedule)))
+
+    def dispatch(self, arrivals):
+        # arrivals yields (offset, query_num, query) in the order the queries are sent
+        results = {}
+        query_results = ResultTable()
+        stats = ResultStats()
+        dispatch_lag = 0.0
+
+        def handle(result):
+            if self.keep_results:
+                query_results.append(result)
+            self.collect(stats, result)
+
+        initargs = self.worker_args(self.target) + (self, self.schedule_start)
+        with Pool(processes=self.workers, initializer=init_worker, initargs=initargs) as pool:
+            start = time.time()
+            self.schedule_start.value = start
+            for offset, query_num, query in arrivals:
+                due = start + offset
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    dispatch_lag = max(dispatch_lag, -delay)
+
+                # Results are kept as they arrive rather than holding on to a task for every query
+                pool.apply_async(run_scheduled, self.task_args(query_num, query, offset), callback=handle)
+            issue_end = time.time()
+
+            pool.close()
+            pool.join()
+            end = time.time()
+
+        # Results arrive as the queries complete, so put them back in schedule order
+        query_results.sort('offset_s')
+
+        results['query_results'] = query_results
+        results['stats'] = stats
+        results['issue_s'] = issue_end - start
+        results['elapsed_s'] = end - start
+        results['max_dispatch_lag_ms'] = round(dispatch_lag * 1000)
+        return results
+
+
+class ReplayExecutor(OpenLoopExecutor):
+    # Sends the queries of a trace at their offsets in the trace. The queries come from the trace rather than
+    # a query set, so each one is compiled when it is sent and is not fed.
+
+    def __init__(self,target, workers):
+       super().__init__(target, [], workers)
+
+    def get_template(self, query_num, query):
+        return compile_template(self.target, query)
+
+    def feed_values(self, query_num, user_num):
+        return None
+
+    def task_args(self, query_num, query, offset):
+        return (query_num, offset, query)
+
+    def run(self, trace):
+        # trace yields (offset, query_num, query) and is read as the queries are sent
+        planned = {'scheduled': 0, 'planned_s': 0.0}
+        def count(arrivals):
+            for arrival in arrivals:
+                planned['scheduled'] += 1
+                planned['planned_s'] = max(planned['planned_s'], arrival[0])
+                yield arrival
+
+        results = self.dispatch(count(trace))
+        if planned['scheduled'] == 0:
+            return None
+        results['scheduled'] = planned['scheduled']
+        results['planned_s'] = round(planned['planned_s'], 3)
+        return results
+
+
+class VirtualUserExecutor(QuerySetExecutor):
+    # Simulates concurrent users, one process each. Every user runs the query set in a closed loop,
+    # waiting for each query to finish before sending the next and thinking between iterations.
+
+    def __init__(self,target, query_set, user_settings, templates=None):
+       super().__init__(target, query_set, templates)
+       self.user_settings = user_settings
+       self.partitions = user_settings['total']
+
+    def run_user(self, user_num, start):
+        rng = random.Random()
+        delay = start + get_start_offset(self.user_settings, user_num) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        deadline = get_deadline(self.user_settings, start)
+        iteration = 1
+        while has_more_iterations(self.user_settings, iteration, deadline, time.time()):
+            for x in range(0, len(self.query_set)):
+                if deadline != None and time.time() >= deadline:
+                    break
+                result = self.run_query(x + 1, user_num, self.target, self.query_set[x])
+                result['iteration'] = iteration
+                forward_result(result)
+            iteration += 1
+            if has_more_iterations(self.user_settings, iteration, deadline, time.time()):
+                time.sleep(get_think_time(self.user_settings, rng))
+
+    def run(self):
+        results = {}
+        user_count = self.user_settings['count']
+        query_results = ResultTable()
+        stats = ResultStats()
+
+        def handle(result):
+            query_results.append(result)
+            self.collect(stats, result)
+
+        # Users stream their results back as each query completes rather than when the user finishes
+        collector = ResultCollector(handle)
+        collector.start()
+        with Pool(processes=user_count, initializer=init_worker, initargs=self.worker_args(self.target, collector.queue)) as pool:
             tasks = []
-            for x in range(0, query_count):
-                args = []
-                args.append(x + 1)   # query_num
-                args.append(0)       # user_num
-                args.append(self.target)  # target
-                args.append(self.query_set[x])  # query
-
-                task = pool.apply(self.run_query, args)
+            start = time.time()
+            for user_num in get_user_nums(self.user_settings):
+                task = pool.apply_async(self.run_user, [user_num, start])
                 tasks.append(task)
-            
+
             pool.close()
             pool.join()
+            end = time.time()
 
             for task in tasks:
-                result = task
-                offset = result['query_num']
-                query_results[offset -1] = result
-        
+                # Raises any exception from the user process
+                task.get()
+        collector.stop()
+
         results['query_results'] = query_results
-        return results
\ No newline at end of file
+        results['stats'] = stats
+        results['elapsed_s'] = end - start
+        return results
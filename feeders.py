@@ -0,0 +1,280 @@
+import csv, json, math, mmap, os, random, multiprocessing
+from bisect import bisect_right
+
+# Feeders bind new parameter values into every execution of a query, so a test isn't just measuring the
+# result cache. File feeders never load the file: CSV and JSONL files are memory mapped and read a line at a
+# time, and Parquet files are read a row group at a time, so every worker process can share a multi-GB key file.
+# The position of each sequential feeder is shared by all of the executor's processes.
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl', '.parquet': 'parquet'}
+SELECTIONS = ['sequential', 'random', 'partitioned']
+GENERATORS = ['range', 'zipf']
+
+# Sources opened by this process, by path. Executors are copied to the pool workers for every task, so
+# open files are kept here rather than on the feeders.
+sources = {}
+sources_pid = None
+
+# Where each virtual user is in its partition of a file, by (feeder slot, user_num)
+partition_positions = {}
+
+def get_source(path, format, columns):
+    global sources, sources_pid
+    if sources_pid != os.getpid():
+        sources = {}
+        sources_pid = os.getpid()
+    if not path in sources:
+        if format == 'parquet':
+            sources[path] = ParquetSource(path, columns)
+        else:
+            sources[path] = LineSource(path, format)
+    return sources[path]
+
+class LineSource():
+    # A CSV or JSON lines file, memory mapped. Positions are byte offsets of line starts.
+
+    def __init__(self, path, format):
+        self.format = format
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.data)
+        self.start = 0
+        self.header = None
+        if format == 'csv':
+            # The first line holds the column names
+            end = self.line_end(0)
+            self.header = next(csv.reader([self.data[0:end].decode()]))
+            self.start = min(end + 1, self.size)
+        if self.start >= self.size:
+            raise ValueError(f'Feeder file {path} has no values')
+
+    def line_end(self, position):
+        end = self.data.find(b'\n', position)
+        return self.size if end < 0 else end
+
+    def line_start(self, position):
+        # The start of the line that holds position
+        return max(self.start, self.data.rfind(b'\n', self.start, position) + 1)
+
+    def next_line_start(self, position):
+        # The first line start at or after position
+        if position <= self.start:
+            return self.start
+        return min(self.size, self.line_end(position - 1) + 1)
+
+    def read(self, position):
+        # Returns the values on the line starting at position and the start of the following line, or None for
+        # a blank line
+        end = self.line_end(position)
+        line = self.data[position:end].strip()
+        if len(line) == 0:
+            return None, end + 1
+        if self.format == 'csv':
+            return dict(zip(self.header, next(csv.reader([line.decode()])))), end + 1
+        return json.loads(line), end + 1
+
+class ParquetSource():
+    # A Parquet file, memory mapped and read one row group at a time. Positions are row numbers.
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError('Parquet feeders need pyarrow. Install it with pip install pyarrow')
+        self.file = pq.ParquetFile(path, memory_map=True)
+        self.columns = columns
+        self.group_starts = []
+        rows = 0
+        for group in range(0, self.file.num_row_groups):
+            self.group_starts.append(rows)
+            rows += self.file.metadata.row_group(group).num_rows
+        self.start = 0
+        self.size = rows
+        if rows == 0:
+            raise ValueError(f'Feeder file {path} has no values')
+        self.group = None
+        self.rows = None
+
+    def read(self, position):
+        group = bisect_right(self.group_starts, position) - 1
+        if group != self.group:
+            self.rows = self.file.read_row_group(group, columns=self.columns).to_pylist()
+            self.group = group
+        return self.rows[position - self.group_starts[group]], position + 1
+
+class Feeder():
+    def __init__(self, settings, slot):
+        self.settings = settings
+        # Index of this feeder's position in the executor's shared positions
+        self.slot = slot
+
+class FileFeeder(Feeder):
+    def __init__(self, settings, slot):
+        super().__init__(settings, slot)
+        self.path = settings['file']
+        self.format = settings['format'] if 'format' in settings else FORMATS.get(os.path.splitext(self.path)[1].lower())
+        if self.format not in FORMATS.values():
+            raise ValueError(f'Unable to tell the format of feeder file {self.path}')
+        self.select = settings['select'] if 'select' in settings else 'sequential'
+        if self.select not in SELECTIONS:
+            raise ValueError(f'Unexpected feeder selection {self.select}')
+        self.columns = settings['columns'] if 'columns' in settings else None
+        self.types = settings['types'] if 'types' in settings else {}
+
+    def next_sequential(self, source, positions):
+        # Every process takes the next line from the same shared position
+        with positions.get_lock():
+            position = positions[self.slot]
+            if position < source.start or position >= source.size:
+                position = source.start
+            values, following = source.read(position)
+            positions[self.slot] = following
+        return values
+
+    def next_random(self, source):
+        # Lines are picked by picking a random byte, so long lines are picked a little more often than short ones
+        if isinstance(source, LineSource):
+            position = source.line_start(random.randrange(source.start, source.size))
+        else:
+            position = random.randrange(source.start, source.size)
+        values, following = source.read(position)
+        return values
+
+    def next_partitioned(self, source, user_num, partitions):
+        # Each virtual user reads its own contiguous slice of the file, starting again when it reaches the end
+        partition = max(0, user_num - 1) % partitions
+        span = source.size - source.start
+        first = source.start + span * partition // partitions
+        last = source.start + span * (partition + 1) // partitions
+        if isinstance(source, LineSource):
+            first = source.next_line_start(first)
+            last = source.next_line_start(last)
+        if first >= last:
+            # More users than lines
+            first, last = source.start, source.size
+
+        key = (self.slot, user_num)
+        position = partition_positions.get(key, first)
+        if position < first or position >= last:
+            position = first
+        values, following = source.read(position)
+        partition_positions[key] = following
+        return values
+
+    def next_values(self, positions, user_num, partitions):
+        source = get_source(self.path, self.format, self.columns)
+        values = None
+        # Skip blank lines
+        for attempt in range(0, 100):
+            if self.select == 'sequential':
+                values = self.next_sequential(source, positions)
+            elif self.select == 'random':
+                values = self.next_random(source)
+            else:
+                values = self.next_partitioned(source, user_num, partitions)
+            if values != None:
+                break
+        if values == None:
+            raise ValueError(f'Feeder file {self.path} has too many blank lines')
+
+        parameters = {}
+        for name in (self.columns if self.columns != None else values.keys()):
+            parameters[name] = (self.types.get(name, 'string'), values[name])
+        return parameters
+
+class GeneratorFeeder(Feeder):
+    def __init__(self, settings, slot):
+        super().__init__(settings, slot)
+        self.generator = settings['generator']
+        if self.generator not in GENERATORS:
+            raise ValueError(f'Unexpected feeder generator {self.generator}')
+        self.name = settings['name']
+        self.type = settings['type'] if 'type' in settings else 'int'
+        self.min = int(settings['min']) if 'min' in settings else 1
+        self.max = int(settings['max'])
+        if self.max < self.min:
+            raise ValueError(f'Feeder generator {self.name} has max below min')
+        if self.generator == 'zipf':
+            self.zipf = ZipfSampler(self.max - self.min + 1, settings['s'] if 's' in settings else 1.0)
+
+    def next_values(self, positions, user_num, partitions):
+        if self.generator == 'range':
+            value = random.randint(self.min, self.max)
+        else:
+            # Rank 1, the most frequent value, is min
+            value = self.min + self.zipf.sample() - 1
+        return {self.name: (self.type, value)}
+
+class ZipfSampler():
+    # Samples ranks 1..count with probability proportional to 1 / rank^s in constant time and memory, using
+    # rejection-inversion (Hormann and Derflinger, 1996), so any number of distinct values can be generated
+
+    def __init__(self, count, s):
+        if s <= 0:
+            raise ValueError('The Zipf exponent s must be greater than 0')
+        self.count = count
+        self.s = s
+        self.h_integral_x1 = self.h_integral(1.5) - 1.0
+        self.h_integral_count = self.h_integral(count + 0.5)
+        self.squeeze = 2.0 - self.h_integral_inverse(self.h_integral(2.5) - self.h(2.0))
+
+    def h(self, x):
+        return math.exp(-self.s * math.log(x))
+
+    def h_integral(self, x):
+        log_x = math.log(x)
+        return helper2((1.0 - self.s) * log_x) * log_x
+
+    def h_integral_inverse(self, x):
+        t = max(-1.0, x * (1.0 - self.s))
+        return math.exp(helper1(t) * x)
+
+    def sample(self):
+        while True:
+            u = self.h_integral_count + random.random() * (self.h_integral_x1 - self.h_integral_count)
+            x = self.h_integral_inverse(u)
+            rank = min(self.count, max(1, int(x + 0.5)))
+            if rank - x <= self.squeeze or u >= self.h_integral(rank + 0.5) - self.h(rank):
+                return rank
+
+def helper1(x):
+    # log(1 + x) / x, accurate near 0
+    if abs(x) > 1e-8:
+        return math.log1p(x) / x
+    return 1.0 - x * (0.5 - x * (1.0 / 3.0 - 0.25 * x))
+
+def helper2(x):
+    # (exp(x) - 1) / x, accurate near 0
+    if abs(x) > 1e-8:
+        return math.expm1(x) / x
+    return 1.0 + x * 0.5 * (1.0 + x * (1.0 / 3.0) * (1.0 + 0.25 * x))
+
+def new_feeder(settings, slot):
+    if 'file' in settings:
+        return FileFeeder(settings, slot)
+    elif 'generator' in settings:
+        return GeneratorFeeder(settings, slot)
+    raise ValueError('A feeder needs either a file or a generator')
+
+def get_query_feeders(query_set):
+    # The feeders of each query in the query set, in order. Every feeder gets its own slot in the shared positions.
+    query_feeders = []
+    slot = 0
+    for query in query_set:
+        feeders = []
+        if 'feeders' in query and query['feeders'] != None:
+            for settings in query['feeders']:
+                feeders.append(new_feeder(settings, slot))
+                slot += 1
+        query_feeders.append(feeders)
+    return query_feeders
+
+def new_feed_positions(query_feeders):
+    return multiprocessing.Array('q', max(1, sum(len(feeders) for feeders in query_feeders)))
+
+def bind_parameters(parameters, values):
+    # Returns the query parameters with the fed values replacing, or added to, them
+    bound = [parameter for parameter in parameters if parameter['name'] not in values]
+    for name, (type, value) in values.items():
+        bound.append({'name': name, 'type': type, 'value': str(value)})
+    return bound
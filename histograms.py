@@ -0,0 +1,273 @@
+import math
+
+# Values are bucketed HDR style: exact below 2^SUB_BUCKET_BITS, then each power of two is split into
+# 2^(SUB_BUCKET_BITS - 1) equal buckets. A bucket is at most 1/2^(SUB_BUCKET_BITS - 1) of the values in it
+# wide, so with 8 bits the relative error stays under 1% (0.8%) with a small, bounded number of buckets no
+# matter how many values are recorded.
+SUB_BUCKET_BITS = 8
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+
+# Latencies are recorded in microseconds so that sub-millisecond values keep their precision
+UNITS_PER_MS = 1000
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+def bucket_index(value):
+    if value < (1 << SUB_BUCKET_BITS):
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+def bucket_high(index):
+    # The highest value that falls into the bucket
+    if index < (1 << SUB_BUCKET_BITS):
+        return index
+    shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    mantissa = index - (shift << (SUB_BUCKET_BITS - 1))
+    return ((mantissa + 1) << shift) - 1
+
+class LatencyHistogram():
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value_ms):
+        value = max(0, int(round(value_ms * UNITS_PER_MS)))
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min != None and (self.min == None or other.min < self.min):
+            self.min = other.min
+        if other.max != None and (self.max == None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, pct):
+        # Returns the value, in ms, that pct percent of the recorded values are less than or equal to
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(self.count * pct / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return round(min(bucket_high(index), self.max) / UNITS_PER_MS, 1)
+        return round(self.max / UNITS_PER_MS, 1)
+
+    def total_ms(self):
+        return self.total / UNITS_PER_MS
+
+    def mean_ms(self):
+        if self.count == 0:
+            return None
+        return round(self.total / self.count / UNITS_PER_MS, 1)
+
+    def max_ms(self):
+        if self.max == None:
+            return None
+        return round(self.max / UNITS_PER_MS, 1)
+
+    def to_dict(self):
+        # JSON friendly, for sending to a distributed test's coordinator
+        return {'counts': list(self.counts.items()), 'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+
+    def summary(self):
+        summary = {'count': self.count, 'mean': self.mean_ms()}
+        for pct in PERCENTILES:
+            summary[f'p{pct}'] = self.percentile(pct)
+        summary['max'] = self.max_ms()
+        return summary
+
+def histogram_from_dict(data):
+    histogram = LatencyHistogram()
+    histogram.counts = {index: count for index, count in data['counts']}
+    histogram.count = data['count']
+    histogram.total = data['total']
+    histogram.min = data['min']
+    histogram.max = data['max']
+    return histogram
+
+
+# Query name used for the histograms that cover every query
+ALL_QUERIES = '*'
+
+def query_set_key(query_set, name=ALL_QUERIES):
+    # Histograms of the queries in a query set of a mix are kept under the query set's name
+    return query_set + '/' + name
+
+# The phases of a query's round trip, as timed by the client
+PHASES = ['dns_ms', 'connect_ms', 'tls_ms', 'send_ms', 'ttfb_ms', 'download_ms']
+
+METRICS = ['round_trip_ms', 'query_ms', 'queued_ms', 'network_ms'] + PHASES + ['decode_ms', 'lag_ms', 'first_page_ms', 'page_ms', 'drain_ms', 'backoff_ms', 'admission_ms']
+
+class ResultStats():
+    # Aggregates query results as they arrive. Stats from different workers or processes are combined with merge.
+
+    def __init__(self, max_warnings=100):
+        self.histograms = {}
+        self.statuses = {}
+        # Statuses of the queries in each query set of a mix
+        self.query_set_statuses = {}
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.download_bytes = 0
+        # Attempts include retries. Retried statuses count the failed attempts that were retried, by status.
+        self.attempts = 0
+        self.retried_statuses = {}
+        self.warnings = []
+        self.warning_count = 0
+        self.max_warnings = max_warnings
+
+    def histogram(self, metric, name=ALL_QUERIES):
+        if not name in self.histograms:
+            self.histograms[name] = {}
+        if not metric in self.histograms[name]:
+            self.histograms[name][metric] = LatencyHistogram()
+        return self.histograms[name][metric]
+
+    def add_warning(self, result, message):
+        self.warning_count += 1
+        if len(self.warnings) < self.max_warnings:
+            warning = {}
+            warning['query_num'] = result['query_num']
+            warning['name'] = result['name']
+            warning['message'] = message
+            self.warnings.append(warning)
+
+    def record_metric(self, names, metric, value):
+        for name in names:
+            self.histogram(metric, name).record(value)
+
+    def record(self, result):
+        status = result['status']
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+        # The names of the histograms the result is added to
+        if 'query_set' in result:
+            query_set = result['query_set']
+            statuses = self.query_set_statuses.setdefault(query_set, {})
+            statuses[status] = statuses.get(status, 0) + 1
+            names = [ALL_QUERIES, query_set_key(query_set), query_set_key(query_set, result['name'])]
+        else:
+            names = [ALL_QUERIES, result['name']]
+
+        if 'new_connection' in result:
+            if result['new_connection']:
+                self.new_connections += 1
+            else:
+                self.reused_connections += 1
+
+        if 'lag_ms' in result:
+            self.record_metric(names, 'lag_ms', result['lag_ms'])
+
+        if 'attempts' in result:
+            self.attempts += result['attempts']
+            for retried in result['retried']:
+                self.retried_statuses[retried] = self.retried_statuses.get(retried, 0) + 1
+            # Only queries that waited are recorded, so the percentiles describe the wait when there is one
+            if result['backoff_ms'] > 0:
+                self.record_metric(names, 'backoff_ms', result['backoff_ms'])
+            if result['admission_ms'] > 0:
+                self.record_metric(names, 'admission_ms', result['admission_ms'])
+
+        if status == 'success':
+            self.record_metric(names, 'round_trip_ms', result['round_trip_ms'])
+            self.record_metric(names, 'query_ms', result['query_ms'])
+            self.record_metric(names, 'queued_ms', result['queued_ns']/1000)
+            self.record_metric(names, 'network_ms', result['network_ms'])
+            self.record_metric(names, 'decode_ms', result['decode_ms'])
+            for phase in PHASES:
+                if phase in result:
+                    self.record_metric(names, phase, result[phase])
+            self.download_bytes += result['download_bytes']
+            if 'page_count' in result:
+                self.record_metric(names, 'first_page_ms', result['first_page_ms'])
+                self.record_metric(names, 'drain_ms', result['drain_ms'])
+                for page_ms in result['page_latencies_ms']:
+                    self.record_metric(names, 'page_ms', page_ms)
+            if result['row_count'] == 0:
+                self.add_warning(result, 'Returned no rows')
+        elif status == 'error':
+            self.add_warning(result, f"Errored with message: {result['message']}")
+        elif status == 'timeout':
+            self.add_warning(result, 'Query timed out')
+        elif status == 'exhausted':
+            self.add_warning(result, 'Resources exhausted')
+
+    def merge(self, other):
+        for name, histograms in other.histograms.items():
+            for metric, histogram in histograms.items():
+                self.histogram(metric, name).merge(histogram)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        for query_set, statuses in other.query_set_statuses.items():
+            mine = self.query_set_statuses.setdefault(query_set, {})
+            for status, count in statuses.items():
+                mine[status] = mine.get(status, 0) + count
+        self.new_connections += other.new_connections
+        self.reused_connections += other.reused_connections
+        self.download_bytes += other.download_bytes
+        self.attempts += other.attempts
+        for status, count in other.retried_statuses.items():
+            self.retried_statuses[status] = self.retried_statuses.get(status, 0) + count
+        self.warnings.extend(other.warnings[:max(0, self.max_warnings - len(self.warnings))])
+        self.warning_count += other.warning_count
+
+    def count(self):
+        return sum(self.statuses.values())
+
+    def successes(self):
+        return self.statuses.get('success', 0)
+
+    def retries(self):
+        return sum(self.retried_statuses.values())
+
+    def clean(self):
+        return self.warning_count == 0
+
+    def to_dict(self):
+        return {
+            'histograms': {name: {metric: histogram.to_dict() for metric, histogram in histograms.items()}
+                for name, histograms in self.histograms.items()},
+            'statuses': self.statuses,
+            'query_set_statuses': self.query_set_statuses,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'download_bytes': self.download_bytes,
+            'attempts': self.attempts,
+            'retried_statuses': self.retried_statuses,
+            'warnings': self.warnings,
+            'warning_count': self.warning_count
+        }
+
+    def latency_summaries(self):
+        # {query name: {metric: summary}} for every histogram that has values
+        summaries = {}
+        for name in self.histograms:
+            summaries[name] = {}
+            for metric in METRICS:
+                if metric in self.histograms[name] and self.histograms[name][metric].count > 0:
+                    summaries[name][metric] = self.histograms[name][metric].summary()
+        return summaries
+
+def stats_from_dict(data):
+    stats = ResultStats()
+    for name, histograms in data['histograms'].items():
+        stats.histograms[name] = {metric: histogram_from_dict(histogram) for metric, histogram in histograms.items()}
+    for key in ['statuses', 'query_set_statuses', 'new_connections', 'reused_connections', 'download_bytes',
+            'attempts', 'retried_statuses', 'warnings', 'warning_count']:
+        setattr(stats, key, data[key])
+    return stats
@@ -0,0 +1,202 @@
+import os, csv, json, math
+import numpy as np
+from histograms import ALL_QUERIES
+from resultArrays import STATUSES, get_run_path, load_run
+
+# Reads runs back out of the history. The details file only ever grows, so it is indexed incrementally: the
+# index records where each run's lines are in the file and how much of the file has been read, and each
+# compare only reads what has been appended since. A run's results are then loaded by seeking straight to its
+# lines, or from its columnar file when the run was saved with --columnar.
+
+INDEX_NAME = 'details_index.json'
+
+def get_index_path(options):
+    return options['output_dir'] + '/' + INDEX_NAME
+
+def new_index():
+    return {'indexed_bytes': 0, 'header': None, 'runs': {}}
+
+def read_records(details, position):
+    # Yields (start, end, line) for each CSV record after position. Quoted values can hold line breaks, so a
+    # record ends at the first line break with an even number of quotes before it.
+    details.seek(position)
+    start = position
+    record = b''
+    for line in details:
+        record += line
+        if record.count(b'"') % 2 == 0 and record.endswith(b'\n'):
+            end = start + len(record)
+            yield start, end, record
+            start = end
+            record = b''
+
+def read_header(details_path):
+    with open(details_path, newline='') as details:
+        return next(csv.reader(details), None)
+
+def update_index(options):
+    # Brings the index up to date with the details file and returns it
+    details_path = options['output_dir'] + '/' + options['details_name']
+    index_path = get_index_path(options)
+    index = new_index()
+    if os.path.exists(index_path):
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+    if not os.path.exists(details_path):
+        return new_index()
+    size = os.path.getsize(details_path)
+    if size < index['indexed_bytes'] or (index['header'] != None and read_header(details_path) != index['header']):
+        # The details file was replaced, e.g. moved aside because its columns changed, start again
+        index = new_index()
+    if size == index['indexed_bytes']:
+        return index
+
+    with open(details_path, 'rb') as details:
+        if index['header'] == None:
+            header = details.readline()
+            index['header'] = next(csv.reader([header.decode()]))
+            index['indexed_bytes'] = len(header)
+        columns = index['header']
+        test_name, run_id, test_start = columns.index('test_name'), columns.index('run_id'), columns.index('test_start')
+        for start, end, record in read_records(details, index['indexed_bytes']):
+            values = next(csv.reader([record.decode()]))
+            run = index['runs'].get(values[run_id])
+            if run == None:
+                run = {'test_name': values[test_name], 'test_start': values[test_start], 'rows': 0, 'ranges': []}
+                index['runs'][values[run_id]] = run
+            run['rows'] += 1
+            # A run's lines are usually together, so they are kept as ranges of bytes
+            if len(run['ranges']) > 0 and run['ranges'][-1][1] == start:
+                run['ranges'][-1][1] = end
+            else:
+                run['ranges'].append([start, end])
+            index['indexed_bytes'] = end
+
+    with open(index_path + '.tmp', 'wt') as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path + '.tmp', index_path)
+    return index
+
+def list_runs(index, test_name=None):
+    # Indexed runs as (run_id, run), oldest first
+    runs = [(run_id, run) for run_id, run in index['runs'].items() if test_name == None or run['test_name'] == test_name]
+    return sorted(runs, key=lambda item: item[1]['test_start'])
+
+def select_runs(index, test_name=None, baseline=None, candidate=None):
+    # Returns the baseline and candidate run ids. Without a candidate the latest run of the test is used,
+    # and without a baseline the run of the same test before the candidate.
+    for run_id in [baseline, candidate]:
+        if run_id != None and run_id not in index['runs']:
+            raise ValueError(f'Run {run_id} is not in the history')
+    if test_name == None:
+        if candidate != None:
+            test_name = index['runs'][candidate]['test_name']
+        elif baseline != None:
+            test_name = index['runs'][baseline]['test_name']
+    runs = [run_id for run_id, run in list_runs(index, test_name)]
+    if candidate == None:
+        if len(runs) == 0:
+            raise ValueError(f'There are no runs of {test_name} in the history')
+        candidate = runs[-1]
+    if baseline == None:
+        earlier = runs[0:runs.index(candidate)] if candidate in runs else []
+        if len(earlier) == 0:
+            raise ValueError(f'There is no run of {test_name} before {candidate} to compare it with')
+        baseline = earlier[-1]
+    return baseline, candidate
+
+def load_details_latencies(options, index, run_id, metric):
+    # Successful queries' values of the metric by query name, read from the run's lines of the details file
+    columns = index['header']
+    if metric not in columns:
+        raise ValueError(f'The details file has no {metric} column')
+    name, status, value = columns.index('query_name'), columns.index('status'), columns.index(metric)
+    latencies = {}
+    with open(options['output_dir'] + '/' + options['details_name'], 'rb') as details:
+        for start, end in index['runs'][run_id]['ranges']:
+            details.seek(start)
+            data = details.read(end - start).decode()
+            for values in csv.reader(data.splitlines(keepends=True)):
+                if values[status] == 'success' and values[value] != '':
+                    latencies.setdefault(values[name], []).append(float(values[value]))
+    return {name: np.array(values) for name, values in latencies.items()}
+
+def load_array_latencies(path, metric):
+    # The same, read from the run's columnar file
+    metadata, columns = load_run(path)
+    if metric not in columns:
+        raise ValueError(f'Columnar files have no {metric} column')
+    success = (columns['status'] == STATUSES.index('success')) & ~np.isnan(columns[metric])
+    latencies = {}
+    for code, name in enumerate(metadata['query_names']):
+        values = columns[metric][success & (columns['query_name'] == code)].astype(np.float64)
+        if len(values) > 0:
+            latencies[name] = values
+    return latencies
+
+def load_latencies(options, index, run_id, metric):
+    path = get_run_path(options, run_id)
+    if os.path.exists(path):
+        return load_array_latencies(path, metric)
+    return load_details_latencies(options, index, run_id, metric)
+
+def rank_sum_test(baseline, candidate):
+    # Mann-Whitney U test, using the normal approximation with a correction for ties. Returns the one sided
+    # p values of the candidate being slower and of it being faster, and the probability that a random
+    # candidate query is slower than a random baseline query.
+    n1, n2 = len(baseline), len(candidate)
+    values = np.concatenate([baseline, candidate])
+    order = np.argsort(values, kind='mergesort')
+    unique, first, counts = np.unique(values[order], return_index=True, return_counts=True)
+    ranks = np.empty(len(values))
+    # Tied values share the average of their ranks
+    ranks[order] = np.repeat(first + (counts + 1) / 2, counts)
+    u = ranks[n1:].sum() - n2 * (n2 + 1) / 2
+    mean = n1 * n2 / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - (counts ** 3 - counts).sum() / (n * (n - 1)))
+    if variance <= 0:
+        # Every value is the same
+        return 1.0, 1.0, 0.5
+    sd = math.sqrt(variance)
+    slower = 0.5 * math.erfc((u - mean - 0.5) / sd / math.sqrt(2))
+    faster = 0.5 * math.erfc((mean - u - 0.5) / sd / math.sqrt(2))
+    return slower, faster, u / (n1 * n2)
+
+def percent_change(baseline, candidate):
+    if baseline == 0:
+        return 0.0 if candidate == 0 else math.inf
+    return (candidate - baseline) / baseline * 100
+
+def compare_query(settings, baseline, candidate):
+    comparison = {'baseline_count': len(baseline), 'candidate_count': len(candidate)}
+    if len(baseline) < settings['min_count'] or len(candidate) < settings['min_count']:
+        comparison['verdict'] = 'too few'
+        return comparison
+    for pct in [50, 99]:
+        base, cand = np.percentile(baseline, pct), np.percentile(candidate, pct)
+        comparison[f'baseline_p{pct}'] = round(float(base), 1)
+        comparison[f'candidate_p{pct}'] = round(float(cand), 1)
+        comparison[f'p{pct}_change_pct'] = round(percent_change(base, cand), 1)
+    slower, faster, p_slower = rank_sum_test(baseline, candidate)
+    comparison['p_value'] = slower if slower <= faster else faster
+    comparison['p_slower'] = round(p_slower, 3)
+
+    # With enough queries even tiny differences are significant, so a change must also be big enough to matter
+    changes = [comparison['p50_change_pct'], comparison['p99_change_pct']]
+    if slower < settings['alpha'] and max(changes) >= settings['min_change_pct']:
+        comparison['verdict'] = 'regression'
+    elif faster < settings['alpha'] and min(changes) <= -settings['min_change_pct']:
+        comparison['verdict'] = 'improvement'
+    else:
+        comparison['verdict'] = 'no change'
+    return comparison
+
+def compare_runs(settings, baseline, candidate):
+    # Compares the latencies of each query name, and of all the queries together, between two runs
+    comparisons = {}
+    for name in sorted(set(baseline) | set(candidate)):
+        comparisons[name] = compare_query(settings, baseline.get(name, np.array([])), candidate.get(name, np.array([])))
+    everything = [np.concatenate(list(latencies.values())) if len(latencies) > 0 else np.array([]) for latencies in [baseline, candidate]]
+    comparisons[ALL_QUERIES] = compare_query(settings, everything[0], everything[1])
+    return comparisons
@@ -0,0 +1,193 @@
+import os, threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Publishes the test's metrics while it runs, in the Prometheus text format, so the client side load can be
+# lined up with Rockset's own metrics and other dashboards. The metrics are served over HTTP for Prometheus
+# to scrape and/or written to a file every interval, e.g. for node_exporter's textfile collector.
+#
+# Results are recorded into counters that belong to the thread recording them, so recording never waits on
+# a lock or on a scrape. A scrape adds up every thread's counters.
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS_S = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+class MetricShard():
+    # The counters of one recording thread. Only that thread changes them.
+
+    def __init__(self):
+        # Number of queries by (query, status)
+        self.queries = {}
+        # Bytes downloaded by query
+        self.download_bytes = {}
+        # Round trip histogram of successful queries by query: a count for each bucket and one for slower
+        # queries, then the sum of the latencies in seconds
+        self.round_trip = {}
+
+    def record(self, result):
+        name = result['name'] if 'name' in result else ''
+        key = (name, result['status'])
+        self.queries[key] = self.queries.get(key, 0) + 1
+        if 'download_bytes' in result:
+            self.download_bytes[name] = self.download_bytes.get(name, 0) + result['download_bytes']
+        if result['status'] == 'success':
+            histogram = self.round_trip.get(name)
+            if histogram == None:
+                histogram = [0] * (len(BUCKETS_S) + 2)
+                self.round_trip[name] = histogram
+            seconds = result['round_trip_ms'] / 1000
+            histogram[bisect_left(BUCKETS_S, seconds)] += 1
+            histogram[-1] += seconds
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsExporter():
+    # Collects metrics from a test's results and publishes them until the test ends
+
+    def __init__(self, options, config):
+        self.options = options
+        self.labels = {'test_name': config['test_name'], 'run_id': config['stats']['run_id']}
+        self.local = threading.local()
+        # Every thread's shard. Only changed when a thread records its first result.
+        self.shards = []
+        self.shards_lock = threading.Lock()
+        self.executors = []
+        self.server = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.export, daemon=True)
+
+    def watch(self, executor):
+        # The executor's in flight counter is read on every scrape
+        self.executors.append(executor)
+
+    def record(self, result):
+        shard = getattr(self.local, 'shard', None)
+        if shard == None:
+            shard = MetricShard()
+            self.local.shard = shard
+            with self.shards_lock:
+                self.shards.append(shard)
+        shard.record(result)
+
+    def totals(self):
+        # Adds up the shards. Each shard's dicts are copied in one step, so threads can keep recording.
+        queries = {}
+        download_bytes = {}
+        round_trip = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key, count in list(shard.queries.items()):
+                queries[key] = queries.get(key, 0) + count
+            for name, count in list(shard.download_bytes.items()):
+                download_bytes[name] = download_bytes.get(name, 0) + count
+            for name, histogram in list(shard.round_trip.items()):
+                total = round_trip.setdefault(name, [0] * len(histogram))
+                for index in range(0, len(histogram)):
+                    total[index] += histogram[index]
+        return queries, download_bytes, round_trip
+
+    def expose(self, openmetrics=False):
+        queries, download_bytes, round_trip = self.totals()
+        lines = []
+
+        def family(name, type, help):
+            # OpenMetrics names a counter family without the _total of its samples
+            family_name = name[:-len('_total')] if openmetrics and type == 'counter' else name
+            lines.append(f'# HELP {family_name} {help}')
+            lines.append(f'# TYPE {family_name} {type}')
+
+        def sample(name, labels, value):
+            lines.append(name + format_labels(dict(self.labels, **labels)) + ' ' + format_value(value))
+
+        family('rsload_queries_total', 'counter', 'Queries completed, by status')
+        for (name, status), count in sorted(queries.items()):
+            sample('rsload_queries_total', {'query': name, 'status': status}, count)
+
+        # Remote workers of a distributed test aren't watched, so their queries in flight aren't known here
+        if len(self.executors) > 0:
+            family('rsload_queries_in_flight', 'gauge', 'Queries sent and not yet answered')
+            sample('rsload_queries_in_flight', {}, sum(executor.in_flight.value for executor in self.executors))
+
+        family('rsload_download_bytes_total', 'counter', 'Bytes of query responses downloaded')
+        for name, count in sorted(download_bytes.items()):
+            sample('rsload_download_bytes_total', {'query': name}, count)
+
+        family('rsload_round_trip_seconds', 'histogram', 'Round trip latency of successful queries')
+        for name, histogram in sorted(round_trip.items()):
+            cumulative = 0
+            for index in range(0, len(BUCKETS_S)):
+                cumulative += histogram[index]
+                sample('rsload_round_trip_seconds_bucket', {'query': name, 'le': format_value(float(BUCKETS_S[index]))}, cumulative)
+            cumulative += histogram[len(BUCKETS_S)]
+            sample('rsload_round_trip_seconds_bucket', {'query': name, 'le': '+Inf'}, cumulative)
+            sample('rsload_round_trip_seconds_sum', {'query': name}, round(histogram[-1], 6))
+            sample('rsload_round_trip_seconds_count', {'query': name}, cumulative)
+
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self):
+        # Written to a temporary file first so that readers never see half of it
+        path = self.options['metrics_file']
+        with open(path + '.tmp', 'wt') as file:
+            file.write(self.expose())
+        os.replace(path + '.tmp', path)
+
+    def export(self):
+        while not self.stopping.wait(self.options['metrics_interval']):
+            self.write_file()
+
+    def start(self):
+        if self.options['metrics_port'] > 0:
+            self.server = MetricsServer(self.options['metrics_host'], self.options['metrics_port'], self)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.options['metrics_file'] != None:
+            self.thread.start()
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.options['metrics_file'] != None:
+            self.stopping.set()
+            self.thread.join()
+            # The final counts
+            self.write_file()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        # Scrapers that ask for OpenMetrics get it, everything else gets the Prometheus text format
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        data = self.server.exporter.expose(openmetrics).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host, port, exporter):
+        super().__init__((host, port), MetricsHandler)
+        self.exporter = exporter
@@ -0,0 +1,117 @@
+import threading
+from histograms import ResultStats
+from results import ResultTable
+
+# A test either has a single list of queries or a mix of named query sets that run at the same time. Each
+# query set in a mix takes a share of the load in proportion to its weight, unless it has its own rate, and
+# can use its own execution mode.
+
+SET_TARGET_KEYS = ['execution_mode', 'async', 'connections', 'response_mode', 'retry', 'admission']
+
+def get_query_sets(config):
+    if not 'query_sets' in config or not config['query_sets']:
+        return [{'name': None, 'queries': config['queries'], 'target': config['target'], 'weight': 1}]
+
+    query_sets = []
+    for x in range(0, len(config['query_sets'])):
+        query_set = dict(config['query_sets'][x])
+        if not 'name' in query_set:
+            query_set['name'] = f'set {x + 1}'
+        if not 'queries' in query_set or not query_set['queries']:
+            raise ValueError(f"Query set {query_set['name']} has no queries")
+        if not 'weight' in query_set:
+            query_set['weight'] = 1
+
+        # Target settings given on the query set apply to its queries only
+        target = dict(config['target'])
+        for key in SET_TARGET_KEYS:
+            if key in query_set:
+                target[key] = query_set[key]
+        query_set['target'] = target
+        query_sets.append(query_set)
+    return query_sets
+
+def get_share(query_sets, query_set):
+    # The query set's share of the load among the query sets that don't have a rate of their own
+    weights = sum(each['weight'] for each in query_sets if not 'rate' in each)
+    if 'rate' in query_set or weights <= 0:
+        return 0
+    return query_set['weight'] / weights
+
+def get_set_qps_config(qps_config, query_sets, query_set):
+    # The arrival schedule settings for one query set: its own rate for the whole test, or its share of every stage
+    set_config = dict(qps_config)
+    if 'rate' in query_set:
+        set_config['rate'] = query_set['rate']
+        set_config['duration'] = get_duration(qps_config)
+        set_config.pop('stages', None)
+        return set_config
+
+    share = get_share(query_sets, query_set)
+    if 'stages' in qps_config and qps_config['stages']:
+        set_config['stages'] = [dict(stage, rate=stage['rate'] * share) for stage in qps_config['stages']]
+    else:
+        set_config['rate'] = qps_config['rate'] * share
+    return set_config
+
+def get_duration(qps_config):
+    if 'stages' in qps_config and qps_config['stages']:
+        return sum(stage['duration'] for stage in qps_config['stages'])
+    return qps_config['duration']
+
+def get_set_user_settings(user_settings, query_sets, query_set):
+    # Virtual users are split between the query sets by weight, unless a query set has its own user count
+    settings = dict(user_settings)
+    if 'users' in query_set:
+        settings['count'] = query_set['users']
+        # Set by the coordinator of a distributed test, see get_user_settings
+        settings['offset'] = query_set['user_offset'] if 'user_offset' in query_set else 0
+        settings['total'] = query_set['total_users'] if 'total_users' in query_set else settings['count']
+    elif len(query_sets) > 1:
+        weights = sum(each['weight'] for each in query_sets if not 'users' in each)
+        settings['count'] = max(1, round(user_settings['count'] * query_set['weight'] / weights))
+        settings['offset'] = 0
+        settings['total'] = settings['count']
+    return settings
+
+def get_set_iterations(iterations, query_set):
+    if 'iterations' in query_set:
+        return query_set['iterations']
+    return iterations
+
+def run_concurrently(runs):
+    # Calls every run at the same time, one thread each, and combines their results. The executors started
+    # by each run have their own worker processes.
+    if len(runs) == 1:
+        return runs[0]()
+
+    results = [None] * len(runs)
+    errors = []
+
+    def run(x):
+        try:
+            results[x] = runs[x]()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(x,)) for x in range(0, len(runs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return combine_results(results)
+
+def combine_results(results_list):
+    if None in results_list:
+        return None
+    combined = {'query_results': ResultTable(), 'stats': ResultStats()}
+    for results in results_list:
+        combined['query_results'].extend(results['query_results'])
+        combined['stats'].merge(results['stats'])
+        # The query sets run side by side, so the test lasts as long as the longest of them
+        for key in ['elapsed_s', 'issue_s', 'max_dispatch_lag_ms']:
+            if key in results:
+                combined[key] = max(combined.get(key, 0), results[key])
+    return combined
@@ -0,0 +1,213 @@
+import argparse, json, random, threading, time, uuid
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the parts of the Rockset API that rockset-load calls. It has no data; every query
+# returns generated rows after a simulated latency, and can be told to time out or reject a share of them.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mock Rockset API server for testing rockset-load.')
+    parser.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='port to listen on', type=int, default=8080)
+    add_mock_arguments(parser)
+    return vars(parser.parse_args())
+
+def add_mock_arguments(parser):
+    parser.add_argument('--latency', help='latency distribution: constant, uniform, exponential or lognormal', default='constant')
+    parser.add_argument('--latency_ms', help='mean (median for lognormal) server latency in ms', type=float, default=0)
+    parser.add_argument('--latency_spread', help='spread of the latency: half width for uniform, sigma for lognormal', type=float, default=0.5)
+    parser.add_argument('--rows', help='number of rows returned by each query', type=int, default=10)
+    parser.add_argument('--row_bytes', help='approximate size in bytes of each row', type=int, default=100)
+    parser.add_argument('--timeout_rate', help='fraction of queries answered with 408', type=float, default=0)
+    parser.add_argument('--exhausted_rate', help='fraction of queries answered with 429', type=float, default=0)
+    parser.add_argument('--max_concurrency', help='queries in flight beyond this are answered with 429 (0 = unlimited)', type=int, default=0)
+    parser.add_argument('--retry_after_s', help='Retry-After header sent with 429 responses (0 = none)', type=float, default=0)
+    parser.add_argument('--page_latency_ms', help='server latency in ms of each page fetched from a paginated query', type=float, default=0)
+
+def get_mock_settings(overrides=None):
+    settings = {
+        'latency': 'constant', 'latency_ms': 0, 'latency_spread': 0.5, 'rows': 10, 'row_bytes': 100,
+        'timeout_rate': 0, 'exhausted_rate': 0, 'max_concurrency': 0, 'page_latency_ms': 0, 'retry_after_s': 0
+    }
+    if overrides != None:
+        settings.update(overrides)
+    return settings
+
+def sample_latency_ms(settings, rng):
+    latency = settings['latency']
+    mean = settings['latency_ms']
+    spread = settings['latency_spread']
+    if latency == 'constant':
+        return mean
+    elif latency == 'uniform':
+        return max(0, rng.uniform(mean - spread, mean + spread))
+    elif latency == 'exponential':
+        return rng.expovariate(1 / mean) if mean > 0 else 0
+    elif latency == 'lognormal':
+        return rng.lognormvariate(0, spread) * mean
+    raise ValueError(f'Unexpected latency distribution {latency}')
+
+class MockRocksetHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, like the real API
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so without TCP_NODELAY a reused connection stalls on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        if status == 429 and self.server.settings['retry_after_s'] > 0:
+            self.send_header('Retry-After', str(self.server.settings['retry_after_s']))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/v1/orgs/self/queries/') and '/pages/' in self.path:
+            self.read_page()
+        elif self.path == '/v1/orgs/self/virtualinstances':
+            self.send_json(200, {'data': [{'current_type': 'MOCK'}]})
+        elif self.path == '/v1/orgs/self/settings':
+            self.send_json(200, {'data': {
+                'aggregator_parallelism': 1,
+                'concurrent_queries_limit': self.server.settings['max_concurrency'],
+                'concurrent_query_execution_limit': self.server.settings['max_concurrency']
+            }})
+        else:
+            self.send_json(404, {'message': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+
+        if self.path == '/v1/orgs/self/queries':
+            self.run_query(request)
+        elif self.path.startswith('/v1/orgs/self/ws/') and '/lambdas/' in self.path:
+            self.run_query(request)
+        else:
+            self.send_json(404, {'message': f'Unknown path {self.path}'})
+
+    def run_query(self, request):
+        server = self.server
+        settings = server.settings
+        if not server.enter():
+            self.send_json(429, {'message': 'Resources exhausted'})
+            return
+        try:
+            draw = server.rng.random()
+            if draw < settings['timeout_rate']:
+                self.send_json(408, {'message': 'Query timed out'})
+                return
+            if draw < settings['timeout_rate'] + settings['exhausted_rate']:
+                self.send_json(429, {'message': 'Resources exhausted'})
+                return
+
+            latency_ms = sample_latency_ms(settings, server.rng)
+            time.sleep(latency_ms / 1000)
+
+            rows = settings['rows']
+            sql = request.get('sql', {})
+            if 'HINT(final_aggregator_drop_results=true)' in sql.get('query', ''):
+                rows = 0
+
+            # Fields are in the same order as in Rockset responses, with the results ahead of the stats
+            response = {'query_id': str(uuid.uuid4())}
+            if sql.get('paginate'):
+                # Cursors are the total row count and a position, so pages can be served without keeping any state
+                initial = min(rows, sql.get('initial_paginate_response_doc_count', 0))
+                response['results'] = server.results(initial)
+                pagination = {'start_cursor': f'{rows}.0', 'next_cursor': f'{rows}.{initial}' if initial < rows else None}
+            else:
+                response['results'] = server.results(rows)
+                pagination = None
+            response['stats'] = {'elapsed_time_ms': round(latency_ms), 'throttled_time_micros': 0}
+            response['results_total_doc_count'] = rows
+            response['pagination'] = pagination
+            self.send_json(200, response)
+        finally:
+            server.leave()
+
+    def read_page(self):
+        server = self.server
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        try:
+            total, position = [int(part) for part in url.path.rsplit('/', 1)[1].split('.')]
+            docs = int(params['docs'][0]) if 'docs' in params else 100
+            offset = int(params['offset'][0]) if 'offset' in params else 0
+        except (ValueError, IndexError):
+            self.send_json(400, {'message': f'Invalid cursor {self.path}'})
+            return
+        if not server.enter():
+            self.send_json(429, {'message': 'Resources exhausted'})
+            return
+        try:
+            time.sleep(server.settings['page_latency_ms'] / 1000)
+            first = min(total, position + offset)
+            last = min(total, first + docs)
+            self.send_json(200, {
+                'results': server.results(last - first),
+                'results_total_doc_count': total,
+                'pagination': {
+                    'start_cursor': f'{total}.{first}',
+                    'next_cursor': f'{total}.{last}' if last < total else None,
+                    'current_page_doc_count': last - first
+                }
+            })
+        finally:
+            server.leave()
+
+class MockRocksetServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host, port, settings):
+        super().__init__((host, port), MockRocksetHandler)
+        self.settings = settings
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.served = 0
+        self.row = {'id': 0, 'payload': 'x' * max(0, settings['row_bytes'] - 20)}
+
+    def enter(self):
+        with self.lock:
+            if self.settings['max_concurrency'] > 0 and self.in_flight >= self.settings['max_concurrency']:
+                return False
+            self.in_flight += 1
+            self.served += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def results(self, rows):
+        return [self.row] * rows
+
+    def start(self):
+        # Serve from a background thread, e.g. while a benchmark runs in the same process
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def url(self):
+        host, port = self.server_address[0:2]
+        return f'http://{host}:{port}'
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    server = MockRocksetServer(options['host'], options['port'], get_mock_settings(options))
+    print(f'Mock Rockset server listening on {server.url()}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,4 +1,5 @@
 import os, csv
+from histograms import ALL_QUERIES, PERCENTILES, PHASES
 
 def validate_history_dir(options):
     output_dir = options['output_dir']
@@ -7,64 +8,117 @@ def validate_history_dir(options):
     if not history_exists:
         os.makedirs(output_dir)
 
-def log_query_results(options, config, query_results):
+def prepare_history_file(file_path, headers):
+    # Writes the headers if the file doesn't exist yet. History files are only ever appended to, so a file
+    # written with other headers, e.g. by an earlier version with fewer columns, is moved aside to
+    # <name>.<n>.csv rather than getting lines that don't match its header.
+    if os.path.exists(file_path):
+        with open(file_path, newline='') as existing:
+            if next(csv.reader(existing), None) == headers:
+                return
+        stem, extension = os.path.splitext(file_path)
+        version = 1
+        while os.path.exists(f'{stem}.{version}{extension}'):
+            version += 1
+        os.rename(file_path, f'{stem}.{version}{extension}')
+    with open(file_path, 'wt') as new_file:
+        writer = csv.writer(new_file, delimiter = ',')
+        writer.writerow(headers)
+
+def create_details_file(options):
+    # Returns the path of the details file, writing the headers if it doesn't exist yet
     validate_history_dir(options)
     output_dir = options['output_dir']
     # Make sure the history files exists
     file_name = options['details_name']
     file_path = output_dir + '/' + file_name
-    file_exists = os.path.exists(file_path)
-    if not file_exists:
-        headers = [
-            'test_name', 'run_id', 'test_start', 'query_name', 'query_num', 'status', 'round_trip_ms', 'server_ms', 'queued_ms', 'query_ms', 'network_ms', 'row_count',
-            'vi_size', 'agg_par', 'cqel', 'cel',
-            'error'
-        ]
-        with open(file_path, 'wt') as new_details:
-            writer = csv.writer(new_details, delimiter = ',')
-            writer.writerow(headers)
+    headers = [
+        'test_name', 'run_id', 'test_start', 'query_name', 'query_num', 'status', 'round_trip_ms', 'server_ms', 'queued_ms', 'query_ms', 'network_ms', 'row_count',
+        'vi_size', 'agg_par', 'cqel', 'cel',
+        'error', 'new_connection', 'user_num', 'iteration', 'download_bytes', 'decode_ms',
+        'page_count', 'first_page_ms', 'drain_ms', 'attempts', 'backoff_ms', 'admission_ms', 'query_set'
+    ] + PHASES + ['worker']
+    prepare_history_file(file_path, headers)
+    return file_path
 
-    test_name = config['test_name']
-    run_id = config['stats']['run_id']
-    test_start = config['stats']['test_start']
+def format_query_result(config, result):
+    line = []
+    line.append(config['test_name'])
+    line.append(config['stats']['run_id'])
+    line.append(config['stats']['test_start'])
+    line.append(result['name'])
+    line.append(result['query_num'])
+    line.append(result['status'])
+    if result['status'] == 'success':
+        line.append(result['round_trip_ms'])
+        line.append(result['server_ms'])
+        line.append(result['queued_ns'])
+        line.append(result['query_ms'])
+        line.append(result['network_ms'])
+        if result['row_count'] == 'dropped':
+            line.append(None)
+        else:
+            line.append(result['row_count'])
+    else: # non successful query
+        line.extend([None,None,None,None,None,None])
+
+    line.append(config['target']['vi_size'])
+    line.append(config['target']['aggregator_parallelism'])
+    line.append(config['target']['concurrent_query_execution_limit'])            
+    line.append(config['target']['concurrent_queries_limit'])
+
+    if result['status'] == 'error':
+        line.append(result['message'])
+    elif result['status'] == 'timeout':
+        line.append( 'Query timed out')
+    elif result['status'] == 'exhausted':
+        line.append( 'Resoruces exhausted')
+    else:
+        line.append(None)
+
+    if 'new_connection' in result:
+        line.append(result['new_connection'])
+    else:
+        line.append(None)
+    line.append(result['user_num'])
+    if 'iteration' in result:
+        line.append(result['iteration'])
+    else:
+        line.append(None)
+    if result['status'] == 'success':
+        line.append(result['download_bytes'])
+        line.append(result['decode_ms'])
+    else:
+        line.extend([None, None])
+    if result['status'] == 'success' and 'page_count' in result:
+        line.append(result['page_count'])
+        line.append(result['first_page_ms'])
+        line.append(result['drain_ms'])
+    else:
+        line.extend([None, None, None])
+    if 'attempts' in result:
+        line.append(result['attempts'])
+        line.append(result['backoff_ms'])
+        line.append(result['admission_ms'])
+    else:
+        line.extend([None, None, None])
+    # Only the queries of a mix of query sets are tagged with their query set
+    line.append(result['query_set'] if 'query_set' in result else None)
+    # Phases are timed for every query that got a response, whatever its status
+    for phase in PHASES:
+        line.append(result[phase] if phase in result else None)
+    # Which worker of a distributed test ran the query
+    line.append(result['worker'] if 'worker' in result else None)
+    return line
+
+def log_query_results(options, config, query_results):
+    file_path = create_details_file(options)
 
     # Add detail records to the details file
     with open(file_path, 'at') as new_details:
         writer = csv.writer(new_details, delimiter = ',')
         for result in query_results['query_results']:
-            line = []
-            line.append(test_name)
-            line.append(run_id)
-            line.append(test_start)
-            # Need to add query set identification
-            line.append(result['name'])
-            line.append(result['query_num'])
-            line.append(result['status'])
-            if result['status'] == 'success':
-                line.append(result['round_trip_ms'])
-                line.append(result['server_ms'])
-                line.append(result['queued_ns'])
-                line.append(result['query_ms'])
-                line.append(result['network_ms'])
-                if result['row_count'] == 'dropped':
-                    line.append(None)
-                else:
-                    line.append(result['row_count'])
-            else: # non successful query
-                line.extend([None,None,None,None,None,None])
-
-            line.append(config['target']['vi_size'])
-            line.append(config['target']['aggregator_parallelism'])
-            line.append(config['target']['concurrent_query_execution_limit'])            
-            line.append(config['target']['concurrent_queries_limit'])
-
-            if result['status'] == 'error':
-                line.append(result['message'])
-            elif result['status'] == 'timeout':
-                line.append( 'Query timed out')
-            elif result['status'] == 'exhausted':
-                line.append( 'Resoruces exhausted')
-            writer.writerow(line)
+            writer.writerow(format_query_result(config, result))
 
 def log_qs_summary(options, config, summary):
     validate_history_dir(options)
@@ -73,15 +127,14 @@ def log_qs_summary(options, config, summary):
     # Make sure the history files exists
     file_name = options['qs_summary_name'] 
     file_path = output_dir + '/' + file_name
-    file_exists = os.path.exists(file_path)
-    if not file_exists:
-        headers = [
-            'test_name', 'run_id','test_start', 'clean', 'total_ms', 'query_ms', 'queued_ms', 'network_ms',
-            'vi_size', 'agg_par', 'cqel', 'cel'
-        ]
-        with open(file_path, 'wt') as new_summary:
-            writer = csv.writer(new_summary, delimiter = ',')
-            writer.writerow(headers)
+    headers = [
+        'test_name', 'run_id','test_start', 'clean', 'total_ms', 'query_ms', 'queued_ms', 'network_ms',
+        'vi_size', 'agg_par', 'cqel', 'cel', 'new_connections', 'reused_connections',
+        'count', 'successes', 'elapsed_s', 'throughput_qps',
+        'round_trip_p50_ms', 'round_trip_p90_ms', 'round_trip_p99_ms', 'round_trip_p99.9_ms', 'round_trip_max_ms',
+        'download_bytes', 'decode_ms', 'attempts', 'retries', 'backoff_ms', 'admission_ms', 'details_dropped'
+    ]
+    prepare_history_file(file_path, headers)
 
     test_name = config['test_name']
     run_id = config['stats']['run_id']
@@ -104,5 +157,164 @@ def log_qs_summary(options, config, summary):
         line.append(config['target']['aggregator_parallelism'])
         line.append(config['target']['concurrent_query_execution_limit'])            
         line.append(config['target']['concurrent_queries_limit'])
+        line.append(summary['new_connections'])
+        line.append(summary['reused_connections'])
+        line.append(summary['count'])
+        line.append(summary['successes'])
+        line.append(summary['elapsed_s'])
+        line.append(summary['throughput_qps'])
+        if 'round_trip_ms' in summary['latency'].get(ALL_QUERIES, {}):
+            round_trip = summary['latency'][ALL_QUERIES]['round_trip_ms']
+            for pct in PERCENTILES:
+                line.append(round_trip[f'p{pct}'])
+            line.append(round_trip['max'])
+        else:
+            line.extend([None] * (len(PERCENTILES) + 1))
+        line.append(summary['download_bytes'])
+        line.append(summary['decode_ms'])
+        line.append(summary['attempts'])
+        line.append(summary['retries'])
+        line.append(summary['backoff_ms'])
+        line.append(summary['admission_ms'])
+        line.append(summary['details_dropped'])
+
+        writer.writerow(line)
+
+    log_latency_summaries(options, config, summary)
+    if len(summary['query_sets']) > 0:
+        log_query_set_summaries(options, config, summary)
+
+def log_query_set_summaries(options, config, summary):
+    validate_history_dir(options)
+    output_dir = options['output_dir']
+
+    # One line per query set of a mix. Their latency percentiles for every metric are in the latency summaries,
+    # under the query name '<query set>/*'
+    file_path = output_dir + '/' + options['query_set_summary_name']
+    headers = ['test_name', 'run_id', 'test_start', 'query_set', 'count', 'successes', 'share', 'throughput_qps']
+    headers.extend([f'round_trip_p{pct}_ms' for pct in PERCENTILES])
+    headers.append('round_trip_max_ms')
+    prepare_history_file(file_path, headers)
+
+    with open(file_path, 'at') as new_details:
+        writer = csv.writer(new_details, delimiter = ',')
+        for query_set in summary['query_sets']:
+            line = [config['test_name'], config['stats']['run_id'], config['stats']['test_start']]
+            line.extend([query_set['name'], query_set['count'], query_set['successes'], query_set['share'], query_set['throughput_qps']])
+            round_trip = query_set['round_trip']
+            for pct in PERCENTILES:
+                line.append(round_trip[f'p{pct}'])
+            line.append(round_trip['max'])
+            writer.writerow(line)
+
+def log_latency_summaries(options, config, summary):
+    validate_history_dir(options)
+    output_dir = options['output_dir']
+
+    # One line per query name and metric, with ALL_QUERIES covering every query
+    file_name = options['latency_summary_name']
+    file_path = output_dir + '/' + file_name
+    headers = ['test_name', 'run_id', 'test_start', 'query_name', 'metric', 'count', 'mean_ms']
+    headers.extend([f'p{pct}_ms' for pct in PERCENTILES])
+    headers.append('max_ms')
+    prepare_history_file(file_path, headers)
+
+    test_name = config['test_name']
+    run_id = config['stats']['run_id']
+    test_start = config['stats']['test_start']
+
+    with open(file_path, 'at') as new_details:
+        writer = csv.writer(new_details, delimiter = ',')
+        for name, metrics in summary['latency'].items():
+            for metric, metric_summary in metrics.items():
+                line = []
+                line.append(test_name)
+                line.append(run_id)
+                line.append(test_start)
+                line.append(name)
+                line.append(metric)
+                line.append(metric_summary['count'])
+                line.append(metric_summary['mean'])
+                for pct in PERCENTILES:
+                    line.append(metric_summary[f'p{pct}'])
+                line.append(metric_summary['max'])
+                writer.writerow(line)
+
+def log_qps_summary(options, config, summary):
+    validate_history_dir(options)
+    output_dir = options['output_dir']
+
+    # Make sure the history files exists
+    file_name = options['qps_summary_name']
+    file_path = output_dir + '/' + file_name
+    headers = [
+        'test_name', 'run_id', 'test_start', 'planned_s', 'elapsed_s', 'scheduled', 'completed', 'successes',
+        'offered_qps', 'issued_qps', 'achieved_qps', 'lag_p50_ms', 'lag_p99_ms', 'lag_max_ms', 'max_dispatch_lag_ms',
+        'vi_size', 'agg_par', 'cqel', 'cel'
+    ]
+    prepare_history_file(file_path, headers)
+
+    test_name = config['test_name']
+    run_id = config['stats']['run_id']
+    test_start = config['stats']['test_start']
+
+    with open(file_path, 'at') as new_details:
+        writer = csv.writer(new_details, delimiter = ',')
+        line = []
+        line.append(test_name)
+        line.append(run_id)
+        line.append(test_start)
+        line.append(summary['planned_s'])
+        line.append(summary['elapsed_s'])
+        line.append(summary['scheduled'])
+        line.append(summary['completed'])
+        line.append(summary['successes'])
+        line.append(summary['offered_qps'])
+        line.append(summary['issued_qps'])
+        line.append(summary['achieved_qps'])
+        line.append(summary['lag_p50_ms'])
+        line.append(summary['lag_p99_ms'])
+        line.append(summary['lag_max_ms'])
+        line.append(summary['max_dispatch_lag_ms'])
+        line.append(config['target']['vi_size'])
+        line.append(config['target']['aggregator_parallelism'])
+        line.append(config['target']['concurrent_query_execution_limit'])
+        line.append(config['target']['concurrent_queries_limit'])
 
         writer.writerow(line)
+
+def log_capacity_summary(options, config, summary):
+    validate_history_dir(options)
+    output_dir = options['output_dir']
+    target = config['target']
+    test_name = config['test_name']
+    run_id = config['stats']['run_id']
+    test_start = config['stats']['test_start']
+
+    # One line for each capacity search
+    file_path = output_dir + '/' + options['capacity_summary_name']
+    headers = [
+        'test_name', 'run_id', 'test_start', 'vi_size', 'agg_par', 'cqel', 'cel', 'p99_slo_ms', 'max_exhausted_rate',
+        'search', 'max_qps', 'achieved_qps', 'p99_ms', 'exhausted_rate', 'steps', 'stop_reason'
+    ]
+    prepare_history_file(file_path, headers)
+
+    with open(file_path, 'at') as new_details:
+        writer = csv.writer(new_details, delimiter = ',')
+        writer.writerow([
+            test_name, run_id, test_start, target['vi_size'], target['aggregator_parallelism'],
+            target['concurrent_query_execution_limit'], target['concurrent_queries_limit'],
+            summary['p99_slo_ms'], summary['max_exhausted_rate'], summary['search'], summary['max_qps'],
+            summary['achieved_qps'], summary['p99_ms'], summary['exhausted_rate'], len(summary['steps']), summary['stop_reason']
+        ])
+
+    # One line for each step of the search
+    file_path = output_dir + '/' + options['capacity_steps_name']
+    step_columns = ['offered_qps', 'achieved_qps', 'count', 'p99_ms', 'exhausted_rate', 'error_rate', 'lag_p99_ms', 'outcome']
+    prepare_history_file(file_path, ['test_name', 'run_id', 'step'] + step_columns)
+
+    with open(file_path, 'at') as new_details:
+        writer = csv.writer(new_details, delimiter = ',')
+        for x in range(0, len(summary['steps'])):
+            step = summary['steps'][x]
+            writer.writerow([test_name, run_id, x + 1] + [step[column] for column in step_columns])
@@ -0,0 +1,48 @@
+import json
+from connections import get_base_url
+
+# A paginated query returns its first page, if any, with the query response. The rest of the result set is
+# read from the query's pages endpoint, either by following next_cursor from page to page or, when pages
+# are pipelined, by requesting every remaining page up front as an offset from start_cursor.
+
+def get_page_settings(query):
+    settings = {'page_size': 1000, 'page_pipeline': 1}
+    if 'initial_paginate_response_doc_count' in query:
+        settings['page_size'] = query['initial_paginate_response_doc_count']
+    for key in settings:
+        if key in query:
+            settings[key] = query[key]
+    settings['page_size'] = max(1, settings['page_size'])
+    settings['page_pipeline'] = max(1, settings['page_pipeline'])
+    return settings
+
+def get_pagination(response_data):
+    # Returns what is needed to fetch the remaining pages of a query response, or None if it isn't paginated
+    if response_data.get('pagination') == None or not 'query_id' in response_data:
+        return None
+    pagination = response_data['pagination']
+    return {
+        'query_id': response_data['query_id'],
+        'start_cursor': pagination.get('start_cursor'),
+        'next_cursor': pagination.get('next_cursor'),
+        'fetched': len(response_data['results']),
+        'total': response_data.get('results_total_doc_count')
+    }
+
+def get_page_url(target, query_id, cursor, docs, offset=0):
+    url = get_base_url(target) + f'/v1/orgs/self/queries/{query_id}/pages/{cursor}?docs={docs}'
+    if offset > 0:
+        url += f'&offset={offset}'
+    return url
+
+def get_page_offsets(pagination, page_size):
+    # Offsets from start_cursor of every page after those already fetched
+    if pagination['start_cursor'] == None or pagination['total'] == None:
+        return []
+    return list(range(pagination['fetched'], pagination['total'], page_size))
+
+def read_page(body):
+    # Returns the number of rows in a page and the cursor of the page after it
+    page_data = json.loads(body)
+    pagination = page_data.get('pagination') or {}
+    return len(page_data['results']), pagination.get('next_cursor')
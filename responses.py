@@ -0,0 +1,77 @@
+import json, re
+from pagination import get_pagination
+
+# Rockset writes the query results before the stats and the other small top level fields, so in the light
+# response mode only the end of the body is kept while it is read, and searched. Quotes inside result values
+# are escaped, so the last unescaped "stats": key in the body belongs to the top level object.
+TAIL_BYTES = 65536
+STATS_KEY = b'"stats":'
+DOC_COUNT = re.compile(rb'"results_total_doc_count":\s*(\d+)')
+# Group 1 is only set when the response isn't paginated
+PAGINATION = re.compile(rb'"pagination":\s*(null)?')
+
+RESPONSE_MODES = ['full', 'light']
+
+decoder = json.JSONDecoder()
+
+def get_response_mode(target):
+    mode = 'full'
+    if 'response_mode' in target:
+        mode = target['response_mode']
+    if mode not in RESPONSE_MODES:
+        raise ValueError(f'Unexpected response mode {mode}')
+    return mode
+
+def keep_tail(tail, chunk):
+    # Adds a chunk of the body to a bytearray holding the end of it. Bytes are only dropped once there are
+    # twice as many as are kept, so the tail isn't copied for every chunk.
+    tail += chunk
+    if len(tail) > 2 * TAIL_BYTES:
+        del tail[:-TAIL_BYTES]
+
+def read_body(chunks, tail_only=False):
+    # Returns the body and its size. With tail_only only the last TAIL_BYTES are kept, so however large
+    # the response is, it is never held in memory.
+    if not tail_only:
+        body = b''.join(chunks)
+        return body, len(body)
+    tail = bytearray()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        keep_tail(tail, chunk)
+    return bytes(tail[-TAIL_BYTES:]), size
+
+def scan_response(body):
+    # Returns the stats and the number of rows without decoding the rows, or None if the tail of the body
+    # doesn't contain both
+    tail_start = max(0, len(body) - TAIL_BYTES)
+    stats_at = body.rfind(STATS_KEY, tail_start)
+    if stats_at < 0:
+        return None
+    tail = body[stats_at + len(STATS_KEY):]
+
+    # A paginated response only holds part of the results, so the total count isn't the number of rows
+    count = DOC_COUNT.search(tail)
+    pagination = PAGINATION.search(tail)
+    if count == None or (pagination != None and pagination.group(1) == None):
+        return None
+
+    try:
+        stats, end = decoder.raw_decode(tail.decode().lstrip())
+    except ValueError:
+        return None
+    return stats, int(count.group(1))
+
+def summarize_response(body, response_mode, complete=True):
+    # Returns the stats block, the number of rows and the pagination, if any, of a successful query response.
+    # body isn't complete when only its tail was kept.
+    if response_mode == 'light':
+        summary = scan_response(body)
+        if summary != None:
+            stats, row_count = summary
+            return stats, row_count, None
+        if not complete:
+            raise ValueError(f"The response can't be summarized from its last {TAIL_BYTES} bytes")
+    response_data = json.loads(body)
+    return response_data['stats'], len(response_data['results']), get_pagination(response_data)
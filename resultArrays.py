@@ -0,0 +1,211 @@
+import os, json
+from array import array
+import numpy as np
+from histograms import PERCENTILES, PHASES
+
+# Columnar result files hold one run each. Values that are the same for the whole run are stored once as
+# metadata and every per query value is a fixed width numeric column. Strings (query names, query sets,
+# statuses and error messages) are interned and stored as integer codes into a table kept in the metadata.
+
+STATUSES = ['success', 'error', 'timeout', 'exhausted', 'invalid']
+
+# column name, array typecode, numpy dtype
+COLUMNS = [
+    ('query_name', 'h', np.int16),
+    ('query_num', 'i', np.int32),
+    ('user_num', 'i', np.int32),
+    ('iteration', 'i', np.int32),
+    ('status', 'b', np.int8),
+    ('round_trip_ms', 'f', np.float32),
+    ('server_ms', 'f', np.float32),
+    ('queued_ms', 'f', np.float32),
+    ('query_ms', 'f', np.float32),
+    ('network_ms', 'f', np.float32),
+    ('lag_ms', 'f', np.float32),
+    ('offset_s', 'd', np.float64),
+    ('row_count', 'q', np.int64),
+    ('new_connection', 'b', np.int8),
+    ('message', 'i', np.int32),
+    ('download_bytes', 'q', np.int64),
+    ('decode_ms', 'f', np.float32),
+    ('page_count', 'i', np.int32),
+    ('first_page_ms', 'f', np.float32),
+    ('drain_ms', 'f', np.float32),
+    ('attempts', 'h', np.int16),
+    ('backoff_ms', 'f', np.float32),
+    ('admission_ms', 'f', np.float32),
+    ('query_set', 'h', np.int16)
+] + [(phase, 'f', np.float32) for phase in PHASES] + [('worker', 'h', np.int16)]
+
+NAN = float('nan')
+
+def get_runs_dir(options):
+    return options['output_dir'] + '/runs'
+
+def get_run_path(options, run_id):
+    return get_runs_dir(options) + '/' + str(run_id) + '.npz'
+
+class ResultArrayWriter():
+    # Collects results into typed arrays as they arrive and saves them as a compressed NumPy file when closed
+
+    def __init__(self, options, config):
+        self.options = options
+        self.config = config
+        self.columns = {}
+        for name, typecode, dtype in COLUMNS:
+            self.columns[name] = array(typecode)
+        self.names = {}
+        self.messages = {}
+        self.query_sets = {}
+
+    def intern(self, table, value):
+        if not value in table:
+            table[value] = len(table)
+        return table[value]
+
+    def add(self, result):
+        columns = self.columns
+        columns['query_name'].append(self.intern(self.names, result['name']))
+        columns['query_num'].append(result['query_num'])
+        columns['user_num'].append(result['user_num'])
+        columns['iteration'].append(result['iteration'] if 'iteration' in result else -1)
+        columns['status'].append(STATUSES.index(result['status']))
+        if result['status'] == 'success':
+            columns['round_trip_ms'].append(result['round_trip_ms'])
+            columns['server_ms'].append(result['server_ms'])
+            columns['queued_ms'].append(result['queued_ns']/1000)
+            columns['query_ms'].append(result['query_ms'])
+            columns['network_ms'].append(result['network_ms'])
+            columns['row_count'].append(-1 if result['row_count'] == 'dropped' else result['row_count'])
+            columns['download_bytes'].append(result['download_bytes'])
+            columns['decode_ms'].append(result['decode_ms'])
+        else:
+            for name in ['round_trip_ms', 'server_ms', 'queued_ms', 'query_ms', 'network_ms', 'decode_ms']:
+                columns[name].append(NAN)
+            columns['row_count'].append(-1)
+            columns['download_bytes'].append(-1)
+        if result['status'] == 'success' and 'page_count' in result:
+            columns['page_count'].append(result['page_count'])
+            columns['first_page_ms'].append(result['first_page_ms'])
+            columns['drain_ms'].append(result['drain_ms'])
+        else:
+            columns['page_count'].append(0)
+            columns['first_page_ms'].append(NAN)
+            columns['drain_ms'].append(NAN)
+        if 'attempts' in result:
+            columns['attempts'].append(result['attempts'])
+            columns['backoff_ms'].append(result['backoff_ms'])
+            columns['admission_ms'].append(result['admission_ms'])
+        else:
+            columns['attempts'].append(0)
+            columns['backoff_ms'].append(NAN)
+            columns['admission_ms'].append(NAN)
+        columns['query_set'].append(self.intern(self.query_sets, result['query_set']) if 'query_set' in result else -1)
+        for phase in PHASES:
+            columns[phase].append(result[phase] if phase in result else NAN)
+        columns['worker'].append(result['worker'] if 'worker' in result else -1)
+        columns['lag_ms'].append(result['lag_ms'] if 'lag_ms' in result else NAN)
+        columns['offset_s'].append(result['offset_s'] if 'offset_s' in result else NAN)
+        if 'new_connection' in result:
+            columns['new_connection'].append(1 if result['new_connection'] else 0)
+        else:
+            columns['new_connection'].append(-1)
+        if 'message' in result:
+            columns['message'].append(self.intern(self.messages, result['message']))
+        else:
+            columns['message'].append(-1)
+
+    def metadata(self):
+        target = self.config['target']
+        return {
+            'test_name': self.config['test_name'],
+            'run_id': str(self.config['stats']['run_id']),
+            'test_start': str(self.config['stats']['test_start']),
+            'vi_size': target['vi_size'],
+            'agg_par': target['aggregator_parallelism'],
+            'cqel': target['concurrent_query_execution_limit'],
+            'cel': target['concurrent_queries_limit'],
+            'query_names': list(self.names),
+            'statuses': STATUSES,
+            'messages': list(self.messages),
+            'query_sets': list(self.query_sets)
+        }
+
+    def close(self):
+        runs_dir = get_runs_dir(self.options)
+        if not os.path.exists(runs_dir):
+            os.makedirs(runs_dir)
+        arrays = {}
+        for name, typecode, dtype in COLUMNS:
+            arrays[name] = np.asarray(self.columns[name], dtype=dtype)
+        path = get_run_path(self.options, self.config['stats']['run_id'])
+        np.savez_compressed(path, metadata=np.array(json.dumps(self.metadata())), **arrays)
+        return path
+
+def load_run(path):
+    # Returns the run metadata and a dict of column arrays
+    with np.load(path) as data:
+        metadata = json.loads(str(data['metadata']))
+        columns = {}
+        for name, typecode, dtype in COLUMNS:
+            if name in data.files:
+                columns[name] = data[name]
+        # Files saved before a column was added don't have it, so it is filled with missing values
+        count = len(columns['status'])
+        for name, typecode, dtype in COLUMNS:
+            if not name in columns:
+                columns[name] = np.full(count, NAN if typecode in ['f', 'd'] else -1, dtype=dtype)
+    return metadata, columns
+
+def load_runs(options, test_name=None, run_ids=None):
+    # Loads many runs into one set of columns, adding a run column that indexes the returned metadata list.
+    # Query name and query set codes are remapped onto single tables shared by all the runs.
+    runs_dir = get_runs_dir(options)
+    if not os.path.exists(runs_dir):
+        return [], {}
+
+    if run_ids != None:
+        paths = [get_run_path(options, run_id) for run_id in run_ids]
+    else:
+        paths = sorted(runs_dir + '/' + file_name for file_name in os.listdir(runs_dir) if file_name.endswith('.npz'))
+
+    runs, parts, names, query_sets = [], [], {}, {}
+    for path in paths:
+        metadata, columns = load_run(path)
+        if test_name != None and metadata['test_name'] != test_name:
+            continue
+        remap = np.array([names.setdefault(name, len(names)) for name in metadata['query_names']], dtype=np.int16)
+        if len(remap) > 0:
+            columns['query_name'] = remap[columns['query_name']]
+        remap = np.array([query_sets.setdefault(name, len(query_sets)) for name in metadata['query_sets']], dtype=np.int16)
+        if len(remap) > 0:
+            tagged = columns['query_set'] >= 0
+            columns['query_set'][tagged] = remap[columns['query_set'][tagged]]
+        columns['run'] = np.full(len(columns['status']), len(runs), dtype=np.int32)
+        runs.append(metadata)
+        parts.append(columns)
+
+    if len(parts) == 0:
+        return [], {}
+    combined = {}
+    for name in parts[0]:
+        combined[name] = np.concatenate([part[name] for part in parts])
+    for metadata in runs:
+        metadata['query_names'] = list(names)
+        metadata['query_sets'] = list(query_sets)
+    return runs, combined
+
+def summarize_columns(metadata, columns, metric='round_trip_ms', percentiles=PERCENTILES):
+    # Latency percentiles for each query name, computed over the successful queries
+    success = columns['status'] == STATUSES.index('success')
+    summaries = {}
+    for code, name in enumerate(metadata['query_names']):
+        values = columns[metric][success & (columns['query_name'] == code)]
+        if len(values) == 0:
+            continue
+        summary = {'count': len(values), 'mean': float(np.mean(values))}
+        for pct, value in zip(percentiles, np.percentile(values, percentiles)):
+            summary[f'p{pct}'] = float(value)
+        summary['max'] = float(np.max(values))
+        summaries[name] = summary
+    return summaries
@@ -0,0 +1,196 @@
+import math, sys
+from array import array
+
+# Query results are QueryResult records rather than dicts. A record is used like a dict, result['status'] or
+# 'lag_ms' in result, but only has slots for the fields below. It is pickled, to come back from a worker
+# process, as a bit mask of the fields it has followed by their values. The query results of a whole test are
+# kept in a ResultTable, one typed array per field, with strings stored once and referred to by code.
+
+# Every field a query result can have
+FIELDS = [
+    'query_num', 'user_num', 'iteration', 'query_set', 'name', 'status', 'message',
+    'round_trip_ms', 'server_ms', 'queued_ns', 'query_ms', 'network_ms', 'row_count', 'new_connection',
+    'download_bytes', 'decode_ms', 'dns_ms', 'connect_ms', 'tls_ms', 'send_ms', 'ttfb_ms', 'download_ms',
+    'page_count', 'first_page_ms', 'drain_ms', 'page_latencies_ms', 'attempts', 'retried', 'backoff_ms',
+    'admission_ms', 'lag_ms', 'offset_s', 'seq', 'worker'
+]
+
+# Strings that repeat from result to result are interned, so every copy shares one string
+INTERNED = ['query_set', 'name', 'status', 'message']
+
+class QueryResult():
+    __slots__ = FIELDS
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return hasattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def keys(self):
+        return [field for field in FIELDS if hasattr(self, field)]
+
+    def to_row(self):
+        # A bit mask of the fields the result has, followed by their values
+        row = [0]
+        for bit in range(0, len(FIELDS)):
+            if hasattr(self, FIELDS[bit]):
+                row[0] |= 1 << bit
+                row.append(getattr(self, FIELDS[bit]))
+        return row
+
+    def __reduce__(self):
+        return (result_from_row, (self.to_row(),))
+
+    def __repr__(self):
+        return 'QueryResult(' + ', '.join(f'{field}={getattr(self, field)!r}' for field in self.keys()) + ')'
+
+def result_from_row(row):
+    result = QueryResult()
+    mask = row[0]
+    index = 1
+    for bit in range(0, len(FIELDS)):
+        if mask & (1 << bit):
+            value = row[index]
+            if FIELDS[bit] in INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(result, FIELDS[bit], value)
+            index += 1
+    return result
+
+
+# How a ResultTable stores each field other than the strings and lists: integers in the smallest array
+# typecode that holds them, with the lowest value of the type standing for a missing field, and numbers
+# that may or may not be whole as doubles, with NaN for a missing field.
+COLUMNS = {
+    'query_num': 'i', 'user_num': 'i', 'iteration': 'i', 'round_trip_ms': 'i', 'server_ms': 'd',
+    'queued_ns': 'q', 'query_ms': 'i', 'network_ms': 'd', 'row_count': 'q', 'new_connection': 'b',
+    'download_bytes': 'q', 'decode_ms': 'd', 'dns_ms': 'd', 'connect_ms': 'd', 'tls_ms': 'd', 'send_ms': 'd',
+    'ttfb_ms': 'd', 'download_ms': 'd', 'page_count': 'i', 'first_page_ms': 'i', 'drain_ms': 'i', 'attempts': 'h',
+    'backoff_ms': 'i', 'admission_ms': 'i', 'lag_ms': 'i', 'offset_s': 'd', 'seq': 'q', 'worker': 'h'
+}
+MISSING = {'b': -2**7, 'h': -2**15, 'i': -2**31, 'q': -2**63, 'd': math.nan}
+
+# Fields that are always recorded as floats. Other doubles that are whole numbers are read back as integers.
+FLOATS = ['decode_ms', 'dns_ms', 'connect_ms', 'tls_ms', 'send_ms', 'ttfb_ms', 'download_ms', 'offset_s']
+
+# Row counts of queries whose results were dropped
+DROPPED_ROWS = -1
+
+# Lists are only stored when they aren't empty. A result has an empty list when it has the field it goes with.
+LISTS = {'page_latencies_ms': 'page_count', 'retried': 'attempts'}
+
+class ResultTable():
+    # The query results of a test, one typed array per field. Iterating over the table, or indexing it,
+    # gives QueryResult records that are built as they are read.
+
+    def __init__(self, results=()):
+        self.count = 0
+        self.columns = {field: array(typecode) for field, typecode in COLUMNS.items()}
+        # Strings are stored as codes into the values of their field
+        self.codes = {field: array('i') for field in INTERNED}
+        self.strings = {field: {} for field in INTERNED}
+        self.values = {field: [] for field in INTERNED}
+        # Non empty lists, by row
+        self.lists = {field: {} for field in LISTS}
+        self.extend(results)
+
+    def __len__(self):
+        return self.count
+
+    def code(self, field, value):
+        strings = self.strings[field]
+        if not value in strings:
+            strings[value] = len(strings)
+            self.values[field].append(value)
+        return strings[value]
+
+    def append(self, result):
+        for field, typecode in COLUMNS.items():
+            value = result.get(field)
+            if value == None:
+                value = MISSING[typecode]
+            elif field == 'row_count' and value == 'dropped':
+                value = DROPPED_ROWS
+            elif field == 'new_connection':
+                value = 1 if value else 0
+            self.columns[field].append(value)
+        for field in INTERNED:
+            value = result.get(field)
+            self.codes[field].append(-1 if value == None else self.code(field, value))
+        for field in LISTS:
+            value = result.get(field)
+            if value:
+                self.lists[field][self.count] = value
+        self.count += 1
+
+    def extend(self, results):
+        if not isinstance(results, ResultTable):
+            for result in results:
+                self.append(result)
+            return
+        # Another table's arrays are copied as they are, with its string codes translated into this table's
+        for field in COLUMNS:
+            self.columns[field].extend(results.columns[field])
+        for field in INTERNED:
+            translate = [self.code(field, value) for value in results.values[field]]
+            self.codes[field].extend(array('i', (-1 if code < 0 else translate[code] for code in results.codes[field])))
+        for field in LISTS:
+            for row, value in results.lists[field].items():
+                self.lists[field][self.count + row] = value
+        self.count += results.count
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.count
+        if row < 0 or row >= self.count:
+            raise IndexError(row)
+        result = QueryResult()
+        for field, typecode in COLUMNS.items():
+            value = self.columns[field][row]
+            if typecode == 'd':
+                if math.isnan(value):
+                    continue
+                if field not in FLOATS and value.is_integer():
+                    value = int(value)
+            elif value == MISSING[typecode]:
+                continue
+            elif field == 'new_connection':
+                value = value == 1
+            setattr(result, field, value)
+        if 'row_count' in result and result.row_count == DROPPED_ROWS:
+            result.row_count = 'dropped'
+        for field in INTERNED:
+            code = self.codes[field][row]
+            if code >= 0:
+                setattr(result, field, self.values[field][code])
+        for field, companion in LISTS.items():
+            if row in self.lists[field] or companion in result:
+                setattr(result, field, list(self.lists[field].get(row, [])))
+        return result
+
+    def __iter__(self):
+        for row in range(0, self.count):
+            yield self[row]
+
+    def sort(self, field):
+        # Orders the rows by a numeric field, keeping the order of rows with the same value
+        column = self.columns[field]
+        order = sorted(range(0, self.count), key=column.__getitem__)
+        for name in COLUMNS:
+            self.columns[name] = array(COLUMNS[name], (self.columns[name][row] for row in order))
+        for name in INTERNED:
+            self.codes[name] = array('i', (self.codes[name][row] for row in order))
+        if any(len(self.lists[name]) > 0 for name in LISTS):
+            position = {row: index for index, row in enumerate(order)}
+            for name in LISTS:
+                self.lists[name] = {position[row]: value for row, value in self.lists[name].items()}
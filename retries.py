@@ -0,0 +1,66 @@
+import random
+
+# Names of the statuses that can be retried, as recorded in query results
+RETRY_STATUSES = {408: 'timeout', 429: 'exhausted'}
+
+JITTERS = ['full', 'equal', 'none']
+
+def get_retry_settings(target):
+    settings = {
+        'max_attempts': 1, 'base_ms': 100, 'multiplier': 2, 'max_backoff_ms': 5000, 'jitter': 'full',
+        'budget_ms': 0, 'retry_on': [429], 'honor_retry_after': True
+    }
+    if 'retry' in target and target['retry'] != None:
+        settings.update(target['retry'])
+    if settings['jitter'] not in JITTERS:
+        raise ValueError(f"Unexpected retry jitter {settings['jitter']}")
+    for status_code in settings['retry_on']:
+        if status_code not in RETRY_STATUSES:
+            raise ValueError(f'Retrying status {status_code} is not supported')
+    return settings
+
+def get_admission_settings(target):
+    # Admission control is off unless the target has an admission attribute, which can just be True
+    if not 'admission' in target or not target['admission']:
+        return None
+    settings = {'step_ms': 10, 'max_delay_ms': 1000, 'decay': 0.9}
+    if isinstance(target['admission'], dict):
+        settings.update(target['admission'])
+    return settings
+
+def get_retry_after_s(value):
+    # Only the delay-seconds form of Retry-After is used, HTTP dates are ignored
+    if value == None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+def get_backoff_s(settings, attempt):
+    # Exponential backoff after the given attempt, capped and then jittered
+    backoff = min(settings['max_backoff_ms'], settings['base_ms'] * settings['multiplier'] ** (attempt - 1)) / 1000
+    if settings['jitter'] == 'full':
+        return random.uniform(0, backoff)
+    elif settings['jitter'] == 'equal':
+        return backoff / 2 + random.uniform(0, backoff / 2)
+    return backoff
+
+def get_retry_wait_s(settings, status_code, attempt, elapsed_s, retry_after=None):
+    # Returns how long to wait before retrying a failed attempt, or None if it shouldn't be retried
+    if status_code not in settings['retry_on'] or attempt >= settings['max_attempts']:
+        return None
+    wait = get_backoff_s(settings, attempt)
+    if retry_after != None and settings['honor_retry_after']:
+        wait = max(wait, retry_after)
+    # The budget covers the whole query, from its first attempt to the end of its last
+    if settings['budget_ms'] > 0 and (elapsed_s + wait) * 1000 >= settings['budget_ms']:
+        return None
+    return wait
+
+def update_admission_delay(settings, delay_ms, status_code):
+    # The delay before each new query grows quickly while queries are rejected with 429 and decays as they succeed
+    if status_code == 429:
+        return min(settings['max_delay_ms'], delay_ms * 2 + settings['step_ms'])
+    delay_ms *= settings['decay']
+    return delay_ms if delay_ms >= 1 else 0.0
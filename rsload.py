@@ -1,9 +1,10 @@
 import os, yaml, requests, uuid
 import argparse
-from testModes import QPSTestMode, IterationsTestMode
+from testModes import new_test_mode
+from distributed import Coordinator, run_worker
 from dotenv import load_dotenv
 from datetime import datetime
-from testModes import IterationsTestMode
+from connections import get_base_url
 
 def parse_args():
     options = {}
@@ -12,50 +13,73 @@ def parse_args():
     parser.add_argument('--nolog', help='suppresses output log', action="store_true")
     parser.add_argument('-c', '--config', help='yaml configuration file with test parameters', default='./resources/config.yaml')
     parser.add_argument('-o', '--output_dir', help='directory where output is writen', default='./history')
+    parser.add_argument('--flush_interval', help='seconds between writes of query details while the test runs', type=float, default=1.0)
+    parser.add_argument('--flush_batch', help='maximum number of query details written at once', type=int, default=1000)
+    parser.add_argument('--live', help='show a live view of the test while it runs', action="store_true")
+    parser.add_argument('--live_interval', help='seconds between refreshes of the live view', type=float, default=1.0)
+    parser.add_argument('--live_window', help='seconds of results covered by the live view', type=int, default=10)
+    parser.add_argument('--metrics_port', help='serve live metrics for Prometheus on this port (0 = off)', type=int, default=0)
+    parser.add_argument('--metrics_host', help='address the metrics endpoint listens on', default='')
+    parser.add_argument('--metrics_file', help='write live metrics in the Prometheus text format to this file')
+    parser.add_argument('--metrics_interval', help='seconds between writes of the metrics file', type=float, default=5.0)
+    parser.add_argument('--columnar', help='also write the results of each run to a columnar NumPy file', action="store_true")
+    parser.add_argument('--queue_size', help='maximum number of query details waiting to be written', type=int, default=100000)
+    parser.add_argument('--coordinator', help='run the test on workers, listening for them on host:port')
+    parser.add_argument('--workers', help='number of workers the coordinator waits for (default = --local_workers)', type=int, default=0)
+    parser.add_argument('--local_workers', help='number of workers the coordinator starts on this machine', type=int, default=0)
+    parser.add_argument('--worker', help='run as a worker of the coordinator at host:port')
+    parser.add_argument('--stream_interval', help='seconds between the results a worker sends to the coordinator', type=float, default=1.0)
 
     args = parser.parse_args()
     options['config_file'] = args.config
     options['verbose'] = args.verbose
     options['output_dir'] = args.output_dir
+    options['flush_interval'] = args.flush_interval
+    options['flush_batch'] = args.flush_batch
+    options['queue_size'] = args.queue_size
+    options['columnar'] = args.columnar
+    options['live'] = args.live
+    options['live_interval'] = args.live_interval
+    options['live_window'] = args.live_window
+    options['metrics_port'] = args.metrics_port
+    options['metrics_host'] = args.metrics_host
+    options['metrics_file'] = args.metrics_file
+    options['metrics_interval'] = args.metrics_interval
+    options['coordinator'] = args.coordinator
+    options['workers'] = args.workers
+    options['local_workers'] = args.local_workers
+    options['worker'] = args.worker
+    options['stream_interval'] = args.stream_interval
 
     # TODO Make the history files configurable
     options['history_dir'] = './history'
     options['details_name'] = 'query_details.csv'
     options['qs_summary_name'] = 'query_set_summaries.csv'
+    options['qps_summary_name'] = 'qps_summaries.csv'
+    options['latency_summary_name'] = 'query_latency_summaries.csv'
+    options['query_set_summary_name'] = 'query_set_mix_summaries.csv'
+    options['capacity_summary_name'] = 'capacity_summaries.csv'
+    options['capacity_steps_name'] = 'capacity_steps.csv'
     options['log_output'] = not args.nolog
     return options
 
-def load_config(options):
-    config = {}
-
-    # Get the test configuration file
-    with open(options['config_file']) as stream:
-        try:
-            config = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-            exit("Could not process yaml config file")
-    # Get the API KEY
-    try:
-        load_dotenv()
-        apiKey = os.getenv('ROCKSET_APIKEY')
-        config['target']['api_key'] = apiKey
-    except KeyError as e:
-         exit("Did not find ROCKSET_APIKEY defined in .env or environment")
-
-    # Ensure the api server doesn't inclue the protocol
-    api_server = config['target']['api_server']
+def normalize_api_server(target):
+    # Ensure the api server doesn't inclue the protocol. Plain http is only used when asked for explicitly,
+    # which is useful when testing against a local mock server
+    api_server = target['api_server']
     if api_server[0:8] == 'https://':
         replacement = api_server[8:]
-        config['target']['api_server'] = replacement
+        target['api_server'] = replacement
     if api_server[0:7] == 'http://':
         replacement = api_server[7:]
-        config['target']['api_server'] = replacement
+        target['api_server'] = replacement
+        target['protocol'] = 'http'
 
+def load_target_info(target):
     # Get information about the test environment. Also tests connectivity
     viResopnse = requests.get(
-        'https://' + config['target']['api_server'] + '/v1/orgs/self/virtualinstances',
-        headers={'Authorization': 'ApiKey ' + config['target']['api_key']})
+        get_base_url(target) + '/v1/orgs/self/virtualinstances',
+        headers={'Authorization': 'ApiKey ' + target['api_key']})
 
     if viResopnse.status_code == 401:
         exit("Authorization failure connecting to target")
@@ -63,20 +87,42 @@ def load_config(options):
         exit(f'Unable to connect to target server. {viResopnse.reason}. {viResopnse.text}')
     viResponseJson = viResopnse.json()
     viResponseData = viResponseJson['data'][0]
-    config['target']['vi_size'] = viResponseData['current_type']
+    target['vi_size'] = viResponseData['current_type']
 
     #Get information about the target org settings. These are only added to the output for reference
     orgResopnse = requests.get(
-        'https://' + config['target']['api_server'] + '/v1/orgs/self/settings',
-        headers={'Authorization': 'ApiKey ' + config['target']['api_key']})
+        get_base_url(target) + '/v1/orgs/self/settings',
+        headers={'Authorization': 'ApiKey ' + target['api_key']})
     if orgResopnse.status_code != 200:
-        exit(f'Unable to get org information from server. {viResopnse.reason}. {viResopnse.text}')
+        exit(f'Unable to get org information from server. {orgResopnse.reason}. {orgResopnse.text}')
     orgResponseJson = orgResopnse.json()
     orgResponseData = orgResponseJson['data']
 
-    config['target']['aggregator_parallelism'] = orgResponseData['aggregator_parallelism']
-    config['target']['concurrent_queries_limit'] = orgResponseData['concurrent_queries_limit'] 
-    config['target']['concurrent_query_execution_limit'] = orgResponseData['concurrent_query_execution_limit']
+    target['aggregator_parallelism'] = orgResponseData['aggregator_parallelism']
+    target['concurrent_queries_limit'] = orgResponseData['concurrent_queries_limit'] 
+    target['concurrent_query_execution_limit'] = orgResponseData['concurrent_query_execution_limit']
+
+def load_api_key():
+    try:
+        load_dotenv()
+        return os.getenv('ROCKSET_APIKEY')
+    except KeyError as e:
+         exit("Did not find ROCKSET_APIKEY defined in .env or environment")
+
+def load_config(options):
+    config = {}
+
+    # Get the test configuration file
+    with open(options['config_file']) as stream:
+        try:
+            config = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print(exc)
+            exit("Could not process yaml config file")
+    config['target']['api_key'] = load_api_key()
+
+    normalize_api_server(config['target'])
+    load_target_info(config['target'])
 
     stats = {}
  
@@ -94,14 +140,14 @@ def load_config(options):
 
 if __name__ == "__main__":
     options = parse_args()
-    config = load_config(options)
-    iterations = 1
-    if 'iterations' in config:
-        iterations = config['iterations']
+    if options['worker'] != None:
+        # Workers get the test from the coordinator
+        run_worker(options['worker'], load_api_key(), options['verbose'])
+        exit()
 
-    if iterations < 1:
-        test = QPSTestMode(config, options) 
+    config = load_config(options)
+    test = new_test_mode(config, options)
+    if options['coordinator'] != None:
+        Coordinator(options, test).run()
     else:
-        test = IterationsTestMode(config, options) 
-
-    test.run()
\ No newline at end of file
+        test.run()
\ No newline at end of file
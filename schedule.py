@@ -0,0 +1,62 @@
+import math, random
+
+def get_stages(qps_config):
+    # A test is either a single stage (rate + duration) or an explicit list of stages
+    if 'stages' in qps_config and qps_config['stages']:
+        stages = qps_config['stages']
+    else:
+        stages = [{'rate': qps_config['rate'], 'duration': qps_config['duration']}]
+
+    resolved = []
+    previous_rate = 0
+    for stage in stages:
+        end_rate = float(stage['rate'])
+        duration = float(stage['duration'])
+        if 'ramp' in stage and stage['ramp']:
+            start_rate = previous_rate
+        else:
+            start_rate = end_rate
+        resolved.append({'start_rate': start_rate, 'end_rate': end_rate, 'duration': duration})
+        previous_rate = end_rate
+    return resolved
+
+def stage_offset(stage, arrivals):
+    # Invert the cumulative arrival count of a (possibly linearly ramping) stage.
+    # The count at time t is start_rate * t + slope * t^2 / 2
+    start_rate = stage['start_rate']
+    slope = (stage['end_rate'] - start_rate) / stage['duration']
+    if slope == 0:
+        return arrivals / start_rate
+    return (math.sqrt(start_rate * start_rate + 2 * slope * arrivals) - start_rate) / slope
+
+def build_schedule(qps_config):
+    # Returns the offsets, in seconds from the start of the test, at which each query is issued
+    arrival = 'constant'
+    if 'arrival' in qps_config:
+        arrival = qps_config['arrival']
+    if arrival not in ['constant', 'poisson']:
+        raise ValueError(f'Unexpected arrival distribution {arrival}')
+
+    rng = random.Random(qps_config['seed'] if 'seed' in qps_config else None)
+    # Constant arrivals start this fraction of an interval into each stage, so that the schedules of the
+    # workers of a distributed test interleave rather than all arriving at once
+    phase = qps_config['phase'] if 'phase' in qps_config else 0.0
+
+    schedule = []
+    stage_start = 0.0
+    for stage in get_stages(qps_config):
+        # Total number of arrivals expected in this stage
+        stage_arrivals = (stage['start_rate'] + stage['end_rate']) / 2 * stage['duration']
+        position = rng.expovariate(1.0) if arrival == 'poisson' else phase
+        while position < stage_arrivals:
+            schedule.append(stage_start + stage_offset(stage, position))
+            if arrival == 'poisson':
+                position += rng.expovariate(1.0)
+            else:
+                position += 1.0
+        stage_start += stage['duration']
+
+    return schedule
+
+def get_planned_duration(qps_config):
+    return sum(stage['duration'] for stage in get_stages(qps_config))
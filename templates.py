@@ -0,0 +1,96 @@
+import json
+from connections import get_base_url
+from feeders import bind_parameters
+
+# Queries are compiled into request templates once, when their executor is created, so sending a query doesn't
+# rebuild its url, headers or payload. The payload is encoded to JSON bytes up front. For a query with feeders
+# the bytes are split around its parameters, and only the parameters are encoded for each request.
+
+# Stands in for the parameters while a payload with feeders is encoded
+PARAMETERS_MARK = '__rsload_parameters__'
+
+def build_request(target, query):
+    # Returns the url, payload, headers and whether results are dropped, or None if the query definition is invalid
+
+    drop_results = False
+    if 'overrides' in target:
+        overrides = target['overrides']
+        if overrides != None:
+            if 'drop_results' in overrides:
+                drop_results = True
+
+    payload = {}
+    headers = {'Authorization': 'ApiKey ' + target['api_key'] ,'Content-Type': 'application/json' }
+
+    if 'lambda' in query:
+
+        qlURL = query['lambda']
+        if qlURL[0] != '/':
+            qlURL = '/' + qlURL
+
+        if 'parameters' in query:
+            payload['parameters'] = query['parameters']
+
+        if drop_results:
+            print('Warning: drop results is not currently supported when using query lambdas')
+            drop_results = False
+
+        url = get_base_url(target) + qlURL
+    elif 'sql' in query:
+        sql = {}
+        sql['query'] = query['sql']
+        drop_results = ('drop_results' in query and query['drop_results']) or drop_results
+        if drop_results:
+            baseQuery = sql['query'].rstrip()
+            if baseQuery[-1] == ';':
+                baseQuery = baseQuery[:-1]
+            sql['query'] = baseQuery + ' HINT(final_aggregator_drop_results=true)'
+        if 'parameters' in query:
+            sql['parameters'] = query['parameters']
+        if 'paginate' in query:
+            sql['paginate'] = query['paginate']
+        if 'initial_paginate_response_doc_count' in query:       
+            sql['initial_paginate_response_doc_count'] = query['initial_paginate_response_doc_count']
+
+        payload['sql'] = sql
+        url = get_base_url(target) + '/v1/orgs/self/queries'
+    else:
+        return None
+
+    return url, payload, headers, drop_results
+
+class RequestTemplate():
+    def __init__(self, url, payload, headers, drop_results, fed):
+        self.url = url
+        self.headers = headers
+        self.drop_results = drop_results
+        # Paginated responses are decoded in full, for the cursors of their pages
+        self.paginated = 'sql' in payload and bool(payload['sql'].get('paginate'))
+        self.body = json.dumps(payload).encode()
+        self.parameters = None
+        self.prefix = None
+        self.suffix = None
+        if fed:
+            container = payload['sql'] if 'sql' in payload else payload
+            self.parameters = container.get('parameters') or []
+            container['parameters'] = PARAMETERS_MARK
+            # Quotes inside JSON strings are escaped, so the quoted mark can only be the parameters value
+            self.prefix, mark, self.suffix = json.dumps(payload).encode().rpartition(json.dumps(PARAMETERS_MARK).encode())
+            container['parameters'] = self.parameters
+
+    def render(self, values=None):
+        # Returns the request body, with the fed values bound into the parameters
+        if values == None or self.prefix == None:
+            return self.body
+        return self.prefix + json.dumps(bind_parameters(self.parameters, values)).encode() + self.suffix
+
+def compile_template(target, query, fed=False):
+    # Returns None if the query definition is invalid
+    request = build_request(target, query)
+    if request == None:
+        return None
+    url, payload, headers, drop_results = request
+    return RequestTemplate(url, payload, headers, drop_results, fed)
+
+def compile_templates(target, query_set, query_feeders):
+    return [compile_template(target, query_set[x], len(query_feeders[x]) > 0) for x in range(0, len(query_set))]
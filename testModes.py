@@ -1,6 +1,21 @@
-from output import log_qs_summary, log_query_results
-from display import display_qs_summary, display_qs_results
-from executors import ParallelQSExecutor, SerialQSExecutor
+from output import log_qs_summary, log_qps_summary, log_capacity_summary
+from display import display_qs_summary, display_qs_results, display_qps_summary, display_writer_summary, display_capacity_step, display_capacity_summary
+from writer import DetailWriter
+from resultArrays import ResultArrayWriter
+from dashboard import LiveDashboard
+from metrics import MetricsExporter
+from executors import ParallelQSExecutor, SerialQSExecutor, OpenLoopExecutor, ReplayExecutor, VirtualUserExecutor
+from asyncExecutors import AsyncQSExecutor, AsyncOpenLoopExecutor, AsyncVirtualUserExecutor
+from users import get_user_settings
+from schedule import build_schedule, get_planned_duration
+from histograms import ResultStats, query_set_key
+from results import ResultTable
+from capacity import get_capacity_settings, get_step_qps_config, get_steady_stats, evaluate_step, CapacitySearch
+from mixes import get_query_sets, get_set_qps_config, get_set_user_settings, get_set_iterations, run_concurrently
+from traces import get_replay_settings, read_trace
+from feeders import get_query_feeders
+from templates import compile_templates
+from functools import partial
 
 class TestMode():
     def __init__(self,config, options):
@@ -8,23 +23,129 @@ class TestMode():
         self.options = options
         self.verbose = options['verbose']
         self.log_output = options['log_output']
+        self.writer = None
+        self.array_writer = None
+        self.dashboard = None
+        self.metrics = None
+        # Results left out of the details file because the writer couldn't keep up
+        self.details_dropped = 0
+        # Called with every query result as it arrives
+        self.result_handlers = []
+        # Compiled requests of each query set, by query set name
+        self.templates = {}
+        # Whether open loop executors return every result as well as the stats
+        self.keep_open_loop_results = False
 
-    def run_queryset(self, target, query_set):
+    def start_output(self):
+        if self.options['live']:
+            self.dashboard = LiveDashboard(self.options['live_interval'], self.options['live_window'])
+            self.result_handlers.append(self.dashboard.stats.record)
+            self.dashboard.start()
+
+        if self.options['metrics_port'] > 0 or self.options['metrics_file'] != None:
+            self.metrics = MetricsExporter(self.options, self.config)
+            self.result_handlers.append(self.metrics.record)
+            self.metrics.start()
+
+        # Query details are written while the test runs rather than after it finishes
+        if self.log_output:
+            self.writer = DetailWriter(self.options, self.config)
+            self.writer.start()
+            self.result_handlers.append(self.writer.add)
+            if self.options['columnar']:
+                self.array_writer = ResultArrayWriter(self.options, self.config)
+                self.result_handlers.append(self.array_writer.add)
+
+    def stop_output(self):
+        if self.dashboard != None:
+            self.dashboard.stop()
+        if self.metrics != None:
+            self.metrics.stop()
+        if self.writer != None:
+            self.writer.close()
+            writer_summary = self.writer.summary()
+            self.details_dropped = writer_summary['dropped']
+            if self.verbose or writer_summary['dropped'] > 0:
+                display_writer_summary(self.options, writer_summary)
+        if self.array_writer != None:
+            path = self.array_writer.close()
+            if self.verbose:
+                print(f"--- COLUMNAR --- results written to {path}")
+
+    def add_result_handlers(self, executor, query_set_name=None):
+        executor.query_set_name = query_set_name
+        executor.result_handlers.extend(self.result_handlers)
+        if self.dashboard != None:
+            self.dashboard.watch(executor)
+        if self.metrics != None:
+            self.metrics.watch(executor)
+        return executor
+
+    def get_templates(self, target, query_set, query_set_name=None):
+        # Each query set is compiled once for the whole test, however many executors, iterations or capacity
+        # steps run it
+        if not query_set_name in self.templates:
+            self.templates[query_set_name] = compile_templates(target, query_set, get_query_feeders(query_set))
+        return self.templates[query_set_name]
+
+    def new_queryset_executor(self, target, query_set, query_set_name=None):
 
         if 'execution_mode' in target:
             mode = target['execution_mode']
         else:
             mode = 'serial'
 
+        templates = self.get_templates(target, query_set, query_set_name)
         if mode == 'parallel':
-            executor =  ParallelQSExecutor(target, query_set)
+            executor =  ParallelQSExecutor(target, query_set, templates)
         elif mode == 'serial':
-            executor =  SerialQSExecutor(target, query_set)
+            executor =  SerialQSExecutor(target, query_set, templates)
+        elif mode == 'async':
+            executor =  AsyncQSExecutor(target, query_set, templates)
         else:
             print(f"Unexpected query set execution mode {mode}")
             return None
+        return self.add_result_handlers(executor, query_set_name)
 
-        return executor.run()
+    def new_open_loop_executor(self, query_set, workers):
+        target = query_set['target']
+        templates = self.get_templates(target, query_set['queries'], query_set['name'])
+        if 'execution_mode' in target and target['execution_mode'] == 'async':
+            executor = AsyncOpenLoopExecutor(target, query_set['queries'], templates)
+        else:
+            executor = OpenLoopExecutor(target, query_set['queries'], query_set['workers'] if 'workers' in query_set else workers, templates)
+        executor.keep_results = self.keep_open_loop_results
+        return self.add_result_handlers(executor, query_set['name'])
+
+    def run_open_loop(self, qps_config, workers):
+        # Every query set runs on its own arrival schedule at the same time. Returns None if there is nothing to run.
+        query_sets = get_query_sets(self.config)
+        runs = []
+        scheduled = 0
+        planned_s = 0
+        for query_set in query_sets:
+            set_qps_config = get_set_qps_config(qps_config, query_sets, query_set)
+            schedule = build_schedule(set_qps_config)
+            if len(schedule) == 0:
+                continue
+            scheduled += len(schedule)
+            planned_s = max(planned_s, get_planned_duration(set_qps_config))
+            runs.append(partial(self.new_open_loop_executor(query_set, workers).run, schedule))
+        if len(runs) == 0:
+            return None
+        results = run_concurrently(runs)
+        results['scheduled'] = scheduled
+        results['planned_s'] = planned_s
+        return results
+
+    def run(self):
+        self.start_output()
+        # The details written so far are flushed and saved even if the test fails
+        try:
+            results = self.run_test()
+        finally:
+            self.stop_output()
+        self.report(results)
 
     def obfuscate_apikey(self, config):
         # We obfuscate the apikey once we are done executing any queries to prevent it from being leaked in any reports
@@ -32,69 +153,212 @@ class TestMode():
         config['target']['api_key'] = '******' + last4
 
     def summarize_qs_results(self, config, results):
-        total, query, queued, network = 0,0,0,0 
-        warnings = []
-        clean = True
-        for result in results['query_results']:
-            if result['status'] == 'success':
-                total += result['round_trip_ms']
-                query += result['query_ms']
-                queued += round(result['queued_ns']/1000)
-                network += result['network_ms']
-                if result['row_count'] == 0:
-                    clean = False
-                    warning = {}
-                    warning['query_num'] = result['query_num']
-                    warning['name'] = result['name']
-                    warning['message'] = 'Returned no rows'
-                    warnings.append(warning)
-            elif result['status'] == 'error':
-                    clean = False
-                    warning = {}
-                    warning['query_num'] = result['query_num']
-                    warning['name'] = result['name']
-                    warning['message'] = f"Errored with message: {result['message']}"
-                    warnings.append(warning)
-            elif result['status'] == 'timeout':
-                    clean = False
-                    warning = {}
-                    warning['query_num'] = result['query_num']
-                    warning['name'] = result['name']
-                    warning['message'] = 'Query timed out'
-                    warnings.append(warning)
-            elif result['status'] == 'exhausted':
-                    clean = False
-                    warning = {}
-                    warning['query_num'] = result['query_num']
-                    warning['name'] = result['name']
-                    warning['message'] = 'Resources exhausted'
-                    warnings.append(warning)
-        
+        # Everything is taken from the stats that were aggregated while the results arrived
+        stats = results['stats']
+        elapsed_s = results['elapsed_s']
         return {
-            'total_ms': total,
-            'query_ms': query,
-            'queued_ms': queued,
-            'network_ms': network,
-            'warnings': warnings,
-            'clean': clean
+            'total_ms': round(stats.histogram('round_trip_ms').total_ms()),
+            'query_ms': round(stats.histogram('query_ms').total_ms()),
+            'queued_ms': round(stats.histogram('queued_ms').total_ms()),
+            'network_ms': round(stats.histogram('network_ms').total_ms()),
+            'new_connections': stats.new_connections,
+            'reused_connections': stats.reused_connections,
+            'download_bytes': stats.download_bytes,
+            'decode_ms': round(stats.histogram('decode_ms').total_ms(), 3),
+            'attempts': stats.attempts,
+            'retries': stats.retries(),
+            'retried_statuses': stats.retried_statuses,
+            'backoff_ms': round(stats.histogram('backoff_ms').total_ms()),
+            'admission_ms': round(stats.histogram('admission_ms').total_ms()),
+            'count': stats.count(),
+            'successes': stats.successes(),
+            'elapsed_s': round(elapsed_s, 3),
+            'throughput_qps': round(stats.successes() / elapsed_s, 2) if elapsed_s > 0 else 0,
+            'latency': stats.latency_summaries(),
+            'warnings': stats.warnings,
+            'warning_count': stats.warning_count,
+            'clean': stats.clean(),
+            'details_dropped': self.details_dropped,
+            'query_sets': self.summarize_query_sets(stats, elapsed_s)
         }
 
+    def summarize_query_sets(self, stats, elapsed_s):
+        # One summary for each query set of a mix
+        summaries = []
+        for query_set in stats.query_set_statuses:
+            statuses = stats.query_set_statuses[query_set]
+            count = sum(statuses.values())
+            successes = statuses.get('success', 0)
+            summaries.append({
+                'name': query_set,
+                'count': count,
+                'successes': successes,
+                'share': round(count / stats.count(), 3) if stats.count() > 0 else 0,
+                'throughput_qps': round(successes / elapsed_s, 2) if elapsed_s > 0 else 0,
+                'round_trip': stats.histogram('round_trip_ms', query_set_key(query_set)).summary()
+            })
+        return summaries
+
 class QPSTestMode(TestMode):
     def __init__(self,config, options):
        super().__init__(config,options)
 
+    def summarize_qps_results(self, results):
+        planned_s = results['planned_s']
+        stats = results['stats']
+        lag = stats.histogram('lag_ms')
+
+        return {
+            'planned_s': planned_s,
+            'elapsed_s': round(results['elapsed_s'], 3),
+            'scheduled': results['scheduled'],
+            'completed': stats.count(),
+            'successes': stats.successes(),
+            'offered_qps': round(results['scheduled'] / planned_s, 2) if planned_s > 0 else 0,
+            'issued_qps': round(stats.count() / results['issue_s'], 2) if results['issue_s'] > 0 else 0,
+            'achieved_qps': round(stats.successes() / results['elapsed_s'], 2) if results['elapsed_s'] > 0 else 0,
+            'lag_p50_ms': lag.percentile(50),
+            'lag_p99_ms': lag.percentile(99),
+            'lag_max_ms': lag.max_ms(),
+            'max_dispatch_lag_ms': results['max_dispatch_lag_ms']
+        }
+
+    def run_test(self):
+        qps_config = self.config['qps']
+        workers = 32
+        if 'workers' in qps_config:
+            workers = qps_config['workers']
+        return self.run_open_loop(qps_config, workers)
+
+    def report(self, query_results):
+        if query_results == None:
+            print("QPS test schedule is empty. Check the rate and duration settings")
+            return
+        self.obfuscate_apikey(self.config)
+        query_set_summary = self.summarize_qs_results(self.config, query_results)
+        qps_summary = self.summarize_qps_results(query_results)
+        if self.verbose:
+            display_qs_summary(self.config, query_set_summary)
+            display_qps_summary(self.config, qps_summary)
+        if self.log_output:
+            log_qs_summary(self.options, self.config, query_set_summary)
+            log_qps_summary(self.options, self.config, qps_summary)
+
+class ReplayTestMode(QPSTestMode):
+    # Replays a trace of recorded queries open loop. The lag is how far the queries fell behind the trace.
+    def __init__(self,config, options):
+       super().__init__(config,options)
+
+    def run_test(self):
+        settings = get_replay_settings(self.config)
+        executor = self.add_result_handlers(ReplayExecutor(self.config['target'], settings['workers']))
+        partition = settings['partition'] if 'partition' in settings else None
+        return executor.run(read_trace(settings, partition))
+
+    def report(self, query_results):
+        if query_results == None:
+            print("Replay trace is empty. Check the trace file and limit")
+            return
+        super().report(query_results)
+
 class IterationsTestMode(TestMode):
     def __init__(self,config, options):
        super().__init__(config,options)
 
-    def run(self):
-        query_results = self.run_queryset(self.config['target'], self.config['queries'])
+    def run_iterations(self, target, query_set, iterations, query_set_name=None):
+        query_results = ResultTable()
+        stats = ResultStats()
+        elapsed_s = 0
+        # One executor runs every iteration, so its workers and their connections last for the whole test
+        executor = self.new_queryset_executor(target, query_set, query_set_name)
+        if executor == None:
+            return None
+        try:
+            for iteration in range(1, iterations + 1):
+                executor.iteration = iteration
+                results = executor.run()
+                query_results.extend(results['query_results'])
+                stats.merge(results['stats'])
+                elapsed_s += results['elapsed_s']
+        finally:
+            executor.close()
+        return {'query_results': query_results, 'stats': stats, 'elapsed_s': elapsed_s}
+
+    def run_users(self, target, query_set, user_settings, query_set_name=None):
+        templates = self.get_templates(target, query_set, query_set_name)
+        if 'execution_mode' in target and target['execution_mode'] == 'async':
+            executor = AsyncVirtualUserExecutor(target, query_set, user_settings, templates)
+        else:
+            executor = VirtualUserExecutor(target, query_set, user_settings, templates)
+        self.add_result_handlers(executor, query_set_name)
+        return executor.run()
+
+    def run_test(self):
+        user_settings = get_user_settings(self.config)
+        query_sets = get_query_sets(self.config)
+        # The query sets of a mix run at the same time, each with its own share of the users or its own iterations
+        runs = []
+        for query_set in query_sets:
+            if 'users' in self.config:
+                runs.append(partial(self.run_users, query_set['target'], query_set['queries'],
+                    get_set_user_settings(user_settings, query_sets, query_set), query_set['name']))
+            else:
+                runs.append(partial(self.run_iterations, query_set['target'], query_set['queries'],
+                    get_set_iterations(user_settings['iterations'], query_set), query_set['name']))
+        return run_concurrently(runs)
+
+    def report(self, query_results):
+        if query_results == None:
+            return
         self.obfuscate_apikey(self.config)
         query_set_summary = self.summarize_qs_results(self.config, query_results)
         if self.verbose:
             display_qs_results(self.config, query_results)
             display_qs_summary(self.config, query_set_summary)
         if self.log_output:
-            log_query_results(self.options, self.config, query_results)
             log_qs_summary(self.options, self.config, query_set_summary)
-  
+
+class CapacityTestMode(TestMode):
+    # Runs a series of short open-loop steps to find the highest rate the target sustains within the SLO
+    def __init__(self,config, options):
+       super().__init__(config,options)
+       # Each step's stats leave out the queries of its warm up, which are told apart by their offsets
+       self.keep_open_loop_results = True
+
+    def run_step(self, settings, rate):
+        results = self.run_open_loop(get_step_qps_config(settings, rate), settings['workers'])
+        query_results = results['query_results'] if results != None else []
+        return evaluate_step(settings, rate, get_steady_stats(query_results, settings['warmup_s']))
+
+    def run_test(self):
+        settings = get_capacity_settings(self.config)
+        search = CapacitySearch(settings)
+        rate = search.next_rate()
+        while rate != None:
+            step = self.run_step(settings, rate)
+            if self.verbose:
+                display_capacity_step(step)
+            search.add_step(step)
+            rate = search.next_rate()
+        return search
+
+    def report(self, search):
+        self.obfuscate_apikey(self.config)
+        capacity_summary = search.summary()
+        if self.verbose:
+            display_capacity_summary(self.config, capacity_summary)
+        if self.log_output:
+            log_capacity_summary(self.options, self.config, capacity_summary)
+
+def new_test_mode(config, options):
+    iterations = 1
+    if 'iterations' in config:
+        iterations = config['iterations']
+
+    if 'capacity' in config:
+        return CapacityTestMode(config, options)
+    elif 'replay' in config:
+        return ReplayTestMode(config, options)
+    elif iterations < 1:
+        return QPSTestMode(config, options)
+    return IterationsTestMode(config, options)
@@ -0,0 +1,76 @@
+import csv, json, os
+from datetime import datetime
+
+# A trace is a log of recorded queries, one per line, in the order they were sent. Each record has a timestamp
+# and a query definition, either sql or a lambda path, with its parameters and any other query options. The
+# trace is read a line at a time while it is replayed, so it can be much larger than memory.
+#
+# JSON lines:  {"timestamp": "2023-05-01T12:00:00.250Z", "name": "search", "sql": "SELECT ...", "parameters": [...]}
+# CSV:         timestamp,name,sql,lambda,parameters   (parameters as a JSON list)
+
+FORMATS = {'.jsonl': 'jsonl', '.json': 'jsonl', '.csv': 'csv'}
+TIME_UNITS = {'s': 1, 'ms': 1000, 'us': 1000000}
+
+def get_replay_settings(config):
+    settings = {'speed': 1.0, 'workers': 32, 'time_field': 'timestamp', 'time_unit': 's', 'limit': 0}
+    if config['replay'] != None:
+        settings.update(config['replay'])
+    if not 'file' in settings:
+        raise ValueError('A replay needs a trace file')
+    if not 'format' in settings:
+        settings['format'] = FORMATS.get(os.path.splitext(settings['file'])[1].lower())
+    if settings['format'] not in FORMATS.values():
+        raise ValueError(f"Unable to tell the format of trace file {settings['file']}")
+    if settings['speed'] <= 0:
+        raise ValueError('The replay speed must be greater than 0')
+    if settings['time_unit'] not in TIME_UNITS:
+        raise ValueError(f"Unexpected trace time unit {settings['time_unit']}")
+    return settings
+
+def get_timestamp_s(value, time_unit):
+    # Numbers are epoch times in time_unit, strings are ISO 8601 times
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    return value / TIME_UNITS[time_unit]
+
+def read_records(settings):
+    with open(settings['file'], newline='') as trace:
+        if settings['format'] == 'csv':
+            for row in csv.DictReader(trace):
+                # Empty CSV fields mean the column doesn't apply to the record
+                record = {key: value for key, value in row.items() if value != '' and value != None}
+                if 'parameters' in record:
+                    record['parameters'] = json.loads(record['parameters'])
+                yield record
+        else:
+            for line in trace:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+def get_query(record, time_field):
+    # The query definition of a record. Queries without a name are named after their lambda, so that the
+    # latency of each lambda is reported on its own.
+    query = {key: value for key, value in record.items() if key != time_field}
+    if not 'name' in query:
+        query['name'] = query['lambda'] if 'lambda' in query else 'sql'
+    return query
+
+def read_trace(settings, partition=None):
+    # Yields (offset_s, query_num, query) for each record, where offset_s is the time since the first record,
+    # divided by the speed up, and query_num is the record's position in the trace. A partition [num, count]
+    # keeps every count-th record, starting at num, so that the workers of a distributed test share the trace.
+    first = None
+    query_num = 0
+    for record in read_records(settings):
+        query_num += 1
+        if settings['limit'] > 0 and query_num > settings['limit']:
+            return
+        timestamp = get_timestamp_s(record[settings['time_field']], settings['time_unit'])
+        if first == None:
+            first = timestamp
+        if partition != None and (query_num - 1) % partition[1] != partition[0]:
+            continue
+        yield (timestamp - first) / settings['speed'], query_num, get_query(record, settings['time_field'])
@@ -0,0 +1,42 @@
+import random
+
+def get_user_settings(config):
+    settings = {'count': 1, 'ramp_up': 0, 'think_time': 0, 'duration': 0, 'iterations': 1}
+    if 'users' in config and config['users'] != None:
+        settings.update(config['users'])
+    if 'iterations' in config:
+        settings['iterations'] = config['iterations']
+    # The workers of a distributed test each run some of the users. offset is the number of users before this
+    # worker's first, and total the number of users across every worker.
+    settings.setdefault('offset', 0)
+    settings.setdefault('total', settings['count'])
+    return settings
+
+def get_user_nums(settings):
+    # Users are numbered across all of a distributed test's workers, so that partitioned feeders give each
+    # user its own slice and its start is spread over the whole ramp up
+    return range(settings['offset'] + 1, settings['offset'] + settings['count'] + 1)
+
+def get_start_offset(settings, user_num):
+    # Users are started evenly over the ramp up period
+    if settings['total'] < 2:
+        return 0
+    return settings['ramp_up'] * (user_num - 1) / settings['total']
+
+def get_think_time(settings, rng=random):
+    # Think time is either a fixed number of seconds or a [min, max] range
+    think_time = settings['think_time']
+    if isinstance(think_time, list):
+        return rng.uniform(think_time[0], think_time[1])
+    return think_time
+
+def get_deadline(settings, start):
+    if settings['duration'] > 0:
+        return start + settings['duration']
+    return None
+
+def has_more_iterations(settings, iteration, deadline, now):
+    # With a duration users keep iterating until it expires, otherwise they stop after the configured iterations
+    if deadline != None:
+        return now < deadline
+    return iteration <= settings['iterations']
@@ -0,0 +1,90 @@
+import csv, queue, threading, time
+from output import create_details_file, format_query_result
+
+class DetailWriter():
+    # Streams query results to the details file from a background thread while the test runs.
+    # Results are handed over on a bounded queue and never block the caller, which is often the thread
+    # issuing queries: when the writer falls behind and the queue is full, results are dropped from the
+    # details file and counted instead, and the count is recorded in the test's summary.
+
+    def __init__(self, options, config):
+        self.options = options
+        self.config = config
+        self.batch_size = options['flush_batch']
+        self.flush_interval = options['flush_interval']
+        self.queue = queue.Queue(maxsize=options['queue_size'])
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.stopping = threading.Event()
+
+        # Results are added from several handler threads
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.write_s = 0.0
+
+    def start(self):
+        self.file_path = create_details_file(self.options)
+        self.thread.start()
+
+    def add(self, result):
+        try:
+            self.queue.put_nowait(result)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return
+        depth = self.queue.qsize()
+        with self.lock:
+            self.queued += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+    def flush(self, details, writer, batch):
+        start = time.perf_counter()
+        writer.writerows([format_query_result(self.config, result) for result in batch])
+        details.flush()
+        self.write_s += time.perf_counter() - start
+        self.written += len(batch)
+        self.batches += 1
+
+    def write(self):
+        with open(self.file_path, 'at') as details:
+            writer = csv.writer(details, delimiter = ',')
+            batch = []
+            last_flush = time.time()
+            while True:
+                timeout = max(0, last_flush + self.flush_interval - time.time())
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    pass
+
+                if len(batch) >= self.batch_size or time.time() - last_flush >= self.flush_interval:
+                    if len(batch) > 0:
+                        self.flush(details, writer, batch)
+                        batch = []
+                    last_flush = time.time()
+
+                if self.stopping.is_set() and self.queue.empty():
+                    break
+
+            if len(batch) > 0:
+                self.flush(details, writer, batch)
+
+    def close(self):
+        # Writes everything still queued and waits for the writer to finish
+        self.stopping.set()
+        self.thread.join()
+
+    def summary(self):
+        return {
+            'queued': self.queued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'max_depth': self.max_depth,
+            'write_s': round(self.write_s, 3)
+        }